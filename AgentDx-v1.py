@@ -1,1499 +1,2182 @@
-import streamlit as st
-import threading, re, os
-from PIL import Image, UnidentifiedImageError
+import threading, re, os, sys
+from PIL import Image, ImageChops, ImageOps, UnidentifiedImageError
+from langchain_core.runnables import RunnableConfig
 from langgraph.graph import StateGraph
-from typing import Dict, Any, List, Set
+from langgraph.types import Send
+from collections import OrderedDict, deque
+import concurrent.futures
+from concurrent.futures import ThreadPoolExecutor
+from typing import Annotated, Dict, Any, List, Optional, Set
 import requests, io, time
+import asyncio
+import base64
+import contextvars
+import functools
+import hashlib
+import itertools
+import queue
+import sqlite3
+import weakref
 import uuid
 import json
 
-conversation_id = str(uuid.uuid4())
-
-def generate_response(prompt, images=None):
-    api_url = "YOUR_API_URL"
-    auth_token = "YOUR_AUTH_TOKEN"
-
-    headers = {"Authorization": f"Bearer {auth_token}"}
-    files = {}
-    processed_image_bytes_io = None  # To store the BytesIO object for later closing
-
-    if images:  # images is expected to be a List[Image.Image]
-        try:
-            # Process the first image in the list if the list is not empty
-            image_to_process = images[0]
-            
-            if not isinstance(image_to_process, Image.Image):
-                error_msg = f"Error: Expected a PIL Image, but got {type(image_to_process)}"
-                print(error_msg)
-                yield error_msg
-                return
-
-            processed_image_bytes_io = io.BytesIO()
-            image_to_process.save(processed_image_bytes_io, format="PNG")
-            processed_image_bytes_io.seek(0)
-            files["file"] = ("image.png", processed_image_bytes_io.getvalue(), "image/png")
-        
-        except IndexError: # images list was empty
-            print("Error: Image list was empty or image could not be accessed.")
-            
-        except Exception as e:
-            error_msg = f"Error processing image: {e}"
-            print(error_msg)
-            if processed_image_bytes_io:
-                processed_image_bytes_io.close()
-                processed_image_bytes_io = None # Avoid closing again in finally
-            yield error_msg
-            return
-
-    data = {"text": prompt, "conversation_id": conversation_id}
-    
-    response_obj = None
-    accumulated_response_text = ""
-
-    try:
-        response_obj = requests.post(api_url, headers=headers, files=files, data=data, stream=True)
-        response_obj.raise_for_status()  # Raise HTTPError for bad responses (4xx or 5xx)
-
-        for line in response_obj.iter_lines(decode_unicode=True):
-            if line:  # Filter out empty lines (e.g., keep-alive newlines)
-                try:
-                    json_chunk = json.loads(line)
-                    if isinstance(json_chunk, dict) and json_chunk.get("type") == "text":
-                        content_piece = json_chunk.get("content", "")
-                        if content_piece:  # Only process if content is not empty
-                            accumulated_response_text += content_piece
-                            yield content_piece  # Yield content_piece for streaming
-                except json.JSONDecodeError:
-                    print(f"Warning: Could not decode JSON from line: '{line}'")
-
-        return accumulated_response_text
-
-    except requests.exceptions.RequestException as e:
-        error_msg = f"Error: API request failed. {e}"
-        print(error_msg)
-        yield error_msg 
-    finally:
-        if response_obj:
-            response_obj.close()
-        if processed_image_bytes_io:
-            processed_image_bytes_io.close()
-
-
-# Specialist Agent Definitions
-def gynecologist_agent(state: Dict[str, Any]) -> Dict[str, Any]:
-    report = state["report"]
-    images = state.get("images")
-    prompt = """As a gynecologist, provide a detailed analysis of this case:
-
-Medical Information:
-{report}
-
-Please provide your assessment in the following structured format:
-
-1. RELEVANT GYNECOLOGICAL FINDINGS:
-- List key symptoms and findings related to reproductive health
-- Note any menstrual, hormonal, or reproductive system concerns
-
-2. DIFFERENTIAL DIAGNOSIS:
-- List possible gynecological conditions in order of likelihood
-
-3. RECOMMENDED TESTS:
-- Specify any required gynecological examinations or tests
-
-4. TREATMENT RECOMMENDATIONS:
-- Provide specific treatment options and recommendations
-- Include any lifestyle modifications if applicable
-
-5. FOLLOW-UP PLAN:
-- Recommend follow-up timeline and monitoring requirements
-
-Please be specific, concise, and focus only on gynecological aspects."""
-
-   
-    full_response = "### Gynaecologist's Assessment\n\n"
-    response_placeholder = st.empty()    
-
-    response_generator = generate_response(prompt.format(report=report), images)
-  
-    for chunk in response_generator:
-        full_response += chunk
-        response_placeholder.markdown(full_response)
-    response_placeholder.empty()
-    state["agent_results"].append({"specialist": "Gynecologist", "analysis": full_response})
-    return state
-
-def neurosurgeon_agent(state: Dict[str, Any]) -> Dict[str, Any]:
-    report = state["report"]
-    images = state.get("images")
-    prompt = """As a neurosurgeon, provide a detailed analysis of this case:
-Medical Information:
-{report}
-Please provide your assessment in the following structured format:
-1. NEUROLOGICAL SURGICAL FINDINGS:
-- List key neurological symptoms requiring surgical intervention
-- Note any structural abnormalities or lesions
-- Evaluate severity and surgical urgency
-2. DIFFERENTIAL DIAGNOSIS:
-- List possible neurosurgical conditions in order of likelihood
-- Identify conditions requiring immediate surgical intervention
-3. RECOMMENDED TESTS:
-- Specify required imaging studies (MRI, CT, angiogram)
-- List necessary pre-operative assessments
-4. TREATMENT RECOMMENDATIONS:
-- Detail surgical approach and technique
-- Outline risks and benefits of surgical intervention
-- Include alternative treatment options if applicable
-5. FOLLOW-UP PLAN:
-- Specify post-operative care requirements
-- Define rehabilitation protocol
-- Set timeline for follow-up visits
-Please be specific, concise, and focus only on neurosurgical aspects."""
-    
-    full_response = "### Neurosurgeon's Assessment\n\n"
-
-    response_placeholder = st.empty()    
-
-    response_generator = generate_response(prompt.format(report=report), images)
-    
-    for chunk in response_generator:
-        full_response += chunk
-        response_placeholder.markdown(full_response)
-    response_placeholder.empty()
-
-    state["agent_results"].append({"specialist": "Neurosurgeon", "analysis": full_response})
-    return state
-
-def radiation_oncologist_agent(state: Dict[str, Any]) -> Dict[str, Any]:
-    report = state["report"]
-    images = state.get("images")
-    prompt = """As a radiation oncologist, provide a detailed analysis of this case:
-Medical Information:
-{report}
-Please provide your assessment in the following structured format:
-1. ONCOLOGICAL FINDINGS:
-- Evaluate tumor characteristics and staging
-- Assess radiation therapy candidacy
-- Note any previous radiation exposure
-2. DIFFERENTIAL DIAGNOSIS:
-- List possible radiotherapy-responsive conditions
-- Evaluate tumor radio-sensitivity
-3. RECOMMENDED TESTS:
-- Specify required imaging for treatment planning
-- Detail necessary radiation dose calculations
-- List required pre-treatment assessments
-4. TREATMENT RECOMMENDATIONS:
-- Define radiation therapy protocol
-- Specify dose fractionation schedule
-- Detail radiation delivery technique
-- Include supportive care measures
-5. FOLLOW-UP PLAN:
-- Set radiation therapy monitoring schedule
-- Define post-treatment imaging timeline
-- Specify long-term monitoring requirements
-Please be specific, concise, and focus only on radiation oncology aspects."""
-    
-    full_response = "### Radiation Oncologist's Assessment\n\n"
-    response_placeholder = st.empty()    
-
-    response_generator = generate_response(prompt.format(report=report), images)
-    
-    for chunk in response_generator:
-        full_response += chunk
-        response_placeholder.markdown(full_response)
-    response_placeholder.empty()
-    state["agent_results"].append({"specialist": "Radiation Oncologist", "analysis": full_response})
-    return state
-
-def psychiatrist_agent(state: Dict[str, Any]) -> Dict[str, Any]:
-    report = state["report"]
-    images = state.get("images")
-    prompt = """As a psychiatrist, provide a detailed analysis of this case:
-Medical Information:
-{report}
-Please provide your assessment in the following structured format:
-1. PSYCHIATRIC FINDINGS:
-- List key mental health symptoms and behaviors
-- Note mood, affect, and cognitive function
-- Assess risk factors and safety concerns
-2. DIFFERENTIAL DIAGNOSIS:
-- List possible psychiatric conditions in order of likelihood
-- Consider comorbid conditions
-3. RECOMMENDED TESTS:
-- Specify required psychological assessments
-- List necessary screening tools
-- Detail required laboratory tests if applicable
-4. TREATMENT RECOMMENDATIONS:
-- Outline psychopharmacological interventions
-- Detail psychotherapy recommendations
-- Include lifestyle and support system modifications
-5. FOLLOW-UP PLAN:
-- Set therapy session frequency
-- Define medication monitoring schedule
-- Specify crisis intervention protocol
-Please be specific, concise, and focus only on psychiatric aspects."""
-    
-    full_response = "### Psychiatrist's Assessment\n\n"
-    response_placeholder = st.empty()    
-
-    response_generator = generate_response(prompt.format(report=report), images)
-    
-    for chunk in response_generator:
-        full_response += chunk
-        response_placeholder.markdown(full_response)
-    response_placeholder.empty()
-    state["agent_results"].append({"specialist": "Psychiatrist", "analysis": full_response})
-    return state
-
-def interventional_cardiologist_agent(state: Dict[str, Any]) -> Dict[str, Any]:
-    report = state["report"]
-    images = state.get("images")
-    prompt = """As an interventional cardiologist, provide a detailed analysis of this case:
-Medical Information:
-{report}
-Please provide your assessment in the following structured format:
-1. CARDIOVASCULAR FINDINGS:
-- List key cardiac symptoms requiring intervention
-- Note coronary anatomy and lesion characteristics
-- Evaluate hemodynamic status
-2. DIFFERENTIAL DIAGNOSIS:
-- List possible conditions requiring cardiac intervention
-- Assess urgency of intervention
-3. RECOMMENDED TESTS:
-- Specify required cardiac catheterization studies
-- Detail necessary pre-procedure imaging
-- List required pre-intervention assessments
-4. TREATMENT RECOMMENDATIONS:
-- Detail interventional approach (PCI, structural intervention)
-- Specify device and technique selection
-- Include antiplatelet/anticoagulation strategy
-- Note post-procedure care requirements
-5. FOLLOW-UP PLAN:
-- Define dual antiplatelet therapy duration
-- Set follow-up angiogram timeline if needed
-- Specify cardiac rehabilitation protocol
-Please be specific, concise, and focus only on interventional cardiology aspects."""
-    
-    full_response = "### Interventional Cardiologist's Assessment\n\n"
-    response_placeholder = st.empty()    
-
-    response_generator = generate_response(prompt.format(report=report), images)
-    
-    for chunk in response_generator:
-        full_response += chunk
-        response_placeholder.markdown(full_response)
-    response_placeholder.empty()
-    state["agent_results"].append({"specialist": "Interventional Cardiologist", "analysis": full_response})
-    return state
-
-def radiologist_agent(state: Dict[str, Any]) -> Dict[str, Any]:
-    report = state["report"]
-    images = state.get("images")
-    prompt = """As a radiologist, provide a detailed analysis of this case:
-
-Medical Information:
-{report}
-
-Please structure your response as follows:
-
-1. IMAGING FINDINGS (if images provided):
-- Detailed description of any visible abnormalities
-- Image quality and technical adequacy
-- Comparison with any prior studies mentioned
-
-2. INTERPRETATION:
-- Systematic analysis of findings
-- Anatomical structures involved
-- Any concerning features or patterns
-
-3. CLINICAL CORRELATION:
-- How findings relate to patient's symptoms
-- Potential clinical implications
-
-4. RECOMMENDATIONS:
-- Additional imaging studies if needed
-- Optimal imaging protocols
-- Follow-up imaging timeline
-
-5. CONCLUSION:
-- Clear, actionable summary of findings
-- Key concerns and their clinical significance
-
-Focus on imaging aspects and maintain radiological perspective throughout."""
-
-   
-    full_response = "### Radiologist's Assessment\n\n"
-    response_placeholder = st.empty()    
-
-    response_generator = generate_response(prompt.format(report=report), images)
-    
-    for chunk in response_generator:
-        full_response += chunk
-        response_placeholder.markdown(full_response)
-    response_placeholder.empty()
-    state["agent_results"].append({"specialist": "Radiologist", "analysis": full_response})
-    return state
-
-def oncologist_agent(state: Dict[str, Any]) -> Dict[str, Any]:
-    report = state["report"]
-    images = state.get("images")
-    prompt = """As an oncologist, provide a comprehensive cancer risk assessment:
-
-Medical Information:
-{report}
-
-Structure your analysis as follows:
-
-1. CANCER RISK ASSESSMENT:
-- Evaluation of concerning symptoms/findings
-- Risk factors identified
-- Family history implications (if mentioned)
-
-2. SUSPICIOUS FINDINGS:
-- Analysis of any masses, lesions, or concerning symptoms
-- Correlation with imaging (if available)
-- Tumor markers or relevant lab values
-
-3. DIFFERENTIAL DIAGNOSIS:
-- Potential malignant conditions
-- Benign alternatives to consider
-- Risk stratification
-
-4. RECOMMENDED WORKUP:
-- Specific tests needed for diagnosis
-- Biopsy recommendations if applicable
-- Staging workup if needed
-
-5. NEXT STEPS:
-- Clear action plan
-- Timeline for interventions
-- Monitoring recommendations
-
-Be precise and evidence-based in your assessment."""
-
-    
-    full_response = "### Oncologist's Assessment\n\n"
-    response_placeholder = st.empty()    
-
-    response_generator = generate_response(prompt.format(report=report), images)
-    
-    for chunk in response_generator:
-        full_response += chunk
-        response_placeholder.markdown(full_response)
-    response_placeholder.empty()
-    state["agent_results"].append({"specialist": "Oncologist", "analysis": full_response})
-    return state
-
-def pain_management_agent(state: Dict[str, Any]) -> Dict[str, Any]:
-    report = state["report"]
-    images = state.get("images")
-    prompt = """As a pain management specialist, analyze this case:
-
-Medical Information:
-{report}
-
-Provide your assessment in this format:
-
-1. PAIN EVALUATION:
-- Pain characteristics (location, intensity, quality)
-- Temporal patterns
-- Aggravating/alleviating factors
-- Impact on daily activities
-
-2. UNDERLYING CAUSES:
-- Primary pain generators
-- Contributing factors
-- Comorbid conditions affecting pain
-
-3. TREATMENT PLAN:
-- Immediate pain management strategies
-- Long-term pain control options
-- Non-pharmacological interventions
-- Medication recommendations if needed
+# `python AgentDx-v1.py batch|serve ...` runs consultations without Streamlit: on that path nothing
+# imports or calls st.*, process-wide resources use a plain cache and agent streams are not rendered
+HEADLESS_COMMANDS = ("batch", "serve")
+HEADLESS = sys.argv[1:2] != [] and sys.argv[1] in HEADLESS_COMMANDS
+
+if HEADLESS:
+    st = None
+
+    def cache_resource(func=None, *, max_entries=None):
+        """
+        Process-wide cache standing in for st.cache_resource in headless runs.
+        """
+        if func is None:
+            return functools.partial(cache_resource, max_entries=max_entries)
+        return functools.lru_cache(maxsize=max_entries)(func)
+
+    def fragment(func=None, *, run_every=None):
+        return func if func is not None else (lambda func: func)
+else:
+    import streamlit as st
+    from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+    cache_resource, fragment = st.cache_resource, st.fragment
 
-4. MONITORING PLAN:
-- Pain assessment tools
-- Follow-up schedule
-- Red flags to watch for
-
-5. LIFESTYLE MODIFICATIONS:
-- Activity modifications
-- Ergonomic recommendations
-- Self-management strategies
-
-Focus on comprehensive pain management approach."""
-
-    
-    full_response = "### Pain Specialist's Assessment\n\n"
-    response_placeholder = st.empty()    
-
-    response_generator = generate_response(prompt.format(report=report), images)
-  
-    for chunk in response_generator:
-        full_response += chunk
-        response_placeholder.markdown(full_response)
-    response_placeholder.empty()
-    state["agent_results"].append({"specialist": "Pain Management", "analysis": full_response})
-    return state
-
-def gastroenterologist_agent(state: Dict[str, Any]) -> Dict[str, Any]:
-    report = state["report"]
-    images = state.get("images")
-    prompt = """As a gastroenterologist, provide a detailed analysis:
-
-Medical Information:
-{report}
-
-Structure your response as follows:
-
-1. GI SYMPTOMS ANALYSIS:
-- Primary digestive complaints
-- Associated symptoms
-- Pattern and progression
-
-2. DIFFERENTIAL DIAGNOSIS:
-- Potential GI conditions
-- Alarm symptoms identified
-- Risk stratification
-
-3. DIAGNOSTIC PLAN:
-- Recommended GI workup
-- Specific tests needed
-- Endoscopic evaluation if needed
-
-4. TREATMENT RECOMMENDATIONS:
-- Immediate interventions
-- Long-term management plan
-- Dietary modifications
-- Lifestyle changes
-
-5. FOLLOW-UP PLAN:
-- Monitoring schedule
-- Warning signs to watch
-- Criteria for urgent evaluation
-
-Focus on digestive system aspects and related complications."""
-
-    
-    full_response = "### Gastroenterologist's Assessment\n\n"
-    response_placeholder = st.empty()    
+conversation_id = str(uuid.uuid4())
 
-    response_generator = generate_response(prompt.format(report=report), images)
-  
-    for chunk in response_generator:
-        full_response += chunk
-        response_placeholder.markdown(full_response)
-    response_placeholder.empty()
-    state["agent_results"].append({"specialist": "Gastroenterologist", "analysis": full_response})
-    return state
+# Dispatch every required specialist in the same graph step instead of one after another.
+PARALLEL_SPECIALISTS = os.environ.get("AGENTDX_PARALLEL_SPECIALISTS", "1") == "1"
 
-def rheumatologist_agent(state: Dict[str, Any]) -> Dict[str, Any]:
-    report = state["report"]
-    images = state.get("images")
-    prompt = """As a rheumatologist, analyze this case:
+# Upstream conversation of the consultation being run; set per graph node from the state
+_conversation_id: contextvars.ContextVar = contextvars.ContextVar("agentdx_conversation_id", default=None)
 
-Medical Information:
-{report}
+def current_conversation_id() -> str:
+    return _conversation_id.get() or conversation_id
 
-Provide analysis in this format:
+# Output sink of the consultation being run; set per graph node from the run config
+_output_sink: contextvars.ContextVar = contextvars.ContextVar("agentdx_output_sink", default=None)
 
-1. RHEUMATOLOGICAL ASSESSMENT:
-- Joint/muscle symptoms
-- Pattern of involvement
-- Morning stiffness
-- Associated symptoms
+API_URL = os.environ.get("AGENTDX_API_URL", "YOUR_API_URL")
+AUTH_TOKEN = os.environ.get("AGENTDX_AUTH_TOKEN", "YOUR_AUTH_TOKEN")
 
-2. DIFFERENTIAL DIAGNOSIS:
-- Potential rheumatic conditions
-- Inflammatory vs non-inflammatory
-- Systemic involvement
+# Upstream connection pool shared by all agent calls and all Streamlit sessions
+HTTP_POOL_SIZE = int(os.environ.get("AGENTDX_HTTP_POOL_SIZE", "32"))
+HTTP_PREWARM_CONNECTIONS = int(os.environ.get("AGENTDX_HTTP_PREWARM", "0"))
 
-3. DIAGNOSTIC WORKUP:
-- Recommended blood tests
-- Imaging studies needed
-- Other specialized tests
+@cache_resource
+def get_http_session(pool_size: int = HTTP_POOL_SIZE,
+                     prewarm_connections: int = HTTP_PREWARM_CONNECTIONS) -> requests.Session:
+    """
+    Returns the process-wide keep-alive session used for upstream API calls.
+    Cached as a Streamlit resource (a plain process cache when headless) so it survives script reruns and is shared across sessions.
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers.update({"Connection": "keep-alive"})
 
-4. TREATMENT PLAN:
-- Anti-inflammatory measures
-- Disease-modifying therapy if needed
-- Joint protection strategies
-- Physical therapy needs
+    if prewarm_connections:
+        prewarm_http_session(session, prewarm_connections)
+    return session
 
-5. MONITORING PLAN:
-- Disease activity monitoring
-- Complication surveillance
-- Follow-up schedule
+def prewarm_http_session(session: requests.Session, connections: int) -> None:
+    """
+    Opens `connections` pooled connections to the API host ahead of the first consultation.
+    """
+    def _open_connection():
+        try:
+            session.head(API_URL, timeout=10).close()
+        except requests.exceptions.RequestException as e:
+            print(f"Warning: Could not prewarm connection to API. {e}")
+
+    threads = [threading.Thread(target=_open_connection, daemon=True) for _ in range(connections)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+# Encoded image payloads kept in memory, shared by every agent call of every consultation
+IMAGE_CACHE_MAX_BYTES = int(os.environ.get("AGENTDX_IMAGE_CACHE_MB", "256")) * 1024 * 1024
+
+# Upload preprocessing: longest side kept, and the encodings the upstream API accepts
+MAX_IMAGE_SIDE = int(os.environ.get("AGENTDX_MAX_IMAGE_SIDE", "2048"))
+IMAGE_UPLOAD_FORMATS = tuple(fmt.strip().upper() for fmt in
+                             os.environ.get("AGENTDX_IMAGE_FORMATS", "png,webp,jpeg").split(",") if fmt.strip())
+JPEG_QUALITY = int(os.environ.get("AGENTDX_JPEG_QUALITY", "90"))
+# Largest per-pixel channel spread still treated as grey (X-rays saved as RGB)
+MONOCHROME_TOLERANCE = 8
+
+IMAGE_FORMAT_FILES = {
+    "PNG": ("image.png", "image/png"),
+    "WEBP": ("image.webp", "image/webp"),
+    "JPEG": ("image.jpg", "image/jpeg"),
+}
+
+def _has_alpha(image: Image.Image) -> bool:
+    return image.mode in ("RGBA", "LA", "PA") or "transparency" in image.info
+
+def is_effectively_monochrome(image: Image.Image) -> bool:
+    """
+    True when the colour channels of an image are (nearly) identical.
+    """
+    sample = image.convert("RGB")
+    sample.thumbnail((256, 256))
+    red, green, blue = sample.split()
+    return all(ImageChops.difference(a, b).getextrema()[1] <= MONOCHROME_TOLERANCE
+               for a, b in ((red, green), (green, blue)))
 
-Focus on musculoskeletal and autoimmune aspects."""
+def preprocess_image(image: Image.Image) -> Image.Image:
+    """
+    Prepares an uploaded image for the agents: applies EXIF orientation, caps the
+    longest side at MAX_IMAGE_SIDE and drops colour from effectively monochrome images.
+    """
+    image = ImageOps.exif_transpose(image)
+    if max(image.size) > MAX_IMAGE_SIDE:
+        image = image.copy()
+        image.thumbnail((MAX_IMAGE_SIDE, MAX_IMAGE_SIDE), Image.LANCZOS)
+    if image.mode in ("RGB", "RGBA", "P", "CMYK") and is_effectively_monochrome(image):
+        image = image.convert("LA" if _has_alpha(image) else "L")
+    return image
+
+def encode_image_payload(image: Image.Image) -> tuple:
+    """
+    Encodes an image in each allowed upload format and returns the smallest
+    as a (filename, bytes, mime type) multipart payload.
+    """
+    candidates = []
+    for fmt in IMAGE_UPLOAD_FORMATS:
+        source = image
+        if fmt == "JPEG" and image.mode not in ("L", "RGB"):
+            if _has_alpha(image):
+                continue  # JPEG cannot carry transparency
+            source = image.convert("RGB")
+        try:
+            with io.BytesIO() as buffer:
+                if fmt == "JPEG":
+                    source.save(buffer, format="JPEG", quality=JPEG_QUALITY, optimize=True)
+                elif fmt == "WEBP":
+                    source.save(buffer, format="WEBP", lossless=True)
+                else:
+                    source.save(buffer, format=fmt)
+                data = buffer.getvalue()
+        except (KeyError, OSError, ValueError) as e:
+            print(f"Warning: Could not encode image as {fmt}: {e}")
+            continue
+        filename, mime_type = IMAGE_FORMAT_FILES.get(fmt, (f"image.{fmt.lower()}", f"image/{fmt.lower()}"))
+        candidates.append((filename, data, mime_type))
+
+    if not candidates:
+        with io.BytesIO() as buffer:
+            image.save(buffer, format="PNG")
+            candidates.append(("image.png", buffer.getvalue(), "image/png"))
+    return min(candidates, key=lambda payload: len(payload[1]))
+
+def image_content_hash(image: Image.Image) -> str:
+    """
+    Hashes the decoded pixels of an image, so identical uploads share a key across reruns.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(f"{image.mode}:{image.size}".encode())
+    digest.update(image.tobytes())
+    return digest.hexdigest()
 
-   
-    full_response = "### Rheumatologist's Assessment\n\n"
-    response_placeholder = st.empty()    
+class ImagePayloadCache:
+    """
+    Bounded LRU of encoded upload payloads keyed by image content hash.
+    Each image is encoded once and the same bytes are handed to every agent call.
+    """
+    def __init__(self, max_bytes: int = IMAGE_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._payloads: "OrderedDict[str, tuple]" = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self._key_locks: Dict[str, threading.Lock] = {}
+        self._thumbnails: "OrderedDict[str, Image.Image]" = OrderedDict()
+        # Digests of live image objects (by id, PIL images are unhashable), so agents
+        # sharing one consultation's image do not rehash it
+        self._digests: Dict[int, str] = {}
+
+    def digest(self, image: Image.Image) -> str:
+        with self._lock:
+            digest = self._digests.get(id(image))
+        if digest is None:
+            digest = image_content_hash(image)
+            with self._lock:
+                if id(image) not in self._digests:
+                    self._digests[id(image)] = digest
+                    weakref.finalize(image, self._forget_digest, id(image))
+        return digest
+
+    def _forget_digest(self, image_id: int) -> None:
+        with self._lock:
+            self._digests.pop(image_id, None)
+
+    def get(self, image: Image.Image) -> tuple:
+        """
+        Returns the (filename, bytes, mime type) multipart payload for an image.
+        """
+        digest = self.digest(image)
+        with self._lock:
+            payload = self._lookup(digest)
+            if payload is not None:
+                return payload
+            key_lock = self._key_locks.setdefault(digest, threading.Lock())
+
+        # Encode outside the cache lock; callers racing on the same image wait for one encode
+        with key_lock:
+            with self._lock:
+                payload = self._lookup(digest)
+            if payload is None:
+                payload = encode_image_payload(image)
+                with self._lock:
+                    self._store(digest, payload)
+
+        with self._lock:
+            self._key_locks.pop(digest, None)
+        return payload
+
+    def _lookup(self, digest: str):
+        payload = self._payloads.get(digest)
+        if payload is not None:
+            self._payloads.move_to_end(digest)
+        return payload
+
+    def _store(self, digest: str, payload: tuple) -> None:
+        self._payloads[digest] = payload
+        self._size += len(payload[1])
+        while self._size > self.max_bytes and len(self._payloads) > 1:
+            _, evicted = self._payloads.popitem(last=False)
+            self._size -= len(evicted[1])
+
+    def downscaled(self, image: Image.Image, max_side: int) -> Image.Image:
+        """
+        Returns a copy of the image whose longest side is at most `max_side`, built once per content hash.
+        """
+        if max(image.size) <= max_side:
+            return image
+        key = f"{self.digest(image)}:{max_side}"
+        with self._lock:
+            thumbnail = self._thumbnails.get(key)
+            if thumbnail is not None:
+                self._thumbnails.move_to_end(key)
+                return thumbnail
+
+        thumbnail = image.copy()
+        thumbnail.thumbnail((max_side, max_side), Image.LANCZOS)
+        with self._lock:
+            thumbnail = self._thumbnails.setdefault(key, thumbnail)
+            while len(self._thumbnails) > 32:
+                self._thumbnails.popitem(last=False)
+        return thumbnail
+
+@cache_resource
+def get_image_payload_cache() -> ImagePayloadCache:
+    return ImagePayloadCache()
+
+# Image attachment policy per graph node: "full", "downscaled" or "none".
+# Agents whose prompts reason only over text do not need the upload at all.
+# Specialists declare theirs in SPECIALIST_REGISTRY.
+IMAGE_POLICIES = ("full", "downscaled", "none")
+DEFAULT_IMAGE_POLICY = "downscaled"
+IMAGE_ATTACHMENT_POLICY = {
+    "gp": "full",
+    "summarizer": "none",
+}
+DOWNSCALED_IMAGE_MAX_SIDE = int(os.environ.get("AGENTDX_DOWNSCALED_IMAGE_MAX_SIDE", "1024"))
+
+def _load_image_policy_overrides(spec: str) -> Dict[str, str]:
+    """
+    Parses overrides of the form "dentist=full,summarizer=downscaled".
+    """
+    overrides = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        node, _, policy = item.partition("=")
+        node, policy = node.strip(), policy.strip().lower()
+        if policy not in IMAGE_POLICIES:
+            print(f"Warning: Ignoring image policy '{item}', expected one of {IMAGE_POLICIES}")
+            continue
+        overrides[node] = policy
+    return overrides
+
+IMAGE_POLICY_OVERRIDES = _load_image_policy_overrides(os.environ.get("AGENTDX_IMAGE_POLICY", ""))
+
+def image_policy_for(node: str) -> str:
+    if node in IMAGE_POLICY_OVERRIDES:
+        return IMAGE_POLICY_OVERRIDES[node]
+    if node in SPECIALIST_REGISTRY:
+        return SPECIALIST_REGISTRY[node].get("image_policy", DEFAULT_IMAGE_POLICY)
+    return IMAGE_ATTACHMENT_POLICY.get(node, DEFAULT_IMAGE_POLICY)
+
+def apply_image_policy(node: str, images):
+    """
+    Returns the images a graph node should upload under its attachment policy.
+    images may be the image references kept in the graph state.
+    """
+    policy = image_policy_for(node)
+    if not images or policy == "none":
+        return None
+    images = resolve_images(images)
+    if policy == "full":
+        return images
+    cache = get_image_payload_cache()
+    return [cache.downscaled(image, DOWNSCALED_IMAGE_MAX_SIDE) if isinstance(image, Image.Image) else image
+            for image in images]
+
+def _encode_image_files(images):
+    """
+    Builds the multipart `files` field for the first uploaded image.
+    Returns (files, error_msg); error_msg is set when the image cannot be encoded.
+    """
+    files = {}
+    if images:  # images is expected to be a List[Image.Image]
+        try:
+            # Process the first image in the list if the list is not empty
+            image_to_process = images[0]
 
-    response_generator = generate_response(prompt.format(report=report), images)
-    
-    for chunk in response_generator:
-        full_response += chunk
-        response_placeholder.markdown(full_response)
-    response_placeholder.empty()
-    state["agent_results"].append({"specialist": "Rheumatologist", "analysis": full_response})
-    return state
+            if not isinstance(image_to_process, Image.Image):
+                return files, f"Error: Expected a PIL Image, but got {type(image_to_process)}"
 
-def psychologist_agent(state: Dict[str, Any]) -> Dict[str, Any]:
-    report = state["report"]
-    images = state.get("images")
-    prompt = """As a psychologist, provide a mental health assessment:
+            files["file"] = get_image_payload_cache().get(image_to_process)
 
-Medical Information:
-{report}
+        except IndexError: # images list was empty
+            print("Error: Image list was empty or image could not be accessed.")
 
-Structure your analysis as follows:
+        except Exception as e:
+            return {}, f"Error processing image: {e}"
 
-1. PSYCHOLOGICAL ASSESSMENT:
-- Mental status observations
-- Mood and affect
-- Behavioral patterns
-- Impact on daily functioning
+    return files, None
 
-2. DIAGNOSTIC CONSIDERATIONS:
-- Potential psychological conditions
-- Stress factors identified
-- Coping mechanisms observed
+def _parse_stream_line(line):
+    """
+    Returns the text content of one NDJSON stream line, or None for non-text lines.
+    """
+    if not line:  # Filter out empty lines (e.g., keep-alive newlines)
+        return None
+    try:
+        json_chunk = json.loads(line)
+        if isinstance(json_chunk, dict) and json_chunk.get("type") == "text":
+            return json_chunk.get("content", "") or None
+    except json.JSONDecodeError:
+        print(f"Warning: Could not decode JSON from line: '{line}'")
+    return None
+
+# Response cache: identical prompt + image + endpoint replays the previous answer
+RESPONSE_CACHE_ENABLED = os.environ.get("AGENTDX_RESPONSE_CACHE", "1") == "1"
+RESPONSE_CACHE_SIZE = int(os.environ.get("AGENTDX_RESPONSE_CACHE_SIZE", "256"))
+RESPONSE_CACHE_TTL = float(os.environ.get("AGENTDX_RESPONSE_CACHE_TTL", str(24 * 3600)))
+RESPONSE_CACHE_DB = os.environ.get("AGENTDX_RESPONSE_CACHE_DB", "agentdx_responses.sqlite3")
+MODEL_ID = os.environ.get("AGENTDX_MODEL_ID", "")
+REPLAY_CHUNK_SIZE = 64
+
+class ResponseCache:
+    """
+    Two-tier cache of complete agent responses: an in-memory LRU with TTL in front
+    of an optional SQLite table that survives restarts.
+    """
+    def __init__(self, max_entries: int = RESPONSE_CACHE_SIZE, ttl: float = RESPONSE_CACHE_TTL,
+                 db_path: Optional[str] = RESPONSE_CACHE_DB):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        if db_path:
+            try:
+                self._db = sqlite3.connect(db_path, check_same_thread=False)
+                self._db.execute("PRAGMA journal_mode=WAL")
+                self._db.execute("CREATE TABLE IF NOT EXISTS responses "
+                                 "(key TEXT PRIMARY KEY, response TEXT NOT NULL, created REAL NOT NULL)")
+                self._db.commit()
+            except sqlite3.Error as e:
+                print(f"Warning: Response cache database unavailable, using memory only. {e}")
+                self._db = None
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if now - entry[1] <= self.ttl:
+                    self._entries.move_to_end(key)
+                    return entry[0]
+                del self._entries[key]
+
+            if self._db is None:
+                return None
+            try:
+                row = self._db.execute("SELECT response, created FROM responses WHERE key = ?", (key,)).fetchone()
+            except sqlite3.Error as e:
+                print(f"Warning: Response cache lookup failed. {e}")
+                return None
+            if row is None or now - row[1] > self.ttl:
+                return None
+            self._remember(key, row[0], row[1])
+            return row[0]
+
+    def put(self, key: str, response: str) -> None:
+        now = time.time()
+        with self._lock:
+            self._remember(key, response, now)
+            if self._db is not None:
+                try:
+                    self._db.execute("INSERT OR REPLACE INTO responses (key, response, created) VALUES (?, ?, ?)",
+                                     (key, response, now))
+                    self._db.execute("DELETE FROM responses WHERE created < ?", (now - self.ttl,))
+                    self._db.commit()
+                except sqlite3.Error as e:
+                    print(f"Warning: Could not persist cached response. {e}")
+
+    def _remember(self, key: str, response: str, created: float) -> None:
+        self._entries[key] = (response, created)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+@cache_resource
+def get_response_cache() -> ResponseCache:
+    return ResponseCache()
+
+def response_cache_key(prompt: str, images=None, max_tokens: Optional[int] = None) -> str:
+    """
+    Identifies a request by endpoint, model, formatted prompt and uploaded image content.
+    """
+    image_digest = ""
+    if images and isinstance(images[0], Image.Image):
+        image_digest = get_image_payload_cache().digest(images[0])
+    digest = hashlib.sha256()
+    for part in (API_URL, MODEL_ID, prompt, image_digest, str(max_tokens or "")):
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+def _replay_chunks(response: str):
+    """
+    Splits a cached response into stream-sized pieces so callers render it like a live stream.
+    """
+    return [response[i:i + REPLAY_CHUNK_SIZE] for i in range(0, len(response), REPLAY_CHUNK_SIZE)]
+
+# Concurrent identical requests share one upstream stream
+COALESCE_REQUESTS = os.environ.get("AGENTDX_COALESCE_REQUESTS", "1") == "1"
+# Start referred specialists while the GP is still writing its referral justification
+SPECULATIVE_SPECIALISTS = os.environ.get("AGENTDX_SPECULATIVE_SPECIALISTS", "1") == "1"
+# Also start the radiologist as soon as the GP starts when an image is attached
+SPECULATE_RADIOLOGIST = os.environ.get("AGENTDX_SPECULATE_RADIOLOGIST", "1") == "1"
+# How long a launched specialist stream waits for its graph node to pick it up
+SPECULATIVE_RETAIN_SECONDS = float(os.environ.get("AGENTDX_SPECULATIVE_RETAIN", "600"))
+
+class _Flight:
+    """
+    One upstream stream and the chunks received from it so far.
+    """
+    def __init__(self):
+        self.chunks: List[str] = []
+        self.done = False
+        self._condition = threading.Condition()
+
+    def publish(self, chunk: str) -> None:
+        with self._condition:
+            self.chunks.append(chunk)
+            self._condition.notify_all()
+
+    def finish(self) -> None:
+        with self._condition:
+            self.done = True
+            self._condition.notify_all()
+
+    def subscribe(self):
+        """
+        Yields every chunk from the start of the stream: a replay of what has already
+        arrived, then new chunks as they come in.
+        """
+        index = 0
+        while True:
+            with self._condition:
+                while index >= len(self.chunks) and not self.done:
+                    self._condition.wait()
+                pending = self.chunks[index:]
+                index = len(self.chunks)
+                finished = self.done
+            yield from pending
+            if finished:
+                return
 
-3. RISK ASSESSMENT:
-- Safety concerns
-- Support system evaluation
-- Coping capacity
+class SingleFlight:
+    """
+    Coalesces concurrent requests with the same key onto a single upstream stream,
+    driven by a background thread so no subscriber can stall the others.
+    """
+    def __init__(self):
+        self._flights: Dict[str, _Flight] = {}
+        # Launched ahead of their first reader: key -> (expiry, flight)
+        self._retained: Dict[str, Any] = {}
+        self._lock = threading.Lock()
+
+    def stream(self, key: str, producer):
+        with self._lock:
+            self._purge_locked()
+            flight = self._claim_locked(key) or self._flights.get(key)
+            if flight is None:
+                flight = self._flights[key] = _Flight()
+                threading.Thread(target=self._run, args=(key, flight, producer), daemon=True).start()
+            else:
+                print(f"Joining in-flight request {key[:12]} ({len(flight.chunks)} chunks received)")
+        return flight.subscribe()
+
+    def launch(self, key: str, producer, retain_for: float) -> bool:
+        """
+        Starts a stream before anyone reads it. Its chunks are kept, even after it
+        finishes, until a stream() or claim() for the same key picks them up or
+        retain_for seconds pass. Returns False if the key is already running or kept.
+        """
+        with self._lock:
+            self._purge_locked()
+            if key in self._flights or key in self._retained:
+                return False
+            flight = self._flights[key] = _Flight()
+            self._retained[key] = (time.time() + retain_for, flight)
+            threading.Thread(target=self._run, args=(key, flight, producer), daemon=True).start()
+        return True
+
+    def claim(self, key: str) -> Optional[_Flight]:
+        with self._lock:
+            self._purge_locked()
+            return self._claim_locked(key)
+
+    def discard(self, key: str) -> None:
+        """
+        Drops a launched stream nobody will read, e.g. because its node was answered
+        from the response cache. A stream still running finishes in the background.
+        """
+        with self._lock:
+            self._retained.pop(key, None)
+
+    def _purge_locked(self) -> None:
+        now = time.time()
+        for expired in [k for k, (expiry, _) in self._retained.items() if expiry < now]:
+            del self._retained[expired]
+
+    def _claim_locked(self, key: str) -> Optional[_Flight]:
+        expiry, flight = self._retained.pop(key, (0, None))
+        if flight is not None and expiry >= time.time():
+            print(f"Picking up launched request {key[:12]} ({len(flight.chunks)} chunks received)")
+            return flight
+        return None
+
+    def in_flight(self) -> int:
+        with self._lock:
+            return len(self._flights)
+
+    def _run(self, key: str, flight: _Flight, producer) -> None:
+        try:
+            for chunk in producer():
+                flight.publish(chunk)
+        except Exception as e:
+            error_msg = f"Error: API request failed. {e}"
+            print(error_msg)
+            flight.publish(error_msg)
+        finally:
+            with self._lock:
+                self._flights.pop(key, None)
+            flight.finish()
 
-4. TREATMENT RECOMMENDATIONS:
-- Therapeutic interventions
-- Coping strategies
-- Lifestyle modifications
-- Support resources
+@cache_resource
+def get_single_flight() -> SingleFlight:
+    return SingleFlight()
 
-5. FOLLOW-UP PLAN:
-- Recommended frequency
-- Treatment goals
-- Progress monitoring
+class _AsyncFlight:
+    """
+    A stream launched on the event loop. Its chunks queue up until the one node
+    that claims it reads them.
+    """
+    def __init__(self):
+        self.queue: "asyncio.Queue[Optional[str]]" = asyncio.Queue()
 
-Focus on psychological aspects and their interaction with physical symptoms."""
+    async def subscribe(self):
+        while (chunk := await self.queue.get()) is not None:
+            yield chunk
 
-    
-    full_response = "### Psychologist's Assessment\n\n"
-    response_placeholder = st.empty()    
+class AsyncSingleFlight:
+    """
+    SingleFlight.launch/claim for the async graph: launched streams run as tasks on
+    the event loop and hand their chunks over through a queue instead of a thread.
+    Not thread-safe; use one per event loop (get_async_single_flight).
+    """
+    def __init__(self):
+        # Launched ahead of their first reader: key -> (expiry timer, flight)
+        self._retained: Dict[str, Any] = {}
+        # The loop only keeps weak references to tasks
+        self._tasks: Set[asyncio.Task] = set()
+
+    def launch(self, key: str, producer, retain_for: float) -> bool:
+        """
+        Starts producer() (an async generator) as a task. Its chunks are kept until
+        claim() picks them up, discard() drops them or retain_for seconds pass.
+        Returns False if the key is already kept.
+        """
+        if key in self._retained:
+            return False
+        loop = asyncio.get_running_loop()
+        flight = _AsyncFlight()
+        task = loop.create_task(self._run(flight, producer))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        self._retained[key] = (loop.call_later(retain_for, self.discard, key), flight)
+        return True
+
+    def claim(self, key: str) -> Optional[_AsyncFlight]:
+        timer, flight = self._retained.pop(key, (None, None))
+        if flight is None:
+            return None
+        timer.cancel()
+        print(f"Picking up launched request {key[:12]} ({flight.queue.qsize()} chunks received)")
+        return flight
+
+    def discard(self, key: str) -> None:
+        timer, _ = self._retained.pop(key, (None, None))
+        if timer is not None:
+            timer.cancel()
+
+    async def _run(self, flight: _AsyncFlight, producer) -> None:
+        try:
+            async for chunk in producer():
+                flight.queue.put_nowait(chunk)
+        except Exception as e:
+            error_msg = f"Error: API request failed. {e}"
+            print(error_msg)
+            flight.queue.put_nowait(error_msg)
+        finally:
+            flight.queue.put_nowait(None)
 
-    response_generator = generate_response(prompt.format(report=report), images)
-    
-    for chunk in response_generator:
-        full_response += chunk
-        response_placeholder.markdown(full_response)
-    response_placeholder.empty()
-    state["agent_results"].append({"specialist": "Psychologist", "analysis": full_response})
-    return state
+_async_single_flights: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
 
-def dentist_agent(state: Dict[str, Any]) -> Dict[str, Any]:
-    report = state["report"]
-    images = state.get("images")
-    prompt = """As a dentist, provide a comprehensive dental analysis:
+def get_async_single_flight() -> AsyncSingleFlight:
+    """
+    Returns the launched-stream registry of the running event loop.
+    """
+    loop = asyncio.get_running_loop()
+    registry = _async_single_flights.get(loop)
+    if registry is None:
+        registry = _async_single_flights[loop] = AsyncSingleFlight()
+    return registry
 
-Medical Information:
-{report}
+def prefix_cache_hints(prefix_chars: int) -> Dict[str, Any]:
+    """
+    Extra form fields telling the backend how much of the prompt is the shared prefix.
+    """
+    if not (PREFIX_CACHE_HINTS and prefix_chars):
+        return {}
+    return {"cache_prompt": "true", "cache_prefix_chars": prefix_chars}
+
+# Upstream limiter: every call to API_URL, sync or async, waits its turn here. A token
+# bucket caps requests and tokens per second, and the concurrency window follows AIMD:
+# +1 per window of successful calls, halved on 429/503 or a time-to-first-byte spike
+UPSTREAM_LIMITER = os.environ.get("AGENTDX_UPSTREAM_LIMITER", "1") == "1"
+UPSTREAM_CONCURRENCY = int(os.environ.get("AGENTDX_UPSTREAM_CONCURRENCY", "16"))
+UPSTREAM_MAX_CONCURRENCY = int(os.environ.get("AGENTDX_UPSTREAM_MAX_CONCURRENCY", str(HTTP_POOL_SIZE)))
+UPSTREAM_MIN_CONCURRENCY = int(os.environ.get("AGENTDX_UPSTREAM_MIN_CONCURRENCY", "1"))
+UPSTREAM_RPS = float(os.environ.get("AGENTDX_UPSTREAM_RPS", "0"))  # 0 = no request rate limit
+UPSTREAM_TPS = float(os.environ.get("AGENTDX_UPSTREAM_TPS", "0"))  # 0 = no token rate limit
+UPSTREAM_RETRIES = int(os.environ.get("AGENTDX_UPSTREAM_RETRIES", "3"))
+UPSTREAM_LATENCY_SPIKE = float(os.environ.get("AGENTDX_UPSTREAM_LATENCY_SPIKE", "3.0"))
+UPSTREAM_OVERLOAD_STATUSES = (429, 503)
+UPSTREAM_DEFAULT_BACKOFF = 1.0  # seconds, for an overload answer without Retry-After
+UPSTREAM_MAX_BACKOFF = 120.0
+UPSTREAM_DECREASE_COOLDOWN = 1.0  # one decrease per burst of overload answers
+UPSTREAM_LATENCY_FLOOR = 0.5  # seconds over the baseline before a slow first byte counts as a spike
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """
+    Seconds to wait from a Retry-After header (delay-seconds or HTTP date), capped.
+    """
+    if not value:
+        return None
+    try:
+        seconds = float(value)
+    except ValueError:
+        from email.utils import parsedate_to_datetime
+        try:
+            seconds = parsedate_to_datetime(value).timestamp() - time.time()
+        except (TypeError, ValueError):
+            return None
+    return min(max(seconds, 0.0), UPSTREAM_MAX_BACKOFF)
 
-Structure your assessment as follows:
+class TokenBucket:
+    """
+    Refills rate units per second up to burst. A cost above burst is admitted from a full bucket.
+    """
+    def __init__(self, rate: float, burst: Optional[float] = None):
+        self.rate = rate
+        self.burst = burst if burst is not None else max(rate, 1.0)
+        self.level = self.burst
+        self._updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.level = min(self.burst, self.level + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def delay(self, cost: float, now: float) -> float:
+        if not self.rate:
+            return 0.0
+        self._refill(now)
+        missing = min(cost, self.burst) - self.level
+        return missing / self.rate if missing > 0 else 0.0
+
+    def take(self, cost: float) -> None:
+        if self.rate:
+            self.level -= min(cost, self.burst)
+
+class _LimiterWaiter:
+    __slots__ = ("cost", "wake", "admitted", "queued_at")
+
+    def __init__(self, cost: float, wake):
+        self.cost = cost
+        self.wake = wake
+        self.admitted = False
+        self.queued_at = time.monotonic()
+
+class UpstreamSlot:
+    """
+    Permission for one upstream call. Report when headers arrive (first_byte) and
+    release it once with the outcome: "ok", "overload" (429/503) or "error".
+    Releasing without an outcome counts as "ok".
+    """
+    def __init__(self, limiter: "UpstreamLimiter"):
+        self.limiter = limiter
+        self.started = time.monotonic()
+        self.ttfb: Optional[float] = None
+        self.released = False
 
-1. DENTAL FINDINGS:
-- Oral symptoms and complaints
-- Dental pain characteristics
-- Oral hygiene status
-- Relevant medical history impact
+    def first_byte(self) -> None:
+        self.ttfb = time.monotonic() - self.started
 
-2. DIAGNOSTIC ASSESSMENT:
-- Potential dental conditions
-- Oral health impact
-- Complications risk
+    def release(self, outcome: str = "ok", retry_after: Optional[float] = None) -> None:
+        if not self.released:
+            self.released = True
+            self.limiter._release(self, outcome, retry_after)
 
-3. TREATMENT NEEDS:
-- Immediate interventions required
-- Preventive measures
-- Long-term dental care plan
+class UpstreamLimiter:
+    """
+    Process-wide gate in front of the upstream API. Callers queue in FIFO order and are
+    admitted while the adaptive concurrency window, the request and token buckets and
+    any Retry-After pause allow. Works for threads (acquire) and coroutines (aacquire).
+    """
+    def __init__(self, initial: int = UPSTREAM_CONCURRENCY, minimum: int = UPSTREAM_MIN_CONCURRENCY,
+                 maximum: int = UPSTREAM_MAX_CONCURRENCY, rps: float = UPSTREAM_RPS, tps: float = UPSTREAM_TPS,
+                 latency_spike: float = UPSTREAM_LATENCY_SPIKE):
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.limit = float(min(max(initial, self.minimum), self.maximum))
+        self.requests = TokenBucket(rps)
+        self.tokens = TokenBucket(tps)
+        self.latency_spike = latency_spike
+        self.in_flight = 0
+        self.blocked_until = 0.0
+        self.latency_baseline: Optional[float] = None
+        self.counters = {"admitted": 0, "overloads": 0, "latency_spikes": 0, "errors": 0, "decreases": 0}
+        self.queue_wait_total = 0.0
+        self._queue: "deque[_LimiterWaiter]" = deque()
+        self._last_decrease = 0.0
+        self._lock = threading.Lock()
+
+    def _admit_locked(self) -> Optional[float]:
+        """
+        Admits waiters from the head of the queue while everything allows. Returns the
+        seconds until the head can be admitted, or None when it waits for a release.
+        """
+        while self._queue:
+            if self.in_flight >= int(self.limit):
+                return None
+            head = self._queue[0]
+            now = time.monotonic()
+            delay = max(self.blocked_until - now, self.requests.delay(1, now), self.tokens.delay(head.cost, now))
+            if delay > 0:
+                return delay
+            self._queue.popleft()
+            self.requests.take(1)
+            self.tokens.take(head.cost)
+            self.in_flight += 1
+            self.counters["admitted"] += 1
+            self.queue_wait_total += now - head.queued_at
+            head.admitted = True
+            head.wake()
+        return None
+
+    def _enqueue(self, waiter: _LimiterWaiter) -> Optional[float]:
+        with self._lock:
+            self._queue.append(waiter)
+        return self._poll(waiter)
+
+    def _poll(self, waiter: _LimiterWaiter) -> Optional[float]:
+        with self._lock:
+            delay = self._admit_locked()
+            # When the caller is not the head (e.g. it was just admitted), the delay is the
+            # head's, which may be waiting for a release; have it re-check after the pause or refill
+            head = self._queue[0] if delay is not None and self._queue[0] is not waiter else None
+        if head is not None:
+            head.wake()
+        return delay
+
+    def _abandon(self, waiter: _LimiterWaiter) -> None:
+        # A caller that stops waiting gives up its place, or its slot if it was just admitted
+        with self._lock:
+            admitted = waiter.admitted
+            if not admitted:
+                self._queue.remove(waiter)
+        if admitted:
+            self._release(UpstreamSlot(self), "abandoned", None)
+        else:
+            self._poll(waiter)
 
-4. RECOMMENDATIONS:
-- Specific dental procedures
-- Oral hygiene instructions
-- Dietary recommendations
+    def acquire(self, cost: float = 0.0) -> UpstreamSlot:
+        event = threading.Event()
+        waiter = _LimiterWaiter(cost, event.set)
+        delay = self._enqueue(waiter)
+        try:
+            while not waiter.admitted:
+                event.wait(delay)
+                event.clear()
+                if not waiter.admitted:
+                    delay = self._poll(waiter)
+        except BaseException:
+            self._abandon(waiter)
+            raise
+        return UpstreamSlot(self)
+
+    async def aacquire(self, cost: float = 0.0) -> UpstreamSlot:
+        loop = asyncio.get_running_loop()
+        wakeup = asyncio.Event()
+        waiter = _LimiterWaiter(cost, lambda: loop.call_soon_threadsafe(wakeup.set))
+        delay = self._enqueue(waiter)
+        try:
+            while not waiter.admitted:
+                try:
+                    await asyncio.wait_for(wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                wakeup.clear()
+                if not waiter.admitted:
+                    delay = self._poll(waiter)
+        except BaseException:
+            self._abandon(waiter)
+            raise
+        return UpstreamSlot(self)
+
+    def _decrease_locked(self, now: float) -> None:
+        if now - self._last_decrease >= UPSTREAM_DECREASE_COOLDOWN:
+            self.limit = max(float(self.minimum), self.limit / 2)
+            self._last_decrease = now
+            self.counters["decreases"] += 1
+            print(f"Upstream concurrency limit lowered to {int(self.limit)}")
+
+    def _release(self, slot: UpstreamSlot, outcome: str, retry_after: Optional[float]) -> None:
+        now = time.monotonic()
+        with self._lock:
+            self.in_flight -= 1
+            if outcome == "overload":
+                self.counters["overloads"] += 1
+                self.blocked_until = max(self.blocked_until,
+                                         now + (retry_after if retry_after is not None else UPSTREAM_DEFAULT_BACKOFF))
+                self._decrease_locked(now)
+            elif outcome == "ok":
+                ttfb = slot.ttfb
+                if (ttfb is not None and self.latency_baseline is not None
+                        and ttfb > self.latency_spike * self.latency_baseline
+                        and ttfb - self.latency_baseline > UPSTREAM_LATENCY_FLOOR):
+                    self.counters["latency_spikes"] += 1
+                    self._decrease_locked(now)
+                else:
+                    self.limit = min(float(self.maximum), self.limit + 1 / self.limit)
+                if ttfb is not None:
+                    self.latency_baseline = ttfb if self.latency_baseline is None \
+                        else 0.9 * self.latency_baseline + 0.1 * ttfb
+            elif outcome == "error":
+                self.counters["errors"] += 1
+            delay = self._admit_locked()
+            head = self._queue[0] if delay is not None else None
+        if head is not None:
+            # The head may be waiting for a release; have it re-check after the pause or refill
+            head.wake()
+
+    def metrics(self) -> Dict[str, Any]:
+        with self._lock:
+            admitted = self.counters["admitted"]
+            return {
+                "concurrency_limit": int(self.limit),
+                "in_flight": self.in_flight,
+                "queue_depth": len(self._queue),
+                "requests_per_second": self.requests.rate or None,
+                "tokens_per_second": self.tokens.rate or None,
+                "paused_for_s": round(max(0.0, self.blocked_until - time.monotonic()), 2),
+                "latency_baseline_s": round(self.latency_baseline, 3) if self.latency_baseline is not None else None,
+                "avg_queue_wait_s": round(self.queue_wait_total / admitted, 3) if admitted else 0.0,
+                **self.counters,
+            }
+
+@cache_resource
+def get_upstream_limiter() -> UpstreamLimiter:
+    return UpstreamLimiter()
+
+def upstream_cost(prompt: str, max_tokens: Optional[int] = None) -> float:
+    """
+    Tokens a call is charged against the token bucket: the prompt estimate plus the response budget.
+    """
+    return estimate_tokens(prompt) + (max_tokens or 0)
 
-5. FOLLOW-UP PLAN:
-- Treatment timeline
-- Monitoring schedule
-- Emergency care criteria
+def generate_response(prompt, images=None, session: Optional[requests.Session] = None,
+                      max_tokens: Optional[int] = None, prefix_chars: int = 0, refresh: bool = False):
+    """
+    Streams the upstream response for a prompt. refresh=True always asks upstream
+    (the new answer still replaces the cached one).
+    """
+    session = session or get_http_session()
+
+    cache_key = None
+    if RESPONSE_CACHE_ENABLED or COALESCE_REQUESTS or SPECULATIVE_SPECIALISTS:
+        cache_key = response_cache_key(prompt, images, max_tokens)
+    if RESPONSE_CACHE_ENABLED and not refresh:
+        cached_response = get_response_cache().get(cache_key)
+        if cached_response is not None:
+            if SPECULATIVE_SPECIALISTS:
+                get_single_flight().discard(cache_key)
+            yield from _replay_chunks(cached_response)
+            return cached_response
+
+    # Captured here: the coalesced stream runs on a thread that does not see our context
+    conversation = current_conversation_id()
+    if refresh:
+        yield from _stream_upstream(prompt, images, session, cache_key, conversation, max_tokens, prefix_chars,
+                                    read_cache=False)
+        return
+    launched = get_single_flight().claim(cache_key) if SPECULATIVE_SPECIALISTS and not COALESCE_REQUESTS else None
+    if launched is not None:
+        yield from launched.subscribe()
+    elif COALESCE_REQUESTS:
+        yield from get_single_flight().stream(
+            cache_key, lambda: _stream_upstream(prompt, images, session, cache_key, conversation, max_tokens, prefix_chars))
+    else:
+        yield from _stream_upstream(prompt, images, session, cache_key, conversation, max_tokens, prefix_chars)
+
+def _stream_upstream(prompt, images, session: requests.Session, cache_key: Optional[str] = None,
+                     conversation: Optional[str] = None, max_tokens: Optional[int] = None,
+                     prefix_chars: int = 0, read_cache: bool = True):
+    api_url = API_URL
+    auth_token = AUTH_TOKEN
+
+    if RESPONSE_CACHE_ENABLED and cache_key and read_cache:
+        # A request that just finished may have filled the cache since the caller looked
+        cached_response = get_response_cache().get(cache_key)
+        if cached_response is not None:
+            yield from _replay_chunks(cached_response)
+            return cached_response
 
-Focus on oral health aspects and their systemic implications."""
+    headers = {"Authorization": f"Bearer {auth_token}"}
+    files, error_msg = _encode_image_files(images)
+    if error_msg:
+        print(error_msg)
+        yield error_msg
+        return
 
+    data = {"text": prompt, "conversation_id": conversation or conversation_id}
+    if max_tokens:
+        data["max_tokens"] = max_tokens
+    data.update(prefix_cache_hints(prefix_chars))
     
-    full_response = "### Dentist's Assessment\n\n"
-    response_placeholder = st.empty()    
+    response_obj = None
+    accumulated_response_text = ""
+    limiter = get_upstream_limiter() if UPSTREAM_LIMITER else None
+    slot = None
 
-    response_generator = generate_response(prompt.format(report=report), images)
-   
-    for chunk in response_generator:
-        full_response += chunk
-        response_placeholder.markdown(full_response)
+    try:
+        for attempt in range(UPSTREAM_RETRIES + 1):
+            slot = limiter.acquire(upstream_cost(prompt, max_tokens)) if limiter else None
+            response_obj = session.post(api_url, headers=headers, files=files, data=data, stream=True)
+            if slot is not None:
+                slot.first_byte()
+            if response_obj.status_code not in UPSTREAM_OVERLOAD_STATUSES or attempt == UPSTREAM_RETRIES:
+                break
+            # Overloaded before anything was streamed: wait as told and try again
+            retry_after = parse_retry_after(response_obj.headers.get("Retry-After"))
+            print(f"Warning: Upstream answered {response_obj.status_code}; retrying "
+                  f"(attempt {attempt + 2} of {UPSTREAM_RETRIES + 1})")
+            response_obj.close()
+            if slot is not None:
+                slot.release("overload", retry_after)
+            else:
+                time.sleep(retry_after if retry_after is not None else UPSTREAM_DEFAULT_BACKOFF)
+        response_obj.raise_for_status()  # Raise HTTPError for bad responses (4xx or 5xx)
 
-    response_placeholder.empty()
-    state["agent_results"].append({"specialist": "Dentist", "analysis": full_response})
-    return state
+        for line in response_obj.iter_lines(decode_unicode=True):
+            content_piece = _parse_stream_line(line)
+            if content_piece:  # Only process if content is not empty
+                accumulated_response_text += content_piece
+                yield content_piece  # Yield content_piece for streaming
 
+        if RESPONSE_CACHE_ENABLED and cache_key and accumulated_response_text:
+            get_response_cache().put(cache_key, accumulated_response_text)
+        return accumulated_response_text
 
-def orthopaedician_agent(state: Dict[str, Any]) -> Dict[str, Any]:
-    report = state["report"]
-    images = state.get("images")
-    prompt = """As an orthopedic specialist, provide a detailed assessment:
+    except requests.exceptions.RequestException as e:
+        if slot is not None:
+            overloaded = e.response is not None and e.response.status_code in UPSTREAM_OVERLOAD_STATUSES
+            slot.release("overload" if overloaded else "error",
+                         parse_retry_after(e.response.headers.get("Retry-After")) if overloaded else None)
+        error_msg = f"Error: API request failed. {e}"
+        print(error_msg)
+        yield error_msg 
+    finally:
+        if slot is not None:
+            slot.release()
+        if response_obj:
+            response_obj.close()
 
-Medical Information:
-{report}
+# Async HTTP clients, one per event loop since an httpx client is bound to the loop it was opened on
+_async_http_clients: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
 
-Structure your analysis as follows:
+def _import_httpx():
+    try:
+        import httpx
+    except ImportError as e:
+        raise ImportError("The async agent path requires httpx: pip install httpx") from e
+    return httpx
 
-1. MUSCULOSKELETAL ASSESSMENT:
-- Location and nature of complaints
-- Pain characteristics
-- Movement limitations
-- Associated symptoms
+def get_async_http_client():
+    """
+    Returns the keep-alive async client for the running event loop.
+    """
+    httpx = _import_httpx()
+    loop = asyncio.get_running_loop()
+    client = _async_http_clients.get(loop)
+    if client is None:
+        client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=HTTP_POOL_SIZE, max_keepalive_connections=HTTP_POOL_SIZE),
+            timeout=httpx.Timeout(None, connect=10.0),  # Streams can legitimately run for minutes
+        )
+        _async_http_clients[loop] = client
+    return client
 
-2. PHYSICAL FINDINGS:
-- Range of motion
-- Strength assessment
-- Neurological aspects
-- Gait analysis if relevant
+async def agenerate_response(prompt, images=None, client=None, max_tokens: Optional[int] = None,
+                             prefix_chars: int = 0):
+    """
+    Async counterpart of generate_response. Yields text chunks from the same NDJSON stream
+    without tying up a thread for the lifetime of the request.
+    """
+    client = client or get_async_http_client()
+
+    cache_key = None
+    if RESPONSE_CACHE_ENABLED or SPECULATIVE_SPECIALISTS:
+        cache_key = await asyncio.to_thread(response_cache_key, prompt, images, max_tokens) if images \
+            else response_cache_key(prompt, max_tokens=max_tokens)
+    if RESPONSE_CACHE_ENABLED:
+        cached_response = get_response_cache().get(cache_key)
+        if cached_response is not None:
+            if SPECULATIVE_SPECIALISTS:
+                get_async_single_flight().discard(cache_key)
+            for content_piece in _replay_chunks(cached_response):
+                yield content_piece
+            return
 
-3. DIFFERENTIAL DIAGNOSIS:
-- Potential orthopedic conditions
-- Injury patterns if applicable
-- Degenerative considerations
+    launched = get_async_single_flight().claim(cache_key) if SPECULATIVE_SPECIALISTS else None
+    stream = launched.subscribe() if launched is not None else \
+        _astream_upstream(prompt, images, client, cache_key, current_conversation_id(), max_tokens, prefix_chars)
+    async for content_piece in stream:
+        yield content_piece
+
+async def _astream_upstream(prompt, images, client, cache_key: Optional[str] = None,
+                            conversation: Optional[str] = None, max_tokens: Optional[int] = None,
+                            prefix_chars: int = 0):
+    httpx = _import_httpx()
+    headers = {"Authorization": f"Bearer {AUTH_TOKEN}"}
+    # Hashing and a first-time encode are CPU-bound; keep them off the event loop
+    files, error_msg = await asyncio.to_thread(_encode_image_files, images) if images else ({}, None)
+    if error_msg:
+        print(error_msg)
+        yield error_msg
+        return
 
-4. TREATMENT PLAN:
-- Immediate interventions
-- Physical therapy needs
-- Surgical considerations
-- Assistive devices if needed
+    data = {"text": prompt, "conversation_id": conversation or current_conversation_id()}
+    if max_tokens:
+        data["max_tokens"] = max_tokens
+    data.update(prefix_cache_hints(prefix_chars))
 
-5. REHABILITATION PLAN:
-- Exercise recommendations
-- Activity modifications
-- Recovery timeline
-- Return to activity goals
+    limiter = get_upstream_limiter() if UPSTREAM_LIMITER else None
+    for attempt in range(UPSTREAM_RETRIES + 1):
+        slot = await limiter.aacquire(upstream_cost(prompt, max_tokens)) if limiter else None
+        try:
+            async with client.stream("POST", API_URL, headers=headers, files=files or None, data=data) as response_obj:
+                if slot is not None:
+                    slot.first_byte()
+                if response_obj.status_code in UPSTREAM_OVERLOAD_STATUSES and attempt < UPSTREAM_RETRIES:
+                    # Overloaded before anything was streamed: wait as told and try again
+                    retry_after = parse_retry_after(response_obj.headers.get("Retry-After"))
+                    print(f"Warning: Upstream answered {response_obj.status_code}; retrying "
+                          f"(attempt {attempt + 2} of {UPSTREAM_RETRIES + 1})")
+                    if slot is not None:
+                        slot.release("overload", retry_after)
+                    else:
+                        await asyncio.sleep(retry_after if retry_after is not None else UPSTREAM_DEFAULT_BACKOFF)
+                    continue
+                response_obj.raise_for_status()
+
+                accumulated_response_text = ""
+                async for line in response_obj.aiter_lines():
+                    content_piece = _parse_stream_line(line)
+                    if content_piece:
+                        accumulated_response_text += content_piece
+                        yield content_piece
+
+            if RESPONSE_CACHE_ENABLED and accumulated_response_text:
+                get_response_cache().put(cache_key, accumulated_response_text)
+            return
 
-Focus on musculoskeletal system and functional improvement."""
+        except httpx.HTTPError as e:
+            if slot is not None:
+                overloaded = isinstance(e, httpx.HTTPStatusError) and e.response.status_code in UPSTREAM_OVERLOAD_STATUSES
+                slot.release("overload" if overloaded else "error",
+                             parse_retry_after(e.response.headers.get("Retry-After")) if overloaded else None)
+            error_msg = f"Error: API request failed. {e}"
+            print(error_msg)
+            yield error_msg
+            return
+        finally:
+            if slot is not None:
+                slot.release()
 
-    
-    full_response = "### Orthopaedician's Assessment\n\n"
-    response_placeholder = st.empty()    
 
-    response_generator = generate_response(prompt.format(report=report), images)
- 
-    for chunk in response_generator:
-        full_response += chunk
-        response_placeholder.markdown(full_response)
-    response_placeholder.empty()
-    state["agent_results"].append({"specialist": "Orthopaedician", "analysis": full_response})
-    return state
+# Streaming render cadence: re-render the growing markdown at most this often
+STREAM_FLUSH_INTERVAL_MS = int(os.environ.get("AGENTDX_STREAM_FLUSH_MS", "250"))
+STREAM_FLUSH_CHARS = int(os.environ.get("AGENTDX_STREAM_FLUSH_CHARS", "400"))
 
-def opthamologist_agent(state: Dict[str, Any]) -> Dict[str, Any]:
-    report = state["report"]
-    images = state.get("images")
-    prompt = """As an ophthalmologist, provide a comprehensive eye assessment:
+class StreamRenderer:
+    """
+    Collects streamed chunks in a buffer and re-renders the placeholder every
+    STREAM_FLUSH_INTERVAL_MS or STREAM_FLUSH_CHARS, instead of on every chunk.
+    """
+    def __init__(self, heading: str = "", placeholder=None,
+                 interval_ms: int = STREAM_FLUSH_INTERVAL_MS, flush_chars: int = STREAM_FLUSH_CHARS):
+        self.placeholder = placeholder if placeholder is not None else st.empty()
+        self.interval = interval_ms / 1000
+        self.flush_chars = flush_chars
+        self._parts: List[str] = [heading]
+        self._pending_chars = 0
+        self._last_flush = time.monotonic()
+
+    @property
+    def text(self) -> str:
+        if len(self._parts) > 1:
+            self._parts = ["".join(self._parts)]
+        return self._parts[0]
+
+    def write(self, chunk: str) -> None:
+        self._parts.append(chunk)
+        self._pending_chars += len(chunk)
+        if (self._pending_chars >= self.flush_chars
+                or time.monotonic() - self._last_flush >= self.interval):
+            self.flush()
+
+    def flush(self) -> None:
+        self.placeholder.markdown(self.text)
+        self._pending_chars = 0
+        self._last_flush = time.monotonic()
+
+    def finish(self, clear: bool = True) -> str:
+        """
+        Ends the stream: clears the placeholder, or renders the remaining buffer
+        when clear is False. Returns the full text.
+        """
+        if clear:
+            self.placeholder.empty()
+        elif self._pending_chars:
+            self.flush()
+        return self.text
+
+class OutputSink:
+    """
+    Receives a consultation's output as events: graph nodes starting and ending, and
+    the chunks of every agent response stream. Agents only talk to a sink, never to
+    the UI. This base sink drops everything, so headless runs pay no rendering cost.
+    """
+    def node_start(self, node: str) -> None:
+        pass
 
-Medical Information:
-{report}
+    def node_end(self, node: str) -> None:
+        pass
 
-Structure your analysis as follows:
+    def stream_start(self, stream_id: int, heading: str) -> None:
+        pass
 
-1. VISION ASSESSMENT:
-- Visual symptoms
-- Vision changes
-- Eye pain or discomfort
-- Associated symptoms
+    def chunk(self, stream_id: int, text: str) -> None:
+        pass
 
-2. CLINICAL FINDINGS:
-- Visual acuity concerns
-- External eye examination
-- Retinal considerations
-- Neurological aspects
+    def stream_replace(self, stream_id: int, text: str) -> None:
+        """
+        The stream's text so far (heading included) is replaced by text.
+        """
 
-3. DIFFERENTIAL DIAGNOSIS:
-- Potential eye conditions
-- Vision threatening concerns
-- Systemic disease impact
+    def stream_end(self, stream_id: int, text: str, keep: bool) -> None:
+        """
+        The stream is complete with text; keep tells whether a display should keep showing it.
+        """
 
-4. TREATMENT RECOMMENDATIONS:
-- Immediate interventions
-- Vision correction needs
-- Medical/surgical options
-- Preventive measures
+class StreamlitSink(OutputSink):
+    """
+    Renders each stream into its own placeholder of the current page through a
+    throttled StreamRenderer. placeholder, if given, is used for the first stream.
+    """
+    def __init__(self, placeholder=None):
+        self.placeholder = placeholder
+        self._renderers: Dict[int, StreamRenderer] = {}
 
-5. FOLLOW-UP PLAN:
-- Monitoring schedule
-- Vision testing needs
-- Emergency warning signs
-- Vision protection strategies
+    def stream_start(self, stream_id: int, heading: str) -> None:
+        placeholder, self.placeholder = self.placeholder, None
+        self._renderers[stream_id] = StreamRenderer(heading, placeholder)
 
-Focus on ocular health and vision preservation."""
+    def chunk(self, stream_id: int, text: str) -> None:
+        self._renderers[stream_id].write(text)
 
-    
-    full_response = "### Opthamologist's Assessment\n\n"
-    response_placeholder = st.empty()    
+    def stream_replace(self, stream_id: int, text: str) -> None:
+        self._renderers[stream_id] = StreamRenderer(text, self._renderers[stream_id].placeholder)
+        self._renderers[stream_id].flush()
 
-    response_generator = generate_response(prompt.format(report=report), images)
-    
-    for chunk in response_generator:
-        full_response += chunk
-        response_placeholder.markdown(full_response)
-    response_placeholder.empty()
-    state["agent_results"].append({"specialist": "Opthamologist", "analysis": full_response})
-    return state
+    def stream_end(self, stream_id: int, text: str, keep: bool) -> None:
+        self._renderers.pop(stream_id).finish(clear=not keep)
 
-def cardiologist_agent(state: Dict[str, Any]) -> Dict[str, Any]:
-    report = state["report"]
-    images = state.get("images")
-    prompt = """As a cardiologist, provide a comprehensive cardiac assessment:
+class EventSink(OutputSink):
+    """
+    Base for sinks that pass events on as dicts: {"event", "consultation", "at", ...}
+    with node, or stream and heading/text. Subclasses implement emit().
+    """
+    def __init__(self, chunks: bool = True):
+        self.chunks = chunks
 
-Medical Information:
-{report}
+    def emit(self, event: Dict[str, Any]) -> None:
+        raise NotImplementedError
 
-Structure your analysis as follows:
+    def _emit(self, event: str, **fields) -> None:
+        self.emit({"event": event, "consultation": _conversation_id.get(), "at": time.time(), **fields})
 
-1. CARDIOVASCULAR ASSESSMENT:
-- Cardiac symptoms
-- Risk factors present
-- Exercise tolerance
-- Associated symptoms
+    def node_start(self, node: str) -> None:
+        self._emit("node_start", node=node)
 
-2. CLINICAL CORRELATION:
-- Cardiovascular findings
-- Hemodynamic status
-- Related systemic effects
-- Risk stratification
+    def node_end(self, node: str) -> None:
+        self._emit("node_end", node=node)
 
-3. DIFFERENTIAL DIAGNOSIS:
-- Potential cardiac conditions
-- Non-cardiac considerations
-- Risk assessment
+    def stream_start(self, stream_id: int, heading: str) -> None:
+        self._emit("stream_start", stream=stream_id, heading=heading)
 
-4. MANAGEMENT PLAN:
-- Immediate interventions
-- Medication recommendations
-- Lifestyle modifications
-- Risk factor management
+    def chunk(self, stream_id: int, text: str) -> None:
+        if self.chunks:
+            self._emit("chunk", stream=stream_id, text=text)
 
-5. MONITORING PLAN:
-- Follow-up schedule
-- Testing requirements
-- Warning signs
-- Prevention strategies
+    def stream_replace(self, stream_id: int, text: str) -> None:
+        self._emit("stream_replace", stream=stream_id, text=text)
 
-Focus on cardiovascular health and risk management."""
+    def stream_end(self, stream_id: int, text: str, keep: bool) -> None:
+        self._emit("stream_end", stream=stream_id, text=text, keep=keep)
 
-    
-    full_response = "### Cardiologist's Assessment\n\n"
-    response_placeholder = st.empty()    
+class JsonlSink(EventSink):
+    """
+    Appends every event as one JSON line to a file, shared safely by concurrent consultations.
+    chunks=False leaves out the individual chunks and keeps the complete stream texts.
+    """
+    def __init__(self, path: str, chunks: bool = True):
+        super().__init__(chunks)
+        self._file = open(path, "a", encoding="utf-8")
+        self._lock = threading.Lock()
+
+    def emit(self, event: Dict[str, Any]) -> None:
+        line = json.dumps(event, default=str) + "\n"
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+
+    def close(self) -> None:
+        with self._lock:
+            self._file.close()
+
+class QueueSink(EventSink):
+    """
+    Puts every event on an in-memory queue (queue.Queue, safe across threads) for a
+    consumer such as a server streaming them to a client.
+    """
+    def __init__(self, maxsize: int = 0, chunks: bool = True):
+        super().__init__(chunks)
+        self.events: "queue.Queue[Dict[str, Any]]" = queue.Queue(maxsize)
 
-    response_generator = generate_response(prompt.format(report=report), images)
-   
-    for chunk in response_generator:
-        full_response += chunk
-        response_placeholder.markdown(full_response)
-    response_placeholder.empty()
-    state["agent_results"].append({"specialist": "Cardiologist", "analysis": full_response})
-    return state
+    def emit(self, event: Dict[str, Any]) -> None:
+        self.events.put(event)
 
-def neurologist_agent(state: Dict[str, Any]) -> Dict[str, Any]:
-    report = state["report"]
-    images = state.get("images")
-    prompt = """As a neurologist, provide a comprehensive neurological assessment:
+def current_sink() -> OutputSink:
+    """
+    Sink of the consultation being run: the one in its run config, otherwise the
+    current page, or nothing when headless.
+    """
+    sink = _output_sink.get()
+    if sink is not None:
+        return sink
+    return OutputSink() if HEADLESS else StreamlitSink()
 
-Medical Information:
-{report}
+# Stream ids are unique per process so events of concurrent consultations never collide
+_stream_ids = itertools.count(1)
 
-Structure your analysis as follows:
-
-1. NEUROLOGICAL ASSESSMENT:
-- Mental status and consciousness
-- Cranial nerve functions
-- Motor system evaluation
-- Sensory system findings
-- Coordination and balance
-- Reflexes and gait
-
-2. SYMPTOM ANALYSIS:
-- Temporal progression
-- Pattern recognition
-- Associated symptoms
-- Aggravating/alleviating factors
-- Impact on daily functioning
-
-3. DIFFERENTIAL DIAGNOSIS:
-- Primary neurological conditions
-- Secondary neurological manifestations
-- Urgent neurological concerns
-- Systemic conditions with neurological impact
-
-4. DIAGNOSTIC PLAN:
-- Neuroimaging recommendations
-- Neurophysiological studies needed
-- Laboratory tests required
-- Specialized neurological testing
-
-5. TREATMENT RECOMMENDATIONS:
-- Immediate interventions
-- Medical management
-- Preventive measures
-- Rehabilitation needs
-- Lifestyle modifications
-
-6. FOLLOW-UP PLAN:
-- Monitoring schedule
-- Warning signs to watch
-- Emergency action plan
-- Long-term management strategy
-
-Focus on nervous system function and neurological manifestations."""
-
-   
-    full_response = "### Neurologist's Assessment\n\n"
-    response_placeholder = st.empty()    
-
-    response_generator = generate_response(prompt.format(report=report), images)
-   
+class AgentStream:
+    """
+    One agent response while it streams: keeps its text and reports each chunk to a sink.
+    """
+    def __init__(self, heading: str = "", sink: Optional[OutputSink] = None):
+        self.sink = sink if sink is not None else current_sink()
+        self.id = next(_stream_ids)
+        self._parts: List[str] = [heading]
+        self.sink.stream_start(self.id, heading)
+
+    @property
+    def text(self) -> str:
+        if len(self._parts) > 1:
+            self._parts = ["".join(self._parts)]
+        return self._parts[0]
+
+    def write(self, chunk: str) -> None:
+        self._parts.append(chunk)
+        self.sink.chunk(self.id, chunk)
+
+    def replace(self, text: str) -> None:
+        self._parts = [text]
+        self.sink.stream_replace(self.id, text)
+
+    def finish(self, clear: bool = True) -> str:
+        """
+        Ends the stream and returns its full text; clear=False asks displays to keep it.
+        """
+        self.sink.stream_end(self.id, self.text, keep=not clear)
+        return self.text
+
+def render_stream(response_generator, heading: str = "", clear: bool = True, renderer=None) -> str:
+    """
+    Streams a response to the current sink and returns the full text. A renderer such
+    as StructuredOutput can be passed in to control how the chunks are shown.
+    """
+    renderer = renderer if renderer is not None else AgentStream(heading)
     for chunk in response_generator:
-        full_response += chunk
-        response_placeholder.markdown(full_response)
-    response_placeholder.empty()
-    state["agent_results"].append({"specialist": "Neurologist", "analysis": full_response})
-    return state
-
-def nephrologist_agent(state: Dict[str, Any]) -> Dict[str, Any]:
-    report = state["report"]
-    images = state.get("images")
-    prompt = """As a nephrologist, provide a detailed renal assessment:
+        renderer.write(chunk)
+    return renderer.finish(clear)
 
-Medical Information:
-{report}
+# Structured output: agents answer with a JSON object whose sections mirror their
+# numbered templates; the markdown shown and stored is derived from it
+OUTPUT_FORMATS = ("markdown", "json")
+OUTPUT_FORMAT = os.environ.get("AGENTDX_OUTPUT_FORMAT", "markdown")
+if OUTPUT_FORMAT not in OUTPUT_FORMATS:
+    print(f"Warning: unknown AGENTDX_OUTPUT_FORMAT {OUTPUT_FORMAT!r}, using 'markdown'")
+    OUTPUT_FORMAT = "markdown"
 
-Structure your analysis as follows:
-
-1. RENAL ASSESSMENT:
-- Kidney function indicators
-- Urinary symptoms
-- Fluid status evaluation
-- Blood pressure patterns
-- Electrolyte balance
-- Related systemic symptoms
-
-2. RISK FACTOR ANALYSIS:
-- Predisposing conditions
-- Medication effects
-- Family history impact
-- Environmental factors
-- Comorbidity influence
-
-3. DIFFERENTIAL DIAGNOSIS:
-- Primary kidney conditions
-- Secondary renal involvement
-- Acute vs. chronic considerations
-- Systemic diseases affecting kidneys
-
-4. DIAGNOSTIC WORKUP:
-- Laboratory tests needed
-- Imaging studies required
-- Specialized renal testing
-- Monitoring parameters
-
-5. TREATMENT PLAN:
-- Immediate interventions
-- Medication adjustments
-- Dietary recommendations
-- Fluid management
-- Blood pressure control
-
-6. FOLLOW-UP STRATEGY:
-- Monitoring frequency
-- Key parameters to track
-- Complications to watch
-- Prevention strategies
-
-Focus on renal function and systemic implications."""
+JSON_OUTPUT_INSTRUCTIONS = """
 
-    
-    full_response = "### Nephrologist's Assessment\n\n"
-    response_placeholder = st.empty()    
-
-    response_generator = generate_response(prompt.format(report=report), images)
-    
-    for chunk in response_generator:
-        full_response += chunk
-        response_placeholder.markdown(full_response)
-    response_placeholder.empty()
-    state["agent_results"].append({"specialist": "Nephrologist", "analysis": full_response})
-    return state
+---
 
-def pulmonologist_agent(state: Dict[str, Any]) -> Dict[str, Any]:
-    report = state["report"]
-    images = state.get("images")
-    prompt = """As a pulmonologist, provide a comprehensive respiratory assessment:
+### Output Format
+Ignore any markdown layout requested above. Respond with a single JSON object and nothing else: no code fences and no text before or after it. Write its sections in the order given, and make it validate against this JSON Schema:
+{schema}
+"""
 
-Medical Information:
-{report}
+def with_output_format(prompt: str, schema: Optional[Dict[str, Any]]) -> str:
+    """
+    Appends the JSON output instructions in structured mode.
+    """
+    if OUTPUT_FORMAT != "json" or schema is None:
+        return prompt
+    return prompt + JSON_OUTPUT_INSTRUCTIONS.format(schema=json.dumps(schema, indent=1))
 
-Structure your analysis as follows:
-
-1. RESPIRATORY ASSESSMENT:
-- Breathing patterns
-- Respiratory symptoms
-- Exercise tolerance
-- Sleep-related symptoms
-- Environmental factors
-- Associated systemic symptoms
-
-2. PHYSICAL FINDINGS:
-- Respiratory rate and effort
-- Breath sounds
-- Chest wall movement
-- Oxygen saturation
-- Use of accessory muscles
-- Signs of respiratory distress
-
-3. DIFFERENTIAL DIAGNOSIS:
-- Primary lung conditions
-- Airway diseases
-- Parenchymal disorders
-- Vascular lung disease
-- Pleural conditions
-- Systemic diseases with pulmonary involvement
-
-4. DIAGNOSTIC PLAN:
-- Pulmonary function testing
-- Imaging requirements
-- Blood gas analysis
-- Sleep studies if needed
-- Specialized respiratory testing
-
-5. TREATMENT RECOMMENDATIONS:
-- Immediate interventions
-- Inhalation therapy
-- Oxygen requirements
-- Medical management
-- Pulmonary rehabilitation
-- Lifestyle modifications
-
-6. FOLLOW-UP PROTOCOL:
-- Monitoring schedule
-- Home monitoring needs
-- Warning signs
-- Emergency action plan
-- Long-term management strategy
-
-Focus on respiratory function and systemic impact."""
+def validate_structured(value, schema: Dict[str, Any], path: str = "$") -> List[str]:
+    """
+    Checks a value against the subset of JSON Schema used by the output schemas
+    (object, array, string and enum). Returns the errors found.
+    """
+    kind = schema.get("type")
+    if kind == "object":
+        if not isinstance(value, dict):
+            return [f"{path}: expected an object"]
+        properties = schema.get("properties", {})
+        errors = [f"{path}.{key}: missing" for key in schema.get("required", []) if key not in value]
+        for key, item in value.items():
+            if key in properties:
+                errors += validate_structured(item, properties[key], f"{path}.{key}")
+        return errors
+    if kind == "array":
+        if not isinstance(value, list):
+            return [f"{path}: expected an array"]
+        return [error for index, item in enumerate(value)
+                for error in validate_structured(item, schema.get("items", {}), f"{path}[{index}]")]
+    if kind == "string":
+        if not isinstance(value, str):
+            return [f"{path}: expected a string"]
+        if "enum" in schema and value not in schema["enum"]:
+            return [f"{path}: {value!r} is not an allowed value"]
+    return []
+
+def structured_section_markdown(key: str, value, schema: Dict[str, Any]) -> str:
+    """
+    Renders one top-level section of a structured response as markdown.
+    """
+    title = schema.get("title", key.replace("_", " ").upper())
+    if key == "required_specialists" and isinstance(value, list):
+        # Same layout as the markdown protocol, so text-based parsing still works on it
+        referrals = [item for item in value if isinstance(item, dict)]
+        listed = "\n".join(f"- {item.get('specialist', '')} ({item.get('urgency', 'routine')})" for item in referrals)
+        justified = "\n".join(f"- **{item.get('specialist', '')}:** {item.get('justification', '')}" for item in referrals)
+        return f"#### **{title}:**\n{listed or 'none'}\n\n---\n\n#### **REFERRAL JUSTIFICATION:**\n{justified}\n\n"
+    if isinstance(value, dict):
+        properties = schema.get("properties", {})
+        parts = [f"#### **{title}:**\n\n"]
+        for sub_key, sub_value in value.items():
+            sub_schema = properties.get(sub_key, {})
+            sub_title = sub_schema.get("title", sub_key.replace("_", " ").title())
+            parts.append(f"**{sub_title}:**\n{_structured_value_markdown(sub_value)}\n\n")
+        return "".join(parts) + "---\n\n"
+    return f"**{title}:**\n{_structured_value_markdown(value)}\n\n"
+
+def _structured_value_markdown(value) -> str:
+    if isinstance(value, list):
+        return "\n".join(f"- {_structured_value_markdown(item)}" for item in value) or "- none"
+    if isinstance(value, dict):
+        return "; ".join(f"{key}: {_structured_value_markdown(item)}" for key, item in value.items())
+    return str(value)
+
+class StructuredOutput:
+    """
+    Streams a JSON agent response. Each top-level section is parsed and validated as
+    soon as it closes, then rendered as markdown. A response that is not JSON is shown
+    as it arrives and structured is None, so callers fall back to the text.
 
-    
-    full_response = "### Pulmonologist's Assessment\n\n"
-    response_placeholder = st.empty()    
+    Has the same write/finish interface as AgentStream.
+    """
+    def __init__(self, schema: Dict[str, Any], heading: str = "", on_section=None, sink: Optional[OutputSink] = None):
+        self.schema = schema
+        self.heading = heading
+        self.on_section = on_section
+        self.stream = AgentStream(heading, sink)
+        self.data: Dict[str, Any] = {}
+        self.errors: List[str] = []
+        self.fallback = False
+        self.structured: Optional[Dict[str, Any]] = None
+        self._raw: List[str] = []
+        self._prelude = ""
+        self._started = False
+        self._closed = False
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._member: List[str] = []
+
+    def write(self, chunk: str) -> None:
+        self._raw.append(chunk)
+        if self.fallback:
+            self.stream.write(chunk)
+            return
+        for char in chunk:
+            self._scan(char)
+            if self.fallback:
+                self._show_raw()
+                return
 
-    response_generator = generate_response(prompt.format(report=report), images)
-   
-    for chunk in response_generator:
-        full_response += chunk
-        response_placeholder.markdown(full_response)
-    response_placeholder.empty()
-    state["agent_results"].append({"specialist": "Pulmonologist", "analysis": full_response})
-    return state
+    def _scan(self, char: str) -> None:
+        if not self._started:
+            if char == "{":
+                self._started, self._depth = True, 1
+            else:
+                # Tolerate whitespace and a ```json fence before the object
+                self._prelude += char
+                if not re.fullmatch(r"\s*(`{1,3}(j(s(o(n)?)?)?)?)?\s*", self._prelude):
+                    self.fallback = True
+            return
+        if self._closed:
+            return
+        if self._in_string:
+            self._member.append(char)
+            if self._escape:
+                self._escape = False
+            elif char == "\\":
+                self._escape = True
+            elif char == '"':
+                self._in_string = False
+            return
+        if char == '"':
+            self._in_string = True
+        elif char in "[{":
+            self._depth += 1
+        elif char in "]}":
+            self._depth -= 1
+            if self._depth == 0:
+                self._complete_member()
+                self._closed = True
+                return
+        elif char == "," and self._depth == 1:
+            self._complete_member()
+            return
+        self._member.append(char)
 
-def ent_agent(state: Dict[str, Any]) -> Dict[str, Any]:
-    report = state["report"]
-    images = state.get("images")
-    prompt = """As an ENT (Otolaryngologist), provide a comprehensive assessment:
+    def _complete_member(self) -> None:
+        text = "".join(self._member).strip()
+        self._member = []
+        if not text:
+            return
+        try:
+            member = json.loads("{" + text + "}")
+        except ValueError:
+            self.fallback = True
+            return
+        properties = self.schema.get("properties", {})
+        for key, value in member.items():
+            section_schema = properties.get(key, {})
+            errors = validate_structured(value, section_schema, f"$.{key}") if section_schema else []
+            self.errors += errors
+            self.data[key] = value
+            self.stream.write(structured_section_markdown(key, value, section_schema))
+            if self.on_section is not None:
+                self.on_section(key, value, not errors)
+
+    def _show_raw(self) -> None:
+        # Replace anything rendered so far with the response as the model wrote it
+        self.stream.replace(self.heading + "".join(self._raw))
+
+    def finish(self, clear: bool = True) -> str:
+        if not self.fallback:
+            if not self._started:
+                self.fallback = True
+                self._show_raw()
+            elif not self._closed:
+                # Keep the last section if it is complete, even though the object never closed
+                self._complete_member()
+                self.errors.append("$: response ended before the JSON object was closed")
+            self.errors += [f"$.{key}: missing" for key in self.schema.get("required", []) if key not in self.data]
+        if self.errors:
+            print(f"Warning: Structured output did not validate: {self.errors[:5]}")
+        if not self.fallback and not self.errors:
+            self.structured = self.data
+        return self.stream.finish(clear)
+
+
+# Specialist registry: one declarative entry per specialist graph node.
+#   specialist    label stored in agent_results and matched by the result tabs
+#   title         heading of the streamed assessment
+#   aliases       phrases in the GP's referral section that select this specialist
+#   image_policy  "full", "downscaled" or "none" (see apply_image_policy)
+#   max_tokens    optional response budget sent upstream (default SPECIALIST_MAX_TOKENS)
+# Prompt templates live in specialist_prompts.json and are loaded on first use.
+SPECIALIST_REGISTRY: Dict[str, Dict[str, Any]] = {
+    "orthopaedician": {
+        "specialist": "Orthopaedician",
+        "title": "Orthopaedician's Assessment",
+        "aliases": ["orthopaedician", "orthopedician", "muscle cramp", "leg cramp"],
+        "image_policy": "downscaled",
+    },
+    "opthamologist": {
+        "specialist": "Opthamologist",
+        "title": "Opthamologist's Assessment",
+        "aliases": ["opthamologist", "ophthalmologist"],
+        "image_policy": "downscaled",
+    },
+    "dentist": {
+        "specialist": "Dentist",
+        "title": "Dentist's Assessment",
+        "aliases": ["dentist", "oral"],
+        "image_policy": "none",
+        "batch_group": "text_only",
+    },
+    "cardiologist": {
+        "specialist": "Cardiologist",
+        "title": "Cardiologist's Assessment",
+        "aliases": ["cardiologist", "cardiac specialist", "cardio", "heart", "chest"],
+        "image_policy": "downscaled",
+    },
+    "gynecologist": {
+        "specialist": "Gynecologist",
+        "title": "Gynaecologist's Assessment",
+        "aliases": ["gynecologist", "gynaecologist", "ob-gyn", "menstrual cramp"],
+        "image_policy": "downscaled",
+    },
+    "radiologist": {
+        "specialist": "Radiologist",
+        "title": "Radiologist's Assessment",
+        "aliases": [],
+        "image_policy": "full",
+    },
+    "oncologist": {
+        "specialist": "Oncologist",
+        "title": "Oncologist's Assessment",
+        "aliases": ["oncologist"],
+        "image_policy": "downscaled",
+    },
+    "pain_management": {
+        "specialist": "Pain Management",
+        "title": "Pain Specialist's Assessment",
+        "aliases": ["pain management", "pain specialist"],
+        "image_policy": "downscaled",
+    },
+    "gastroenterologist": {
+        "specialist": "Gastroenterologist",
+        "title": "Gastroenterologist's Assessment",
+        "aliases": ["gastroenterologist", "gastrointestinal specialist", "gi specialist", "abdominal cramp", "stomach cramp"],
+        "image_policy": "downscaled",
+    },
+    "rheumatologist": {
+        "specialist": "Rheumatologist",
+        "title": "Rheumatologist's Assessment",
+        "aliases": ["rheumatologist"],
+        "image_policy": "downscaled",
+    },
+    "psychologist": {
+        "specialist": "Psychologist",
+        "title": "Psychologist's Assessment",
+        "aliases": ["psychologist"],
+        "image_policy": "none",
+        "batch_group": "text_only",
+    },
+    "neurologist": {
+        "specialist": "Neurologist",
+        "title": "Neurologist's Assessment",
+        "aliases": ["neurologist", "neuro"],
+        "image_policy": "downscaled",
+    },
+    "nephrologist": {
+        "specialist": "Nephrologist",
+        "title": "Nephrologist's Assessment",
+        "aliases": ["nephrologist", "kidney specialist", "nephro"],
+        "image_policy": "downscaled",
+    },
+    "pulmonologist": {
+        "specialist": "Pulmonologist",
+        "title": "Pulmonologist's Assessment",
+        "aliases": ["pulmonologist"],
+        "image_policy": "downscaled",
+    },
+    "ent": {
+        "specialist": "ENT",
+        "title": "ENT's Assessment",
+        "aliases": ["ent specialist", "ear nose throat specialist", "ear nose and throat", "otolaryngologist"],
+        "image_policy": "downscaled",
+    },
+    "allergist": {
+        "specialist": "Allergist",
+        "title": "Allergist's Assessment",
+        "aliases": ["allergist"],
+        "image_policy": "downscaled",
+    },
+    "endocrinologist": {
+        "specialist": "Endocrinologist",
+        "title": "Endocrinologist's Assessment",
+        "aliases": ["endocrinologist"],
+        "image_policy": "downscaled",
+    },
+    "dermatologist": {
+        "specialist": "Dermatologist",
+        "title": "Dermatologist's Assessment",
+        "aliases": ["dermatologist"],
+        "image_policy": "downscaled",
+    },
+    "urologist": {
+        "specialist": "Urologist",
+        "title": "Urologist's Assessment",
+        "aliases": ["urologist"],
+        "image_policy": "downscaled",
+    },
+    "hepatologist": {
+        "specialist": "Hepatologist",
+        "title": "Hepatologist's Assessment",
+        "aliases": ["hepatologist"],
+        "image_policy": "downscaled",
+    },
+    "dietician": {
+        "specialist": "Dietician",
+        "title": "Dietician's Assessment",
+        "aliases": ["dietician", "dietitian", "nutritionist", "food specialist"],
+        "image_policy": "none",
+        "batch_group": "text_only",
+    },
+    "neurosurgeon": {
+        "specialist": "Neurosurgeon",
+        "title": "Neurosurgeon's Assessment",
+        "aliases": ["neurosurgeon", "neuro surgeon"],
+        "image_policy": "downscaled",
+    },
+    "radiation_oncologist": {
+        "specialist": "Radiation Oncologist",
+        "title": "Radiation Oncologist's Assessment",
+        "aliases": ["radiation oncologist"],
+        "image_policy": "downscaled",
+    },
+    "psychiatrist": {
+        "specialist": "Psychiatrist",
+        "title": "Psychiatrist's Assessment",
+        "aliases": ["psychiatrist"],
+        "image_policy": "none",
+        "batch_group": "text_only",
+    },
+    "interventional_cardiologist": {
+        "specialist": "Interventional Cardiologist",
+        "title": "Interventional Cardiologist's Assessment",
+        "aliases": ["interventional cardiologist", "interventional_cardiologist"],
+        "image_policy": "downscaled",
+    },
+}
+
+SPECIALIST_MAX_TOKENS = int(os.environ.get("AGENTDX_SPECIALIST_MAX_TOKENS", "0")) or None
+# Registry batch groups whose members are asked for in one upstream call when several
+# are referred together, e.g. "text_only". Empty keeps one call per specialist.
+BATCH_SPECIALIST_GROUPS = {group.strip() for group in os.environ.get("AGENTDX_BATCH_GROUPS", "").split(",")
+                           if group.strip()}
+SPECIALIST_PROMPTS_PATH = os.environ.get(
+    "AGENTDX_SPECIALIST_PROMPTS", os.path.join(os.path.dirname(os.path.abspath(__file__)), "specialist_prompts.json"))
+
+@functools.lru_cache(maxsize=4)
+def _load_prompt_pack(path: str, modified_ns: int) -> Dict[str, str]:
+    with open(path, encoding="utf-8") as prompt_file:
+        return json.load(prompt_file)
+
+def load_specialist_prompt(name: str) -> str:
+    """
+    Returns a specialist's prompt template, reading the prompt pack on first use
+    (and again whenever the file changes).
+    """
+    return _load_prompt_pack(SPECIALIST_PROMPTS_PATH, os.stat(SPECIALIST_PROMPTS_PATH).st_mtime_ns)[name]
+
+# Prompt layout: "classic" formats each template as written; "shared_prefix" puts the case
+# (framing, report, imaging) first so every call in a consultation starts with the same bytes
+# and a prefix/KV cache on the backend can reuse it across the GP and all specialists.
+PROMPT_LAYOUTS = ("classic", "shared_prefix")
+PROMPT_LAYOUT = os.environ.get("AGENTDX_PROMPT_LAYOUT", "classic")
+if PROMPT_LAYOUT not in PROMPT_LAYOUTS:
+    print(f"Warning: unknown AGENTDX_PROMPT_LAYOUT {PROMPT_LAYOUT!r}, using 'classic'")
+    PROMPT_LAYOUT = "classic"
+# Sends the shared prefix length with each request for backends that accept a cache hint
+PREFIX_CACHE_HINTS = os.environ.get("AGENTDX_PREFIX_CACHE_HINTS", "0") == "1"
+# How long a prefix is assumed to stay warm in the backend cache
+PREFIX_CACHE_WINDOW = float(os.environ.get("AGENTDX_PREFIX_CACHE_WINDOW", "300"))
+
+SHARED_PROMPT_PREFIX = """You are taking part in a multi-disciplinary medical consultation. The same case is reviewed by a General Practitioner and by the specialists they refer to. Your role and the structure of your answer follow the case below.
 
 Medical Information:
 {report}
 
-Structure your analysis as follows:
-
-1. ENT ASSESSMENT:
-- Ear symptoms and findings
-- Nose and sinus evaluation
-- Throat and larynx status
-- Head and neck examination
-- Hearing and balance issues
-- Voice and swallowing function
-
-2. SYMPTOM ANALYSIS:
-- Duration and progression
-- Impact on daily activities
-- Associated symptoms
-- Aggravating/alleviating factors
-- Previous treatments tried
-
-3. DIFFERENTIAL DIAGNOSIS:
-- Ear-related conditions
-- Nasal/sinus pathologies
-- Throat/laryngeal issues
-- Head and neck concerns
-- Systemic conditions affecting ENT
-
-4. DIAGNOSTIC PLAN:
-- Audiological testing needs
-- Imaging requirements
-- Endoscopic evaluation
-- Special ENT investigations
-- Laboratory tests
-
-5. TREATMENT RECOMMENDATIONS:
-- Immediate interventions
-- Medical management
-- Surgical considerations
-- Preventive measures
-- Voice/speech therapy needs
-
-6. FOLLOW-UP PROTOCOL:
-- Monitoring schedule
-- Warning signs
-- Hearing protection strategies
-- Lifestyle modifications
-
-Focus on ear, nose, throat, and related structures."""
+Medical Imaging: {imaging}
 
-    
-    full_response = "### ENT's Assessment\n\n"
-    response_placeholder = st.empty()    
+---
 
-    response_generator = generate_response(prompt.format(report=report), images)
-    
-    for chunk in response_generator:
-        full_response += chunk
-        response_placeholder.markdown(full_response)
-    response_placeholder.empty()
-    state["agent_results"].append({"specialist": "ENT", "analysis": full_response})
-    return state
+"""
+PREFIX_REPORT_REFERENCE = "(see Medical Information above)"
 
-def allergist_agent(state: Dict[str, Any]) -> Dict[str, Any]:
-    report = state["report"]
-    images = state.get("images")
-    prompt = """As an allergist/immunologist, provide a detailed assessment:
+def describe_images(images) -> str:
+    """
+    One-line imaging description for the shared prefix. Uses the uploaded images,
+    not the per-agent attachment, so it is identical for every call in a consultation.
+    """
+    if not images:
+        return "Absent"
+    images = resolve_images(images)
+    return "Present (" + "; ".join(f"{image.width}x{image.height} {image.mode}" for image in images) + ")"
 
-Medical Information:
-{report}
+def assemble_prompt(template: str, state: Dict[str, Any], record: bool = True):
+    """
+    Returns (prompt, prefix_chars) for a template that takes {report}.
+    prefix_chars is the length of the shared prefix, 0 in the classic layout.
+    record=False leaves the call out of the prefix cache statistics.
+    """
+    if PROMPT_LAYOUT != "shared_prefix":
+        return template.format(report=state["report"]), 0
+    prefix = SHARED_PROMPT_PREFIX.format(report=state["report"], imaging=describe_images(state.get("images")))
+    if record:
+        get_prefix_cache_stats().record(current_conversation_id(), prefix)
+    return prefix + template.format(report=PREFIX_REPORT_REFERENCE).strip(), len(prefix)
+
+class PrefixCacheStats:
+    """
+    Estimates prefix cache reuse: a call counts as a hit when the same prefix was sent
+    within PREFIX_CACHE_WINDOW seconds. Counts are kept per consultation.
+    """
+    def __init__(self, window: float = PREFIX_CACHE_WINDOW, max_prefixes: int = 1024):
+        self.window = window
+        self.max_prefixes = max_prefixes
+        self._last_sent = OrderedDict()
+        self._consultations: Dict[str, Dict[str, int]] = {}
+        self._lock = threading.Lock()
+
+    def record(self, conversation: str, prefix: str) -> bool:
+        key = hashlib.sha256(prefix.encode("utf-8")).hexdigest()
+        now = time.time()
+        with self._lock:
+            last_sent = self._last_sent.pop(key, None)
+            hit = last_sent is not None and now - last_sent <= self.window
+            self._last_sent[key] = now
+            while len(self._last_sent) > self.max_prefixes:
+                self._last_sent.popitem(last=False)
+            counts = self._consultations.setdefault(conversation, {"calls": 0, "hits": 0})
+            counts["calls"] += 1
+            counts["hits"] += hit
+        return hit
+
+    def report(self, conversation: str) -> Optional[Dict[str, Any]]:
+        """
+        Returns and clears the counts for a consultation, with its hit rate.
+        """
+        with self._lock:
+            counts = self._consultations.pop(conversation, None)
+        if not counts:
+            return None
+        return {**counts, "hit_rate": counts["hits"] / counts["calls"]}
+
+@cache_resource
+def get_prefix_cache_stats() -> PrefixCacheStats:
+    return PrefixCacheStats()
+
+def record_prefix_cache_report(state: Dict[str, Any]) -> None:
+    """
+    Moves the consultation's prefix cache counts into state["metadata"].
+    """
+    if PROMPT_LAYOUT != "shared_prefix":
+        return
+    report = get_prefix_cache_stats().report(current_conversation_id())
+    if report:
+        state["metadata"] = {**(state.get("metadata") or {}), "prefix_cache": report}
+        print("Prefix cache ", report)
 
-Structure your analysis as follows:
-
-1. ALLERGY ASSESSMENT:
-- Allergic symptoms
-- Trigger patterns
-- Environmental factors
-- Seasonal variations
-- Impact on quality of life
-- Family history of allergies
-
-2. IMMUNE SYSTEM EVALUATION:
-- History of infections
-- Autoimmune manifestations
-- Immune response patterns
-- Vaccination history
-- Previous allergy testing
-
-3. DIFFERENTIAL DIAGNOSIS:
-- Type of allergic conditions
-- Non-allergic considerations
-- Immune system disorders
-- Cross-reactivity patterns
-- Secondary complications
-
-4. DIAGNOSTIC PLAN:
-- Skin testing requirements
-- Blood tests needed
-- Challenge testing considerations
-- Environmental assessment
-- Immunological workup
-
-5. TREATMENT STRATEGIES:
-- Immediate relief measures
-- Long-term management
-- Immunotherapy options
-- Environmental control
-- Emergency protocols
-
-6. PREVENTIVE PLAN:
-- Trigger avoidance strategies
-- Diet modifications
-- Environmental controls
-- Action plan for reactions
-- Follow-up schedule
-
-Focus on allergic conditions and immune system function."""
-
-   
-    full_response = "### Allergist's Assessment\n\n"
-    response_placeholder = st.empty()    
-
-    response_generator = generate_response(prompt.format(report=report), images)
-    #full_response = ""
-    for chunk in response_generator:
-        full_response += chunk
-        response_placeholder.markdown(full_response)
-    response_placeholder.empty()
-    state["agent_results"].append({"specialist": "Allergist", "analysis": full_response})
-    return state
+SECTION_HEADING = re.compile(r"(?m)^\s*(\d+)\.\s*([^:\n]+):\s*$")
 
-def endocrinologist_agent(state: Dict[str, Any]) -> Dict[str, Any]:
-    report = state["report"]
-    images = state.get("images")
-    prompt = """As an endocrinologist, provide a comprehensive hormonal assessment:
+def specialist_output_schema(name: str) -> Dict[str, Any]:
+    """
+    JSON Schema mirroring a specialist's numbered template: one list of points per section.
+    """
+    properties = {}
+    for number, heading in SECTION_HEADING.findall(load_specialist_prompt(name)):
+        key = re.sub(r"[^a-z0-9]+", "_", re.sub(r"\(.*?\)", "", heading).lower()).strip("_")
+        properties[key] = {"type": "array", "title": f"{number}. {heading.strip()}", "items": {"type": "string"}}
+    return {"type": "object", "properties": properties, "required": list(properties)}
 
-Medical Information:
-{report}
+def specialist_request(name: str, state: Dict[str, Any], record_prefix: bool = True):
+    """
+    Returns (prompt, max_tokens, prefix_chars) for a specialist's upstream call.
+    """
+    prompt, prefix_chars = assemble_prompt(load_specialist_prompt(name), state, record=record_prefix)
+    if OUTPUT_FORMAT == "json":
+        prompt = with_output_format(prompt, specialist_output_schema(name))
+    return prompt, SPECIALIST_REGISTRY[name].get("max_tokens", SPECIALIST_MAX_TOKENS), prefix_chars
 
-Structure your analysis as follows:
-
-1. ENDOCRINE ASSESSMENT:
-- Hormone-related symptoms
-- Metabolic status
-- Growth and development
-- Energy levels
-- Weight changes
-- Temperature regulation
-
-2. SYSTEM-SPECIFIC EVALUATION:
-- Thyroid function
-- Adrenal status
-- Glucose metabolism
-- Reproductive hormones
-- Calcium homeostasis
-- Pituitary function
-
-3. DIFFERENTIAL DIAGNOSIS:
-- Primary endocrine disorders
-- Secondary endocrine conditions
-- Metabolic complications
-- Related systemic diseases
-- Medication effects
-
-4. DIAGNOSTIC WORKUP:
-- Hormone level testing
-- Dynamic testing needs
-- Imaging requirements
-- Metabolic evaluation
-- Genetic testing considerations
-
-5. TREATMENT PLAN:
-- Hormone replacement needs
-- Metabolic management
-- Lifestyle modifications
-- Dietary adjustments
-- Medication recommendations
-
-6. MONITORING PROTOCOL:
-- Hormone level monitoring
-- Metabolic tracking
-- Complication surveillance
-- Follow-up schedule
-- Emergency protocols
-
-Focus on endocrine system function and metabolic health."""
+def specialist_output(name: str, heading: str) -> Optional[StructuredOutput]:
+    return StructuredOutput(specialist_output_schema(name), heading) if OUTPUT_FORMAT == "json" else None
 
-    
-    full_response = "### Endocrinologist's Assessment\n\n"
-    response_placeholder = st.empty()    
+def specialist_result(name: str, full_response: str, output: Optional[StructuredOutput]) -> Dict[str, Any]:
+    result = {"specialist": SPECIALIST_REGISTRY[name]["specialist"], "analysis": full_response}
+    if output is not None and output.structured is not None:
+        result["structured"] = output.structured
+    return result
 
-    response_generator = generate_response(prompt.format(report=report), images)
-    #full_response = ""
-    for chunk in response_generator:
-        full_response += chunk
-        response_placeholder.markdown(full_response)
-    response_placeholder.empty()
-    state["agent_results"].append({"specialist": "Endocrinologist", "analysis": full_response})
+def run_specialist_agent(name: str, state: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Generic specialist agent: streams the registry entry's prompt for this case
+    and appends the assessment to agent_results.
+    """
+    entry = SPECIALIST_REGISTRY[name]
+    prompt, max_tokens, prefix_chars = specialist_request(name, state)
+    # state["images"] stays the original upload so the shared prefix describes it identically
+    response_generator = generate_response(prompt, apply_image_policy(name, state.get("images")),
+                                           max_tokens=max_tokens, prefix_chars=prefix_chars)
+    heading = f"### {entry['title']}\n\n"
+    output = specialist_output(name, heading)
+    full_response = render_stream(response_generator, heading, renderer=output)
+    state["agent_results"].append(specialist_result(name, full_response, output))
     return state
 
-def dermatologist_agent(state: Dict[str, Any]) -> Dict[str, Any]:
-    report = state["report"]
-    images = state.get("images")
-    prompt = """As a dermatologist, provide a detailed skin assessment:
+def make_specialist_agent(name: str):
+    def agent(state: Dict[str, Any]) -> Dict[str, Any]:
+        return run_specialist_agent(name, state)
+    agent.__name__ = f"{name}_agent"
+    return agent
 
-Medical Information:
-{report}
 
-Structure your analysis as follows:
-
-1. SKIN ASSESSMENT:
-- Lesion characteristics
-- Distribution pattern
-- Color changes
-- Texture alterations
-- Associated symptoms
-- Skin appendage status
-
-2. SYMPTOM ANALYSIS:
-- Onset and progression
-- Triggering factors
-- Previous treatments
-- Impact on daily life
-- Associated conditions
-
-3. DIFFERENTIAL DIAGNOSIS:
-- Primary skin conditions
-- Secondary skin manifestations
-- Systemic diseases with cutaneous signs
-- Infectious considerations
-- Allergic reactions
-
-4. DIAGNOSTIC PLAN:
-- Skin examination findings
-- Biopsy requirements
-- Patch testing needs
-- Laboratory workup
-- Imaging considerations
-
-5. TREATMENT RECOMMENDATIONS:
-- Topical treatments
-- Systemic medications
-- Procedural interventions
-- Skincare routine
-- Preventive measures
-
-6. FOLLOW-UP PROTOCOL:
-- Monitoring schedule
-- Photography documentation
-- Skin protection strategy
-- Warning signs
-- Prevention plan
-
-Focus on skin, hair, nails, and related structures."""
-
-    #response = generate_response(prompt.format(report=report), images)
-    #st.subheader("Dermatologist's Assessment")
-    full_response = "### Dermatologist's Assessment\n\n"
-    response_placeholder = st.empty()    
-
-    response_generator = generate_response(prompt.format(report=report), images)
-    #full_response = ""
-    for chunk in response_generator:
-        full_response += chunk
-        response_placeholder.markdown(full_response)
-    response_placeholder.empty()
-    state["agent_results"].append({"specialist": "Dermatologist", "analysis": full_response})
-    return state
-
-def urologist_agent(state: Dict[str, Any]) -> Dict[str, Any]:
-    report = state["report"]
-    images = state.get("images")
-    prompt = """As a urologist, provide a comprehensive urological assessment:
+def specialist_mappings() -> Dict[str, List[str]]:
+    """
+    Referral aliases of every specialist the GP can refer to, from the current registry.
+    """
+    return {name: entry["aliases"] for name, entry in SPECIALIST_REGISTRY.items() if entry["aliases"]}
 
-Medical Information:
-{report}
+def build_referral_matcher(mappings: Dict[str, List[str]]):
+    """
+    Compiles every alias into one case-insensitive alternation, tried once at each
+    word boundary. Returns (pattern, implied) where implied maps a lower-cased alias
+    to every specialist it stands for, including those of shorter aliases it contains
+    (so "interventional cardiologist" also refers to the cardiologist, as the
+    per-alias search did).
+    """
+    aliases: Dict[str, Set[str]] = {}
+    for name, variations in mappings.items():
+        for variant in variations:
+            aliases.setdefault(variant.lower(), set()).add(name)
+
+    # Longest first so each boundary reports its longest alias
+    alternation = "|".join(re.escape(alias) for alias in sorted(aliases, key=len, reverse=True))
+    pattern = re.compile(rf"\b(?=({alternation})\b)", re.IGNORECASE)
+
+    implied = {}
+    for alias in aliases:
+        names = set()
+        for other, other_names in aliases.items():
+            if re.search(rf"\b{re.escape(other)}\b", alias):
+                names |= other_names
+        implied[alias] = frozenset(names)
+    return pattern, implied
+
+_referral_matcher: Dict[str, Any] = {"aliases": None, "matcher": None}
+
+def referral_matcher():
+    """
+    Returns (mappings, pattern, implied) for the current registry, compiled again
+    only when a registry change touches the aliases.
+    """
+    mappings = specialist_mappings()
+    aliases = tuple((name, tuple(variations)) for name, variations in mappings.items())
+    cached = _referral_matcher
+    if cached["aliases"] != aliases:
+        cached["matcher"] = (mappings, *build_referral_matcher(mappings))
+        cached["aliases"] = aliases
+    return cached["matcher"]
+
+def iter_referral_matches(text: str, matcher=None):
+    """
+    Yields (specialist, alias, position) for every alias mention in text, in one pass.
+    """
+    _, pattern, implied = matcher or referral_matcher()
+    for match in pattern.finditer(text):
+        alias = match.group(1).lower()
+        for name in sorted(implied[alias]):
+            yield name, alias, match.start()
 
-Structure your analysis as follows:
-
-1. UROLOGICAL ASSESSMENT:
-- Urinary symptoms
-- Sexual health concerns
-- Prostate status (if male)
-- Pelvic symptoms
-- Pain evaluation
-- Related systemic symptoms
-
-2. FUNCTIONAL EVALUATION:
-- Voiding patterns
-- Continence status
-- Sexual function
-- Pelvic floor status
-- Quality of life impact
-
-3. DIFFERENTIAL DIAGNOSIS:
-- Urological conditions
-- Anatomical considerations
-- Functional disorders
-- Oncological concerns
-- Systemic disease impact
-
-4. DIAGNOSTIC PLAN:
-- Urinalysis needs
-- Imaging studies
-- Functional testing
-- Cystoscopy considerations
-- Laboratory workup
-
-5. TREATMENT RECOMMENDATIONS:
-- Medical management
-- Surgical options
-- Behavioral modifications
-- Pelvic floor therapy
-- Lifestyle changes
-
-6. FOLLOW-UP PROTOCOL:
-- Monitoring schedule
-- PSA tracking (if male)
-- Symptom diary needs
-- Warning signs
-- Prevention strategy
-
-Focus on urological system and related functions."""
-
-    #response = generate_response(prompt.format(report=report), images)
-    #st.subheader("Urologist's Assessment")
-    full_response = "### Urologist's Assessment\n\n"
-    response_placeholder = st.empty()    
-
-    response_generator = generate_response(prompt.format(report=report), images)
-    #full_response = ""
-    for chunk in response_generator:
-        full_response += chunk
-        response_placeholder.markdown(full_response)
-    response_placeholder.empty()
-    state["agent_results"].append({"specialist": "Urologist", "analysis": full_response})
-    return state
+def match_referrals(text: str, matcher=None) -> Set[str]:
+    """
+    Returns the specialists whose aliases are mentioned in text.
+    """
+    return {name for name, _, _ in iter_referral_matches(text, matcher)}
+
+def _match_referrals_per_alias(text: str) -> Set[str]:
+    # The original detection loop, kept as the benchmark baseline
+    found = set()
+    for standard_name, variations in specialist_mappings().items():
+        for variant in variations:
+            if re.search(rf"\b{re.escape(variant)}\b", text, re.IGNORECASE):
+                found.add(standard_name)
+    return found
+
+def benchmark_referral_matcher(texts: Optional[List[str]] = None, rounds: int = 200) -> Dict[str, Any]:
+    """
+    Times the compiled matcher against the per-alias loop over the same texts and
+    checks that both find the same specialists.
+    """
+    if texts is None:
+        texts = [gp_prompt_template().lower(), "required specialists:\n- cardiologist\n- interventional cardiologist\n- dentist\n"]
+    matcher = referral_matcher()
+    compiled = functools.partial(match_referrals, matcher=matcher)
+    if any(compiled(text) != _match_referrals_per_alias(text) for text in texts):
+        raise AssertionError("Compiled referral matcher disagrees with the per-alias search")
+    timings = {}
+    for label, search in (("per_alias", _match_referrals_per_alias), ("compiled", compiled)):
+        started = time.perf_counter()
+        for _ in range(rounds):
+            for text in texts:
+                search(text)
+        timings[label] = (time.perf_counter() - started) / (rounds * len(texts)) * 1e6
+    return {"per_alias_us": timings["per_alias"], "compiled_us": timings["compiled"],
+            "speedup": timings["per_alias"] / timings["compiled"]}
+
+# Referral budget: the GP is asked for its top 3; 0 keeps every detected specialist
+MAX_REFERRALS = int(os.environ.get("AGENTDX_MAX_REFERRALS", "3"))
+LIST_ITEM = re.compile(r"^\s*(?:[-*\u2022]|\d+[.)])\s*")
+# Aliases naming a role rather than an organ or symptom ("heart", "oral", "neuro")
+ROLE_ALIAS = re.compile(r"(?:ist|ian|surgeon|specialist)\b")
+
+def _referral_tier(name: str, alias: str, listed: bool, in_section: bool, contained: bool,
+                   mappings: Dict[str, List[str]]) -> int:
+    """
+    Lower is stronger: a role alias on a list line of the REQUIRED SPECIALISTS section
+    ranks first; loose aliases, aliases inside a longer one ("cardiologist" in
+    "interventional cardiologist"), prose mentions and mentions outside the section rank lower.
+    """
+    direct = not contained and alias in (variant.lower() for variant in mappings[name])
+    strong = direct and (ROLE_ALIAS.search(alias) is not None or alias.replace(" ", "_") == name)
+    return (0 if listed else 2) + (0 if strong else 1) + (0 if in_section else 4)
 
-def hepatologist_agent(state: Dict[str, Any]) -> Dict[str, Any]:
-    report = state["report"]
-    images = state.get("images")
-    prompt = """As a hepatologist, provide a detailed liver assessment:
+def rank_referrals(full_response: str) -> List[Dict[str, Any]]:
+    """
+    Returns every referred specialist, best first, with the alias that triggered it.
+    Candidates are ranked by tier and then by where the GP listed them.
+    """
+    response_lower = full_response.lower()
+    match = re.search(r"required specialists:.*?(?=\n---|\Z)", response_lower, re.DOTALL | re.IGNORECASE)
+    if match:
+        specialist_section = match.group(0)
+        print("Extracted specialist section:", specialist_section)
+    else:
+        specialist_section = response_lower
+        print("Failed to extract specialist section, using full response")
+
+    matcher = referral_matcher()
+    best: Dict[str, Any] = {}
+    for line_number, line in enumerate(specialist_section.split("\n")):
+        listed = LIST_ITEM.match(line) is not None
+        covered_until, last_position, contained = -1, -1, False
+        for name, alias, position in iter_referral_matches(line, matcher):
+            if position != last_position:
+                contained = position + len(alias) <= covered_until
+                covered_until, last_position = max(covered_until, position + len(alias)), position
+            rank = (_referral_tier(name, alias, listed, match is not None, contained, matcher[0]),
+                    line_number, position)
+            if name not in best or rank < best[name]["rank"]:
+                best[name] = {"specialist": name, "alias": alias, "rank": rank}
+    return [{"specialist": candidate["specialist"], "alias": candidate["alias"], "tier": candidate["rank"][0]}
+            for candidate in sorted(best.values(), key=lambda candidate: candidate["rank"])]
+
+def detect_required_specialists(full_response: str, images=None, max_referrals: int = MAX_REFERRALS) -> List[str]:
+    """
+    Extracts the specialists referred to in a GP response, keeping at most
+    max_referrals of the best-ranked candidates (plus the radiologist for images).
+    """
+    required_specialists = set()
 
-Medical Information:
-{report}
+    try:
+        ranked = rank_referrals(full_response)
+        kept = ranked[:max_referrals] if max_referrals else ranked
+        for candidate in ranked:
+            outcome = "Referral" if candidate in kept else "Dropped referral (over budget)"
+            print(f"{outcome}: {candidate['specialist']} via '{candidate['alias']}' (tier {candidate['tier']})")
+        required_specialists.update(candidate["specialist"] for candidate in kept)
 
-Structure your analysis as follows:
-
-1. LIVER ASSESSMENT:
-- Liver-related symptoms
-- Portal system status
-- Metabolic factors
-- Nutritional status
-- Associated symptoms
-- Risk factors present
-
-2. SYSTEMIC EVALUATION:
-- Hepatic manifestations
-- Extra-hepatic signs
-- Complications present
-- Impact on other systems
-- Quality of life effects
-
-3. DIFFERENTIAL DIAGNOSIS:
-- Primary liver conditions
-- Secondary liver involvement
-- Metabolic liver disease
-- Vascular disorders
-- Systemic conditions
-
-4. DIAGNOSTIC WORKUP:
-- Liver function tests
-- Imaging requirements
-- Fibroscan needs
-- Biopsy considerations
-- Additional testing
-
-5. TREATMENT PLAN:
-- Immediate interventions
-- Long-term management
-- Nutritional support
-- Medication adjustments
-- Lifestyle modifications
-
-6. MONITORING PROTOCOL:
-- Lab monitoring schedule
-- Imaging follow-up
-- Complication surveillance
-- Warning signs
-- Prevention strategies
-
-Focus on liver function and related systems."""
-
-    #response = generate_response(prompt.format(report=report), images)
-    #st.subheader("Hepatologist's Assessment")
-    full_response = "### Hepatologist's Assessment\n\n"
-    response_placeholder = st.empty()    
-
-    response_generator = generate_response(prompt.format(report=report), images)
-    #full_response = ""
-    for chunk in response_generator:
-        full_response += chunk
-        response_placeholder.markdown(full_response)
-    response_placeholder.empty()
-    state["agent_results"].append({"specialist": "Hepatologist", "analysis": full_response})
-    return state
+        # Always include radiologist if imaging is provided; it does not count against the budget
+        if images:
+            required_specialists.add("radiologist")
 
-def dietician_agent(state: Dict[str, Any]) -> Dict[str, Any]:
-    report = state["report"]
-    images = state.get("images")
-    prompt = """As a dietitian, provide a comprehensive nutritional assessment:
+    except Exception as e:
+        print(f"Error in specialist detection: {str(e)}")
 
-Medical Information:
-{report}
+    # Stable order keeps downstream prompts (and their cache keys) identical across runs
+    return sorted(required_specialists)
 
-Structure your analysis as follows:
-
-1. NUTRITIONAL ASSESSMENT:
-- Current dietary patterns
-- Nutritional status
-- Weight history
-- Eating behaviors
-- Dietary restrictions
-- Nutritional deficiencies
-
-2. METABOLIC EVALUATION:
-- Energy requirements
-- Macro/micronutrient needs
-- Hydration status
-- Metabolic conditions
-- Impact of medications
-
-3. DIETARY ANALYSIS:
-- Current diet composition
-- Eating patterns
-- Food allergies/intolerances
-- Cultural considerations
-- Lifestyle factors
-
-4. NUTRITIONAL DIAGNOSIS:
-- Nutritional deficiencies
-- Dietary imbalances
-- Eating patterns
-- Related medical conditions
-- Lifestyle impact
-
-5. INTERVENTION PLAN:
-- Dietary modifications
-- Meal planning
-- Supplement recommendations
-- Behavior modification
-- Educational needs
-
-6. MONITORING PROTOCOL:
-- Weight tracking
-- Dietary compliance
-- Nutrient monitoring
-- Progress evaluation
-- Follow-up schedule
-
-Focus on nutritional status and dietary management."""
-
-    #response = generate_response(prompt.format(report=report), images)
-    #st.subheader("Dietician's Assessment")
-    full_response = "### Dietician's Assessment\n\n"
-    response_placeholder = st.empty()    
-
-    response_generator = generate_response(prompt.format(report=report), images)
-    #full_response = ""
-    for chunk in response_generator:
-        full_response += chunk
-        response_placeholder.markdown(full_response)
-    response_placeholder.empty()
-    state["agent_results"].append({"specialist": "Dietician", "analysis": full_response})
-    return state
+REFERRAL_URGENCIES = ("emergency", "urgent", "routine")
 
-def gp_agent(state: Dict[str, Any]) -> Dict[str, Any]:
+def structured_referrals(structured: Dict[str, Any], images=None, max_referrals: int = MAX_REFERRALS) -> List[str]:
+    """
+    Reads the referrals from a validated structured GP response: most urgent first,
+    then in the GP's order, capped at max_referrals (plus the radiologist for images).
+    """
+    ranked = sorted(enumerate(structured.get("required_specialists", [])),
+                    key=lambda item: (REFERRAL_URGENCIES.index(item[1]["urgency"]), item[0]))
+    names = list(dict.fromkeys(referral["specialist"] for _, referral in ranked))
+    kept = names[:max_referrals] if max_referrals else names
+    for _, referral in ranked:
+        outcome = "Referral" if referral["specialist"] in kept else "Dropped referral (over budget)"
+        print(f"{outcome}: {referral['specialist']} via structured output ({referral['urgency']})")
+    required_specialists = set(kept)
+    if images:
+        required_specialists.add("radiologist")
+    return sorted(required_specialists)
+
+def _speculative_request(name: str, state: Dict[str, Any]):
+    """
+    The request a specialist's node will send, as (prompt, images, max_tokens,
+    prefix_chars, cache_key), or None when the response cache already answers it.
+    """
+    images = apply_image_policy(name, state.get("images"))
+    prompt, max_tokens, prefix_chars = specialist_request(name, state, record_prefix=False)
+    cache_key = response_cache_key(prompt, images, max_tokens)
+    if RESPONSE_CACHE_ENABLED and get_response_cache().get(cache_key) is not None:
+        return None
+    return prompt, images, max_tokens, prefix_chars, cache_key
+
+def launch_specialist(name: str, state: Dict[str, Any]) -> bool:
+    """
+    Starts a specialist's upstream call ahead of its graph node. The node later sends
+    the identical request and picks up this stream through the single-flight registry.
+    """
+    request = _speculative_request(name, state)
+    if request is None:
+        return False
+    prompt, images, max_tokens, prefix_chars, cache_key = request
+    session = get_http_session()
+    conversation = current_conversation_id()
+    launched = get_single_flight().launch(
+        cache_key, lambda: _stream_upstream(prompt, images, session, cache_key, conversation, max_tokens, prefix_chars),
+        SPECULATIVE_RETAIN_SECONDS)
+    if launched:
+        print(f"Launched {name} while the GP is still responding")
+    return launched
+
+def alaunch_specialist(name: str, state: Dict[str, Any]) -> bool:
     """
-    GP agent analyzes medical history and determines which specialists to consult based on LLM output.
-    Now with improved parsing and robust specialist detection.
+    launch_specialist for the async graph: the stream runs as a task on the running
+    event loop, so speculation does not start a thread per specialist.
     """
-    report = state["report"]
-    images = state.get("images")
-    prompt ="""
+    request = _speculative_request(name, state)
+    if request is None:
+        return False
+    prompt, images, max_tokens, prefix_chars, cache_key = request
+    client = get_async_http_client()
+    conversation = current_conversation_id()
+    launched = get_async_single_flight().launch(
+        cache_key, lambda: _astream_upstream(prompt, images, client, cache_key, conversation, max_tokens, prefix_chars),
+        SPECULATIVE_RETAIN_SECONDS)
+    if launched:
+        print(f"Launched {name} while the GP is still responding")
+    return launched
+
+class ReferralWatcher:
+    """
+    Follows the GP stream and launches the referred specialists as soon as the
+    REQUIRED SPECIALISTS block is closed, instead of after the whole response.
+    launch is launch_specialist, or alaunch_specialist when fed on an event loop.
+    """
+    def __init__(self, state: Dict[str, Any], launch=launch_specialist):
+        self.state = state
+        self.launch = launch
+        self.text = ""
+        self.launched: Set[str] = set()
+        self._section_start = -1
+        self._closed = not SPECULATIVE_SPECIALISTS
+        if SPECULATIVE_SPECIALISTS and SPECULATE_RADIOLOGIST and state.get("images"):
+            # detect_required_specialists always adds the radiologist when there is an image
+            self._launch(["radiologist"])
+
+    def watch(self, response_generator):
+        for chunk in response_generator:
+            self.feed(chunk)
+            yield chunk
+
+    def feed(self, chunk: str) -> None:
+        if self._closed:
+            return
+        self.text += chunk
+        if self._section_start < 0:
+            self._section_start = self.text.lower().find("required specialists:")
+            if self._section_start < 0:
+                return
+        if "\n---" not in self.text[self._section_start:]:
+            return
+        self._closed = True
+        required_specialists = detect_required_specialists(self.text, self.state.get("images"))
+        # Batched specialists are sent together by their own node
+        self._launch(plan_specialist_batches(required_specialists)[1])
+
+    def structured_section(self, key: str, value, valid: bool) -> None:
+        """
+        StructuredOutput callback: the referral list is known once its section validates.
+        """
+        if key != "required_specialists" or not valid or not SPECULATIVE_SPECIALISTS:
+            return
+        self._closed = True
+        required_specialists = structured_referrals({key: value}, self.state.get("images"))
+        self._launch(plan_specialist_batches(required_specialists)[1])
+
+    def _launch(self, names: List[str]) -> None:
+        for name in names:
+            if name not in self.launched and name in SPECIALIST_REGISTRY:
+                self.launched.add(name)
+                self.launch(name, self.state)
+
+GP_PROMPT = """
 You are a General Practitioner (GP) conducting a comprehensive patient assessment. Your task is to synthesize the provided medical history, current symptoms, and imaging findings (if available) to deliver structured clinical recommendations. You must prioritize clinically relevant specialist referrals based on the following hierarchy:
 1. **Symptoms**: Determine the initial specialist(s) based on the patient's chief complaints and active symptoms.
 2. **Medical History**: Identify additional specialists based on pre-existing conditions, chronic diseases, or risk factors.
@@ -1594,15 +2277,7 @@ Respond EXACTLY in this format:
 
 #### **REQUIRED SPECIALISTS:**
 [List ONLY THE TOP 3 MOST CRITICAL SPECIALISTS using EXACTLY these specializations ]  
-- gynecologist																		- oncologist            - psychiatrist
-- pain_management															- gastroenterologist    - rheumatologist  
-- psychologist																		- dentist               - orthopaedician  
-- opthamologist																	- cardiologist          - neurologist  
-- nephrologist																		- pulmonologist         - ent  
-- allergist																					- endocrinologist       - dermatologist  
-- urologist																					- hepatologist          - dietician  
-- neurosurgeon																		- radiation_oncologist  
-- interventional_cardiologist
+{specialists}
 
 If no specialists needed: REQUIRED SPECIALISTS: none  
 
@@ -1614,101 +2289,255 @@ For EACH specialist:
 - Active symptom(s) needing their expertise.  
 - Imaging finding(s) requiring review (if applicable).  
 - Expected clinical outcome from consultation.  
-    """    
-    # Initialize full response
-    #print("\n***GP's Initial Assessment***:")
-    response_placeholder = st.empty()    
-    #response_placeholder.subheader("General Practitioner's Initial Assessment")
+    """
+
+def gp_prompt_template() -> str:
+    """
+    GP_PROMPT listing every specialist of the current registry the GP can refer to.
+    """
+    return GP_PROMPT.replace("{specialists}", "\n".join(f"- {name}" for name in specialist_mappings()))
+
+def _string_list(title: str) -> Dict[str, Any]:
+    return {"type": "array", "title": title, "items": {"type": "string"}}
 
+def gp_output_schema() -> Dict[str, Any]:
+    """
+    JSON schema of a structured GP response; referrals are limited to the current registry.
+    """
+    return {
+        "type": "object",
+        "properties": {
+            "initial_assessment": {
+                "type": "object",
+                "title": "INITIAL ASSESSMENT",
+                "properties": {
+                    "chief_complaints": _string_list("1. Chief Complaints"),
+                    "vital_signs_and_examination": _string_list("2. Vital Signs & Physical Examination"),
+                    "medical_history_analysis": _string_list("3. Medical History Analysis"),
+                    "imaging_analysis": _string_list("4. Imaging Analysis"),
+                    "initial_diagnosis": _string_list("5. Initial Diagnosis"),
+                    "immediate_actions": _string_list("6. Immediate Actions"),
+                    "initial_management_plan": _string_list("7. Initial Management Plan"),
+                },
+                "required": ["chief_complaints", "medical_history_analysis", "initial_diagnosis",
+                             "immediate_actions", "initial_management_plan"],
+            },
+            "required_specialists": {
+                "type": "array",
+                "title": "REQUIRED SPECIALISTS",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "specialist": {"type": "string", "enum": list(SPECIALIST_REGISTRY)},
+                        "urgency": {"type": "string", "enum": list(REFERRAL_URGENCIES)},
+                        "justification": {"type": "string"},
+                    },
+                    "required": ["specialist", "urgency", "justification"],
+                },
+            },
+        },
+        "required": ["initial_assessment", "required_specialists"],
+    }
+
+def gp_request(state: Dict[str, Any]):
+    """
+    Returns (prompt, prefix_chars) for the GP's upstream call.
+    """
+    prompt, prefix_chars = assemble_prompt(gp_prompt_template(), state)
+    return with_output_format(prompt, gp_output_schema()), prefix_chars
+
+def gp_referrals(full_response: str, output: Optional[StructuredOutput], images=None) -> List[str]:
+    # A validated structured response lists the referrals directly; anything else is parsed as text
+    if output is not None and output.structured is not None:
+        return structured_referrals(output.structured, images)
+    return detect_required_specialists(full_response, images)
+
+def gp_agent(state: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    GP agent analyzes medical history and determines which specialists to consult based on LLM output.
+    Now with improved parsing and robust specialist detection.
+    """
+    images = state.get("images")
+    prompt, prefix_chars = gp_request(state)
+    heading = "### General Practitioner's Initial Assessment\n\n"
     # Get streaming response and accumulate it
-    response_generator = generate_response(prompt.format(report=report), images)
-    full_response = "### General Practitioner's Initial Assessment\n\n"
-    for chunk in response_generator:
-        full_response += chunk
-        response_placeholder.markdown(full_response)
-    #    #print(chunk, end='', flush=True)
-    #    yield chunk
-    response_placeholder.empty()
+    response_generator = generate_response(prompt, apply_image_policy("gp", images), prefix_chars=prefix_chars)
+    # Referred specialists start as soon as the GP has named them
+    watcher = ReferralWatcher(state)
+    response_generator = watcher.watch(response_generator)
+    output = StructuredOutput(gp_output_schema(), heading, watcher.structured_section) if OUTPUT_FORMAT == "json" else None
+    full_response = render_stream(response_generator, heading, renderer=output)
     # Store GP's analysis
-    state["agent_results"].append({
+    gp_result = {
         "specialist": "General Practitioner",
         "analysis": full_response
-    })
-    print("GP Agent Full response ",full_response)
-    # Specialist name mappings for detection
-    # "radiologist": ["radiologist", "radiological", "radiology"],
-    specialist_mappings = {
-        "gynecologist": ["gynecologist", "gynaecologist", "ob-gyn", "menstrual cramp"],
-        "oncologist": ["oncologist"],
-        "pain_management": ["pain management", "pain specialist"],
-        "gastroenterologist": ["gastroenterologist", "gastrointestinal specialist", "gi specialist", "abdominal cramp", "stomach cramp"],
-        "rheumatologist": ["rheumatologist"],
-        "psychologist": ["psychologist"],
-        "dentist": ["dentist","oral"],
-        "orthopaedician": ["orthopaedician", "orthopedician", "muscle cramp", "leg cramp"],
-        "opthamologist": ["opthamologist", "ophthalmologist"],
-        "cardiologist": ["cardiologist", "cardiac specialist", "cardio","heart","chest"],
-        "neurologist": ["neurologist","neuro"],
-        "nephrologist": ["nephrologist", "kidney specialist", "nephro"],
-        "pulmonologist": ["pulmonologist"],
-        "ent": ["ent specialist", "ear nose throat specialist", "ear nose and throat", "otolaryngologist"],
-        "allergist": ["allergist"],
-        "endocrinologist": ["endocrinologist"],
-        "dermatologist": ["dermatologist"],
-        "urologist": ["urologist"],
-        "hepatologist": ["hepatologist"],
-        "dietician": ["dietician", "dietitian", "nutritionist","food specialist"],
-        "neurosurgeon": ["neurosurgeon","neuro surgeon"],
-        "radiation_oncologist":["radiation oncologist"],  
-        "psychiatrist": ["psychiatrist"],
-        "interventional_cardiologist":["interventional cardiologist","interventional_cardiologist"]
     }
-
-    try:
-        # Extract the REQUIRED SPECIALISTS section using regex
-        response_lower = full_response.lower()
-
-        # Extract the REQUIRED SPECIALISTS section using regex
-        match = re.search(r"required specialists:.*?(?=\n---|\Z)", response_lower, re.DOTALL | re.IGNORECASE)
-        if match:
-              specialist_section = match.group(0)
-              print("Extracted specialist section:", specialist_section) 
-        else:
-              specialist_section = response_lower
-              print("Failed to extract specialist section, using full response")
-
-        # Extract specialists from the section
-        required_specialists = set()
-        for standard_name, variations in specialist_mappings.items():
-              for variant in variations:
-                  # Use word boundaries to ensure exact matches
-                  if re.search(rf"\b{re.escape(variant)}\b", specialist_section,re.IGNORECASE):
-                        required_specialists.add(standard_name)
-
-								# Always include radiologist if imaging is provided
-        if images:  # Assuming `images` is a boolean indicating whether imaging was provided
-              required_specialists.add("radiologist")
-
-    except Exception as e:
-								print(f"Error in specialist detection: {str(e)}")
+    if output is not None and output.structured is not None:
+        gp_result["structured"] = output.structured
+    state["agent_results"].append(gp_result)
+    print("GP Agent Full response ",full_response)
+    required_specialists = gp_referrals(full_response, output, images)
 
     # Store detected specialists
     print("GP Identified Specialists ",required_specialists)
-    state["required_specialists"] = list(required_specialists)
+    state["required_specialists"] = required_specialists
     #print("GP State ",state)
     #return specialist_agent(state, "General Physician", prompt_template)
     return state
 
-def summarize_findings(state: Dict[str, Any]) -> Dict[str, Any]:
+# Summarizer input compaction: only the decision-relevant sections of each report are sent
+SUMMARY_COMPACTION = os.environ.get("AGENTDX_SUMMARY_COMPACTION", "1") == "1"
+SUMMARY_TOKEN_BUDGET = int(os.environ.get("AGENTDX_SUMMARY_TOKEN_BUDGET", "1500"))
+
+# Checked in order, so "DIAGNOSTIC PLAN" is a test section and "RECOMMENDED TESTS" is not treatment
+SUMMARY_SECTION_CATEGORIES = (
+    ("follow_up", ("follow-up", "follow up", "monitoring", "next steps", "preventive")),
+    ("tests", ("test", "workup", "work-up", "diagnostic plan", "investigation", "diagnostics")),
+    ("diagnosis", ("diagnos", "interpretation", "conclusion", "impression")),
+    ("treatment", ("treatment", "management", "intervention", "therapeutic", "recommendation", "action",
+                   "rehabilitation", "lifestyle", "care plan")),
+    ("findings", ("finding", "complaint", "assessment", "history", "evaluation", "analysis", "symptom",
+                  "correlation")),
+)
+SUMMARY_CATEGORY_TITLES = {"findings": "Findings", "diagnosis": "Diagnosis", "treatment": "Treatment",
+                           "follow_up": "Follow-up"}
+# Trimmed first when over budget
+SUMMARY_TRIM_ORDER = ("findings", "follow_up", "tests", "treatment", "diagnosis")
+
+def estimate_tokens(text: str) -> int:
+    # Roughly four characters per token for English clinical text
+    return (len(text) + 3) // 4
+
+def summary_section_category(title: str) -> Optional[str]:
+    title = title.lower().replace("_", " ")
+    for category, keywords in SUMMARY_SECTION_CATEGORIES:
+        if any(keyword in title for keyword in keywords):
+            return category
+    return None
+
+def _clean_item(line: str) -> str:
+    return re.sub(r"^(?:[-*•]|\d+[.)])\s*", "", line.strip()).replace("**", "").strip()
+
+def extract_report_sections(analysis: str, structured: Optional[Dict[str, Any]] = None) -> Dict[str, List[str]]:
     """
-    Summarize findings from all agents into a consolidated report.
+    Pulls the findings, diagnosis, tests, treatment and follow-up points out of one
+    agent report, from its structured form when there is one, else from its markdown.
     """
-    images = state.get("images")
-    report = state["report"]
-    combined_analysis = "\n".join([f"{result['specialist']}: {result['analysis']}" 
-                                 for result in state["agent_results"]])
+    sections: Dict[str, List[str]] = {}
+    if structured is not None:
+        pending = list(structured.items())
+        while pending:
+            key, value = pending.pop(0)
+            if isinstance(value, dict):
+                pending[:0] = value.items()
+                continue
+            category = summary_section_category(key)
+            if category and key != "required_specialists":
+                items = value if isinstance(value, list) else [value]
+                sections.setdefault(category, []).extend(str(item) for item in items if str(item).strip())
+        return sections
+
+    category = None
+    for line in analysis.splitlines():
+        stripped = line.strip()
+        if not stripped or stripped == "---":
+            continue
+        bare = stripped.replace("*", "").strip()
+        if stripped.startswith("#") or (bare.endswith(":") and len(bare) < 60 and not stripped.startswith("-")):
+            category = summary_section_category(bare.lstrip("#").strip())
+            continue
+        if category:
+            item = _clean_item(stripped)
+            if item:
+                sections.setdefault(category, []).append(item)
+    return sections
+
+def _normalize_item(item: str) -> str:
+    return " ".join(re.sub(r"[^a-z0-9 ]+", " ", item.lower()).split())
+
+def compact_agent_results(agent_results: List[Dict[str, Any]], token_budget: int = SUMMARY_TOKEN_BUDGET):
+    """
+    Builds the summarizer's view of the agent reports: the decision-relevant sections of
+    each report, recommended tests merged across specialists, trimmed to token_budget.
+    Returns (text, stats) where stats records the token reduction.
+    """
+    full_text = "\n".join(f"{result['specialist']}: {result['analysis']}" for result in agent_results)
+
+    # GP first, then specialists by name, so the text does not depend on completion order
+    ordered = sorted(agent_results, key=lambda result: (result["specialist"] != "General Practitioner",
+                                                         result["specialist"]))
+    reports: List[Any] = []
+    tests: Dict[str, Any] = {}
+    for result in ordered:
+        sections = extract_report_sections(result["analysis"], result.get("structured"))
+        if not sections:
+            # Nothing recognisable; keep the report as findings so it is not lost
+            sections = {"findings": [_clean_item(line) for line in result["analysis"].splitlines()[1:]
+                                     if _clean_item(line)]}
+        for test in sections.pop("tests", []):
+            merged = tests.setdefault(_normalize_item(test), {"test": test, "specialists": []})
+            if result["specialist"] not in merged["specialists"]:
+                merged["specialists"].append(result["specialist"])
+        for category, items in sections.items():
+            sections[category] = list({_normalize_item(item): item for item in items}.values())
+        reports.append((result["specialist"], sections))
+
+    def render() -> str:
+        parts = []
+        if tests:
+            parts.append("Recommended tests (merged across specialists):\n" + "\n".join(
+                f"- {merged['test']} [{', '.join(merged['specialists'])}]" for merged in tests.values()))
+        for specialist, sections in reports:
+            lines = [f"{specialist}:"]
+            for category, title in SUMMARY_CATEGORY_TITLES.items():
+                if sections.get(category):
+                    lines.append(f"  {title}: " + "; ".join(sections[category]))
+            parts.append("\n".join(lines))
+        return "\n\n".join(parts)
+
+    text = render()
+    for category in SUMMARY_TRIM_ORDER:
+        while estimate_tokens(text) > token_budget:
+            if category == "tests":
+                if not tests:
+                    break
+                tests.pop(next(reversed(tests)))
+            else:
+                # Shorten whichever report says the most in this category
+                longest = max((sections.get(category, []) for _, sections in reports), key=len, default=[])
+                if not longest:
+                    break
+                longest.pop()
+            text = render()
+
+    stats = {"tokens_before": estimate_tokens(full_text), "tokens_after": estimate_tokens(text)}
+    stats["reduction"] = 1 - stats["tokens_after"] / stats["tokens_before"] if stats["tokens_before"] else 0.0
+    return text, stats
+
+def summary_input(state: Dict[str, Any]):
+    """
+    Returns (combined_analysis, stats) for the summarizer prompt; stats is None
+    when compaction is off.
+    """
+    if not SUMMARY_COMPACTION:
+        return "\n".join([f"{result['specialist']}: {result['analysis']}" for result in state["agent_results"]]), None
+    combined_analysis, stats = compact_agent_results(state["agent_results"])
+    print(f"Summarizer input compacted from {stats['tokens_before']} to {stats['tokens_after']} tokens "
+          f"({stats['reduction']:.0%} less)")
+    return combined_analysis, stats
+
+def record_summary_compaction(state: Dict[str, Any], stats: Optional[Dict[str, Any]]) -> None:
+    if stats:
+        state["metadata"] = {**(state.get("metadata") or {}), "summary_compaction": stats}
+
+def build_summary_prompt(state: Dict[str, Any], combined_analysis: Optional[str] = None) -> str:
+    """
+    Builds the summarizer prompt from every agent result collected so far.
+    """
+    if combined_analysis is None:
+        combined_analysis = summary_input(state)[0]
     #prompt = f"SUMMARIZE the following specialist analysis into a comprehensive professional medical report in not more than 500 words:\n{combined_analysis}"
-    prompt = f"""
+    return f"""
 You are a highly skilled medical analyst. Your task is to synthesize the following multi-specialist assessments into a **comprehensive, structured, and professional medical report** in no more than 500 words. 
 
 ### **Patient Case Summary**
@@ -1743,22 +2572,290 @@ Your response should follow this format:
    - Follow-up plan and required specialist consultations.  
 
 Ensure your summary is **concise, evidence-based, and actionable** with **no unnecessary repetition**.  
-    """  
+    """
 
-    #summary = generate_response(prompt,images)
-    #st.subheader("FINAL ASSESSMENT REPORT (Summary)")
-    response_placeholder = st.empty()    
+def summarize_findings(state: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Summarize findings from all agents into a consolidated report.
+    """
+    images = apply_image_policy("summarizer", state.get("images"))
+    combined_analysis, compaction = summary_input(state)
+    prompt = build_summary_prompt(state, combined_analysis)
 
-    response_generator = generate_response(prompt.format(report=report), images)
-    #full_response = ""
-    full_response = "### FINAL ASSESSMENT REPORT (Summary)\n\n"
-    for chunk in response_generator:
-        full_response += chunk
-        response_placeholder.markdown(full_response)
-    response_placeholder.empty()
+    response_generator = generate_response(prompt, images)
+    full_response = render_stream(response_generator, "### FINAL ASSESSMENT REPORT (Summary)\n\n")
+    state["final_report"] = full_response
+    state["summary_input"] = combined_analysis
+    record_summary_compaction(state, compaction)
+    record_prefix_cache_report(state)
+    return state
+
+SUMMARY_VERSIONS_KEPT = int(os.environ.get("AGENTDX_SUMMARY_VERSIONS", "5"))
+
+def regenerate_summary(state: Dict[str, Any], placeholder=None) -> bool:
+    """
+    Writes a fresh summary for a finished consultation without re-running the graph:
+    reuses the stored compacted summarizer input and the session's images, streams into
+    placeholder (the summary tab) and keeps the replaced summary in state["summary_versions"].
+    Returns False (keeping the current summary) if the upstream call failed.
+    """
+    heading = "### FINAL ASSESSMENT REPORT (Summary)\n\n"
+    combined_analysis = state.get("summary_input") or summary_input(state)[0]
+    prompt = build_summary_prompt(state, combined_analysis)
+    images = apply_image_policy("summarizer", state.get("images"))
+
+    token = _conversation_id.set(state.get("conversation_id") or None)
+    try:
+        full_response = render_stream(generate_response(prompt, images, refresh=True), heading, clear=False,
+                                      renderer=AgentStream(heading, StreamlitSink(placeholder)))
+    finally:
+        _conversation_id.reset(token)
+    if full_response[len(heading):].startswith("Error:"):
+        st.error(full_response[len(heading):])
+        return False
+
+    versions = state.setdefault("summary_versions", [])
+    if state.get("final_report"):
+        versions.append({"summary": state["final_report"], "replaced_at": time.strftime("%H:%M:%S")})
+        del versions[:-SUMMARY_VERSIONS_KEPT]
     state["final_report"] = full_response
+    state["summary_input"] = combined_analysis
+    return True
+
+
+# Async Agent Definitions
+async def _astream_agent_response(prompt: str, images, heading: str, max_tokens: Optional[int] = None,
+                                  prefix_chars: int = 0, watcher: Optional[ReferralWatcher] = None,
+                                  renderer=None) -> str:
+    renderer = renderer if renderer is not None else AgentStream(heading)
+    async for chunk in agenerate_response(prompt, images, max_tokens=max_tokens, prefix_chars=prefix_chars):
+        if watcher is not None:
+            watcher.feed(chunk)
+        renderer.write(chunk)
+    return renderer.finish()
+
+async def arun_specialist_agent(name: str, state: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Async version of run_specialist_agent.
+    """
+    entry = SPECIALIST_REGISTRY[name]
+    prompt, max_tokens, prefix_chars = specialist_request(name, state)
+    heading = f"### {entry['title']}\n\n"
+    output = specialist_output(name, heading)
+    full_response = await _astream_agent_response(prompt, apply_image_policy(name, state.get("images")), heading,
+                                                   max_tokens=max_tokens, prefix_chars=prefix_chars, renderer=output)
+    state["agent_results"].append(specialist_result(name, full_response, output))
+    return state
+
+def make_async_specialist_agent(name: str):
+    async def agent(state: Dict[str, Any]) -> Dict[str, Any]:
+        return await arun_specialist_agent(name, state)
+    agent.__name__ = f"{name}_agent"
+    return agent
+
+async def agp_agent(state: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Async version of gp_agent.
+    """
+    images = state.get("images")
+    prompt, prefix_chars = gp_request(state)
+    heading = "### General Practitioner's Initial Assessment\n\n"
+    watcher = ReferralWatcher(state, launch=alaunch_specialist)
+    output = StructuredOutput(gp_output_schema(), heading, watcher.structured_section) if OUTPUT_FORMAT == "json" else None
+    full_response = await _astream_agent_response(prompt, apply_image_policy("gp", images), heading,
+                                                   prefix_chars=prefix_chars, watcher=watcher, renderer=output)
+    gp_result = {"specialist": "General Practitioner", "analysis": full_response}
+    if output is not None and output.structured is not None:
+        gp_result["structured"] = output.structured
+    state["agent_results"].append(gp_result)
+    state["required_specialists"] = gp_referrals(full_response, output, images)
+    print("GP Identified Specialists ", state["required_specialists"])
     return state
 
+async def asummarize_findings(state: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Async version of summarize_findings.
+    """
+    combined_analysis, compaction = summary_input(state)
+    state["final_report"] = await _astream_agent_response(build_summary_prompt(state, combined_analysis),
+                                                          apply_image_policy("summarizer", state.get("images")),
+                                                          "### FINAL ASSESSMENT REPORT (Summary)\n\n")
+    state["summary_input"] = combined_analysis
+    record_summary_compaction(state, compaction)
+    record_prefix_cache_report(state)
+    return state
+
+
+# Batched specialist generation: one upstream call returns a delimited section per specialist
+SECTION_START = re.compile(r"^\s*=+\s*SECTION:\s*([A-Za-z_]+)\s*=+\s*$")
+SECTION_END = re.compile(r"^\s*=+\s*END SECTION\s*=+\s*$")
+
+BATCH_PROMPT_HEADER = """You are a panel of medical specialists reviewing one case together. Each specialist below writes their own assessment, following their own instructions.
+
+Write one section per specialist, in the order listed. Start each section with a line containing exactly `=== SECTION: <key> ===` and end it with a line containing exactly `=== END SECTION ===`, where <key> is the specialist's key. Write nothing outside the sections.
+
+Medical Information:
+{report}
+
+"""
+
+def plan_specialist_batches(pending: List[str]):
+    """
+    Splits pending specialists into batches (two or more members of an enabled
+    batch group) and specialists that still get a call of their own.
+    """
+    if OUTPUT_FORMAT == "json":
+        # A batched response has no per-specialist schema to fill, so keep one call each
+        return [], list(pending)
+    groups: Dict[str, List[str]] = {}
+    for name in pending:
+        group = SPECIALIST_REGISTRY.get(name, {}).get("batch_group")
+        if group in BATCH_SPECIALIST_GROUPS:
+            groups.setdefault(group, []).append(name)
+    batches = [members for members in groups.values() if len(members) > 1]
+    batched = {name for members in batches for name in members}
+    return batches, [name for name in pending if name not in batched]
+
+def build_batch_prompt(names: List[str]) -> str:
+    """
+    Template (taking {report}) asking for every listed specialist's assessment in one response.
+    """
+    sections = []
+    for name in names:
+        instructions = load_specialist_prompt(name).format(report=PREFIX_REPORT_REFERENCE).strip()
+        sections.append(f"=== SPECIALIST: {name} ===\n{instructions}\n")
+    body = "\n".join(sections).replace("{", "{{").replace("}", "}}")
+    return BATCH_PROMPT_HEADER + body
+
+def batch_images(names: List[str], images):
+    # The call carries the richest attachment any member of the batch would get
+    policy_owner = min(names, key=lambda name: IMAGE_POLICIES.index(image_policy_for(name)))
+    return apply_image_policy(policy_owner, images)
+
+def batch_max_tokens(names: List[str]) -> Optional[int]:
+    budgets = [SPECIALIST_REGISTRY[name].get("max_tokens", SPECIALIST_MAX_TOKENS) for name in names]
+    return sum(budgets) if all(budgets) else None
+
+class SpecialistSectionSplitter:
+    """
+    Splits a batched response into specialist sections while it streams. Each section
+    is rendered under its own heading and recorded in results as soon as it closes.
+    """
+    def __init__(self, names: List[str]):
+        self.names = names
+        self.results: Dict[str, str] = {}
+        self._buffer = ""
+        self._current: Optional[str] = None
+        self._renderer: Optional[AgentStream] = None
+        self._has_body = False
+
+    def feed(self, chunk: str) -> None:
+        self._buffer += chunk
+        *lines, self._buffer = self._buffer.split("\n")
+        for line in lines:
+            self._feed_line(line)
+
+    def _feed_line(self, line: str) -> None:
+        start = SECTION_START.match(line)
+        if start:
+            # A new section also closes one that was left open
+            self._close_section()
+            name = start.group(1).lower()
+            if name in self.names and name not in self.results:
+                self._current = name
+                self._renderer = AgentStream(f"### {SPECIALIST_REGISTRY[name]['title']}\n\n")
+            return
+        if SECTION_END.match(line):
+            self._close_section()
+        elif self._renderer is not None:
+            self._renderer.write(line + "\n")
+            self._has_body = self._has_body or bool(line.strip())
+
+    def _close_section(self) -> None:
+        if self._renderer is not None:
+            analysis = self._renderer.finish().strip()
+            # A section with nothing under its heading is missing, not complete
+            if self._has_body:
+                self.results[self._current] = analysis
+        self._current, self._renderer, self._has_body = None, None, False
+
+    def close(self) -> List[str]:
+        """
+        Ends the stream and returns the specialists without a complete section.
+        A section cut off by the end of the stream counts as missing.
+        """
+        if self._buffer:
+            self._feed_line(self._buffer)
+            self._buffer = ""
+        if self._renderer is not None:
+            self._renderer.finish()
+            self._current, self._renderer, self._has_body = None, None, False
+        return [name for name in self.names if name not in self.results]
+
+def _batch_update(names: List[str], splitter: SpecialistSectionSplitter, fallback_results) -> Dict[str, Any]:
+    sections = {name: {"specialist": SPECIALIST_REGISTRY[name]["specialist"], "analysis": analysis}
+                for name, analysis in splitter.results.items()}
+    sections.update(fallback_results)
+    print(f"Visited {names} in one call")
+    return {
+        "agent_results": [sections[name] for name in names],
+        "visited_specialists": set(names),
+    }
+
+def run_specialist_batch(names: List[str], state: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Runs several specialists in one upstream call and splits the answer into their
+    agent_results entries. Specialists whose section is missing or malformed fall
+    back to their own call.
+    """
+    prompt, prefix_chars = assemble_prompt(build_batch_prompt(names), state)
+    splitter = SpecialistSectionSplitter(names)
+    for chunk in generate_response(prompt, batch_images(names, state.get("images")),
+                                   max_tokens=batch_max_tokens(names), prefix_chars=prefix_chars):
+        splitter.feed(chunk)
+    missing = splitter.close()
+
+    fallback_results = {}
+    if missing:
+        print(f"Warning: Batched response had no complete section for {missing}, calling them one by one")
+    for name in missing:
+        result = run_specialist_agent(name, {**state, "agent_results": []})
+        fallback_results[name] = result["agent_results"][-1]
+    return _batch_update(names, splitter, fallback_results)
+
+async def arun_specialist_batch(names: List[str], state: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Async version of run_specialist_batch.
+    """
+    prompt, prefix_chars = assemble_prompt(build_batch_prompt(names), state)
+    splitter = SpecialistSectionSplitter(names)
+    async for chunk in agenerate_response(prompt, batch_images(names, state.get("images")),
+                                          max_tokens=batch_max_tokens(names), prefix_chars=prefix_chars):
+        splitter.feed(chunk)
+    missing = splitter.close()
+
+    fallback_results = {}
+    if missing:
+        print(f"Warning: Batched response had no complete section for {missing}, calling them one by one")
+    for name in missing:
+        result = await arun_specialist_agent(name, {**state, "agent_results": []})
+        fallback_results[name] = result["agent_results"][-1]
+    return _batch_update(names, splitter, fallback_results)
+
+def _batch_members(state: Dict[str, Any]) -> List[str]:
+    # Parallel fan-out names the batch explicitly; the sequential router leaves it to the node
+    if state.get("batch_specialists"):
+        return state["batch_specialists"]
+    visited_specialists = state.get("visited_specialists", set())
+    pending = [spec for spec in state.get("required_specialists", []) if spec not in visited_specialists]
+    return plan_specialist_batches(pending)[0][0]
+
+def specialist_batch_node(state: Dict[str, Any]) -> Dict[str, Any]:
+    return run_specialist_batch(_batch_members(state), state)
+
+async def aspecialist_batch_node(state: Dict[str, Any]) -> Dict[str, Any]:
+    return await arun_specialist_batch(_batch_members(state), state)
+
 
 def route_to_specialists(state: Dict[str, Any]) -> str:
     """
@@ -1773,102 +2870,702 @@ def route_to_specialists(state: Dict[str, Any]) -> str:
     if all(spec in visited_specialists for spec in required_specialists):
         return "summarizer"
     
-    for specialist in required_specialists:
-        if specialist not in visited_specialists:
-            return specialist
-    
-    return "summarizer"
+    pending = [spec for spec in required_specialists if spec not in visited_specialists]
+    batches, _ = plan_specialist_batches(pending)
+    if batches and pending[0] in batches[0]:
+        return "specialist_batch"
+    return pending[0]
+
+def fan_out_to_specialists(state: Dict[str, Any]):
+    """
+    Dispatches all unvisited required specialists at once as parallel branches.
+    """
+    required_specialists = state.get("required_specialists", [])
+    visited_specialists = state.get("visited_specialists", set())
+
+    pending = [spec for spec in required_specialists if spec not in visited_specialists]
+    print(f"\nDispatching specialists in parallel: {pending}")
+    if not pending:
+        return "summarizer"
+
+    # Each branch gets its own results list so concurrent appends do not interleave
+    batches, singles = plan_specialist_batches(pending)
+    return [Send(spec, {**state, "agent_results": list(state.get("agent_results", []))})
+            for spec in singles] + \
+           [Send("specialist_batch", {**state, "agent_results": [], "batch_specialists": members})
+            for members in batches]
+
+def merge_agent_results(existing: Optional[List[Dict[str, str]]],
+                        new: Optional[List[Dict[str, str]]]) -> List[Dict[str, str]]:
+    """
+    Reducer for agent_results: one entry per specialist, in first-seen order.
+    """
+    merged = {result["specialist"]: result for result in existing or []}
+    for result in new or []:
+        merged[result["specialist"]] = result
+    return list(merged.values())
+
+def merge_visited_specialists(existing: Optional[Set[str]], new: Optional[Set[str]]) -> Set[str]:
+    return set(existing or set()) | set(new or set())
+
+def specialist_registry_fingerprint(registry: Optional[Dict[str, Any]] = None) -> str:
+    """
+    Hashes the specialist registry and the prompt pack's version, so a compiled
+    workflow is rebuilt whenever either changes.
+    """
+    registry = SPECIALIST_REGISTRY if registry is None else registry
+    digest = hashlib.sha256(json.dumps(registry, sort_keys=True).encode())
+    try:
+        prompt_pack = os.stat(SPECIALIST_PROMPTS_PATH)
+        digest.update(f"{prompt_pack.st_mtime_ns}:{prompt_pack.st_size}".encode())
+    except OSError:
+        pass
+    return digest.hexdigest()
+
+def create_dynamic_medical_workflow(parallel: bool = PARALLEL_SPECIALISTS, use_async: bool = False,
+                                    checkpointer=None):
+    """
+    Builds the consultation graph. With use_async=True every node is a coroutine
+    and the compiled graph must be driven with ainvoke/astream. With a checkpointer
+    the state is saved after every step under config["configurable"]["thread_id"].
 
-def create_dynamic_medical_workflow():
+    Routing goes through a single "router" hub, so the number of edges grows
+    linearly with the number of specialists.
+    """
     class AgentState(Dict[str, Any]):
         report: str
-        images: List[Image.Image] = []
-        agent_results: List[Dict[str, str]] = []
+        images: List[str] = []  # ImageStore references
+        agent_results: Annotated[List[Dict[str, str]], merge_agent_results] = []
         required_specialists: List[str] = []
-        visited_specialists: Set[str] = set()
+        visited_specialists: Annotated[Set[str], merge_visited_specialists] = set()
         final_report: str = ""
+        metadata: Dict[str, Any] = {}
+        conversation_id: str = ""
+        batch_specialists: List[str] = []
+        summary_input: str = ""
 
     workflow = StateGraph(AgentState)
     
-    # Add all specialist nodes
-    specialists = {
-        "orthopaedician": orthopaedician_agent,
-        "opthamologist": opthamologist_agent,
-        "dentist": dentist_agent,
-        "cardiologist": cardiologist_agent,
-        "gynecologist": gynecologist_agent,
-        "radiologist": radiologist_agent,
-        "oncologist": oncologist_agent,
-        "pain_management": pain_management_agent,
-        "gastroenterologist": gastroenterologist_agent,
-        "rheumatologist": rheumatologist_agent,
-        "psychologist": psychologist_agent,
-        "neurologist": neurologist_agent,
-        "nephrologist":nephrologist_agent,
-        "pulmonologist":pulmonologist_agent,
-        "ent":ent_agent,
-        "allergist":allergist_agent, 
-        "endocrinologist":endocrinologist_agent,
-        "dermatologist":dermatologist_agent,
-        "urologist":urologist_agent,
-        "hepatologist":hepatologist_agent,
-        "dietician":dietician_agent,
-        "neurosurgeon": neurosurgeon_agent,
-        "radiation_oncologist":radiation_oncologist_agent,  
-        "psychiatrist": psychiatrist_agent,
-        "interventional_cardiologist":interventional_cardiologist_agent,
-    }
-    
+    # One node per specialist of the registry as it is now
+    make_agent = make_async_specialist_agent if use_async else make_specialist_agent
+    specialists = {name: make_agent(name) for name in SPECIALIST_REGISTRY}
+    with_context = with_async_consultation_context if use_async else with_consultation_context
+
     # Add GP node
-    workflow.add_node("gp", gp_agent)
+    workflow.add_node("gp", with_context(agp_agent if use_async else gp_agent))
     
     # Add specialist nodes with state update wrapper
+    wrap_specialist = update_state_after_async_specialist if use_async else update_state_after_specialist
     for name, agent in specialists.items():
-        workflow.add_node(name, update_state_after_specialist(agent))
+        workflow.add_node(name, with_context(wrap_specialist(agent)))
     
+    # One node serves every batched group of specialists
+    workflow.add_node("specialist_batch", with_context(aspecialist_batch_node if use_async else specialist_batch_node))
+
     # Add summarizer node
-    workflow.add_node("summarizer", summarize_findings)
-    
-    # Add conditional routing
-    workflow.add_conditional_edges(
-        "gp",
-        route_to_specialists,
-        {name: name for name in specialists.keys()} | {"summarizer": "summarizer"}
-    )
-    
-    for name in specialists.keys():
+    workflow.add_node("summarizer", with_context(asummarize_findings if use_async else summarize_findings))
+
+    # Routing hub between the GP, the specialists and the summarizer
+    workflow.add_node("router", route_hub)
+    workflow.add_edge("gp", "router")
+
+    if parallel:
+        # Fan out to all required specialists, then join at the summarizer
+        workflow.add_conditional_edges(
+            "router",
+            fan_out_to_specialists,
+            list(specialists.keys()) + ["specialist_batch", "summarizer"]
+        )
+
+        for name in list(specialists.keys()) + ["specialist_batch"]:
+            workflow.add_edge(name, "summarizer")
+    else:
+        # Each specialist hands back to the hub, which picks the next one
         workflow.add_conditional_edges(
-            name,
+            "router",
             route_to_specialists,
-            {other: other for other in specialists.keys()} | {"summarizer": "summarizer"}
+            {name: name for name in specialists.keys()} | {"specialist_batch": "specialist_batch",
+                                                           "summarizer": "summarizer"}
         )
+
+        for name in list(specialists.keys()) + ["specialist_batch"]:
+            workflow.add_edge(name, "router")
     
-    workflow.set_entry_point("gp")
+    # A consultation resumed with its GP assessment goes straight to the router
+    workflow.set_conditional_entry_point(consultation_entry, {"gp": "gp", "router": "router"})
     
-    return workflow.compile()
+    return workflow.compile(checkpointer=checkpointer)
 
-def update_state_after_specialist(specialist_func):
-    def wrapped(state: Dict[str, Any]) -> Dict[str, Any]:
-        response_generator = specialist_func(state)
-        full_response = ""
+# Consultation checkpoints: the graph state is saved after every step, keyed by a
+# per-consultation thread id, so an interrupted or partly failed run can be resumed
+CHECKPOINT_DB = os.environ.get("AGENTDX_CHECKPOINT_DB", "agentdx_checkpoints.sqlite3")
+# Checkpoints of finished consultations, and stored images not used for this long, are
+# deleted (0 keeps them forever). Pruning runs at most once per CHECKPOINT_PRUNE_INTERVAL
+CHECKPOINT_RETENTION_SECONDS = float(os.environ.get("AGENTDX_CHECKPOINT_RETENTION", str(24 * 3600)))
+CHECKPOINT_PRUNE_INTERVAL = 600.0
+
+def _import_sqlite_saver():
+    try:
+        from langgraph.checkpoint.sqlite import SqliteSaver
+        from langgraph.checkpoint.serde.jsonplus import JsonPlusSerializer
+    except ImportError as e:
+        raise ImportError("Consultation checkpoints require langgraph-checkpoint-sqlite: "
+                          "pip install langgraph-checkpoint-sqlite") from e
+    return SqliteSaver, JsonPlusSerializer
+
+@cache_resource
+def get_checkpointer(db_path: str = CHECKPOINT_DB):
+    """
+    Returns the process-wide SQLite checkpointer, or None when checkpointing is
+    turned off or its package is not installed.
+    """
+    if not db_path:
+        return None
+    try:
+        SqliteSaver, JsonPlusSerializer = _import_sqlite_saver()
+    except ImportError as e:
+        print(f"Warning: {e}. Consultations will not be checkpointed.")
+        return None
+    conn = sqlite3.connect(db_path, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    # The state holds image references, not pixels (see ImageStore), so no pickling is needed
+    return SqliteSaver(conn, serde=JsonPlusSerializer())
+
+class ImageStore:
+    """
+    Uploaded image bytes keyed by their content hash. The graph state only carries
+    the hashes, so checkpoints, channel writes and fan-out payloads never hold pixels.
+    Kept in the checkpoint database so a resumed consultation still finds its images,
+    or in memory when checkpointing is off. Images linked to a consultation thread are
+    kept until the thread is unlinked, whatever their age.
+    """
+    def __init__(self, db_path: str = ":memory:", retention: float = CHECKPOINT_RETENTION_SECONDS):
+        self.retention = retention
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        if db_path != ":memory:":
+            self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS images (ref TEXT PRIMARY KEY, data BLOB NOT NULL, "
+                         "used REAL NOT NULL)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS image_links (thread_id TEXT NOT NULL, ref TEXT NOT NULL, "
+                         "PRIMARY KEY (thread_id, ref))")
+        self._db.commit()
+        self._next_prune = 0.0
+
+    def put(self, data: bytes) -> str:
+        """
+        Stores an upload once and returns its reference.
+        """
+        ref = hashlib.sha256(data).hexdigest()
+        now = time.time()
+        with self._lock:
+            self._db.execute("INSERT INTO images (ref, data, used) VALUES (?, ?, ?) "
+                             "ON CONFLICT(ref) DO UPDATE SET used = excluded.used", (ref, data, now))
+            if self.retention and now >= self._next_prune:
+                self._next_prune = now + CHECKPOINT_PRUNE_INTERVAL
+                pruned = self._db.execute("DELETE FROM images WHERE used < ? AND ref NOT IN "
+                                          "(SELECT ref FROM image_links)", (now - self.retention,)).rowcount
+                if pruned:
+                    print(f"Pruned {pruned} stored images")
+            self._db.commit()
+        return ref
+
+    def get(self, ref: str) -> Optional[bytes]:
+        with self._lock:
+            row = self._db.execute("SELECT data FROM images WHERE ref = ?", (ref,)).fetchone()
+            if row is not None:
+                self._db.execute("UPDATE images SET used = ? WHERE ref = ?", (time.time(), ref))
+                self._db.commit()
+        return row[0] if row else None
+
+    def link(self, thread_id: str, refs: List[str]) -> None:
+        with self._lock:
+            self._db.executemany("INSERT OR IGNORE INTO image_links (thread_id, ref) VALUES (?, ?)",
+                                 [(thread_id, ref) for ref in refs])
+            self._db.commit()
+
+    def unlink(self, thread_ids: List[str]) -> None:
+        with self._lock:
+            self._db.executemany("DELETE FROM image_links WHERE thread_id = ?", [(t,) for t in thread_ids])
+            self._db.commit()
+
+@cache_resource
+def get_image_store(db_path: str = CHECKPOINT_DB) -> ImageStore:
+    return ImageStore(db_path or ":memory:")
+
+def store_uploaded_image(data: bytes) -> str:
+    return get_image_store().put(data)
+
+@cache_resource(max_entries=16)
+def load_stored_image(ref: str):
+    data = get_image_store().get(ref)
+    if data is None:
+        raise KeyError(f"Image {ref[:12]} is no longer stored")
+    return load_uploaded_image(data)[0]
+
+def resolve_images(images):
+    """
+    PIL images for the image references in the graph state. Items that already are
+    images pass through unchanged.
+    """
+    if not images:
+        return images
+    return [load_stored_image(image) if isinstance(image, str) else image for image in images]
 
-        for chunk in response_generator:  # Collect the full response
-            full_response += chunk
+class ConsultationLog:
+    """
+    Index of checkpointed consultations (thread id, report excerpt, status), kept next
+    to the checkpoints so unfinished ones can be listed without loading their state.
+    """
+    def __init__(self, db_path: str = CHECKPOINT_DB, checkpointer=None, image_store: Optional[ImageStore] = None,
+                 retention: float = CHECKPOINT_RETENTION_SECONDS):
+        self.checkpointer = checkpointer
+        self.image_store = image_store
+        self.retention = retention
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS consultations (thread_id TEXT PRIMARY KEY, "
+                         "report TEXT NOT NULL, status TEXT NOT NULL, updated REAL NOT NULL)")
+        self._db.commit()
+        self._next_prune = 0.0
+
+    def record(self, thread_id: str, report: str, status: str, images=None) -> None:
+        """
+        images are the consultation's ImageStore references, kept while the thread is.
+        """
+        refs = [image for image in images or [] if isinstance(image, str)]
+        if refs and self.image_store is not None:
+            self.image_store.link(thread_id, refs)
+        now = time.time()
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO consultations (thread_id, report, status, updated) "
+                             "VALUES (?, ?, ?, ?)", (thread_id, report[:200], status, now))
+            self._db.commit()
+            prune = self.checkpointer is not None and self.retention and now >= self._next_prune
+            if prune:
+                self._next_prune = now + CHECKPOINT_PRUNE_INTERVAL
+        if prune:
+            self.prune_finished(now - self.retention)
+
+    def prune_finished(self, before: float) -> int:
+        """
+        Deletes the checkpoints and log entries of consultations that finished (or were
+        retried under a new thread) before the given time. Unfinished ones are kept.
+        """
+        with self._lock:
+            thread_ids = [row[0] for row in self._db.execute(
+                "SELECT thread_id FROM consultations WHERE status IN ('finished', 'retried') AND updated < ?",
+                (before,)).fetchall()]
+        for thread_id in thread_ids:
+            self.checkpointer.delete_thread(thread_id)
+        if self.image_store is not None:
+            # Their images now age out unless another consultation still uses them
+            self.image_store.unlink(thread_ids)
+        with self._lock:
+            self._db.executemany("DELETE FROM consultations WHERE thread_id = ?", [(t,) for t in thread_ids])
+            self._db.commit()
+        if thread_ids:
+            print(f"Pruned the checkpoints of {len(thread_ids)} finished consultations")
+        return len(thread_ids)
+
+    def unfinished(self, limit: int = 10) -> List[Dict[str, Any]]:
+        with self._lock:
+            rows = self._db.execute("SELECT thread_id, report, status, updated FROM consultations "
+                                    "WHERE status IN ('running', 'failed') ORDER BY updated DESC LIMIT ?", (limit,)).fetchall()
+        return [{"thread_id": row[0], "report": row[1], "status": row[2], "updated": row[3]} for row in rows]
+
+@cache_resource
+def get_consultation_log(db_path: str = CHECKPOINT_DB) -> Optional[ConsultationLog]:
+    checkpointer = get_checkpointer(db_path) if db_path else None
+    if checkpointer is None:
+        return None
+    return ConsultationLog(db_path, checkpointer, get_image_store(db_path))
+
+def is_error_response(analysis: str) -> bool:
+    # Upstream failures are streamed as "Error: ..." after the agent's heading
+    return re.match(r"(?:#+[^\n]*\n+)?\s*Error:", analysis or "") is not None
+
+def failed_specialists(state: Dict[str, Any]) -> List[str]:
+    """
+    Registry names of the specialists whose stored result is an upstream error.
+    """
+    names_by_label = {entry["specialist"]: name for name, entry in SPECIALIST_REGISTRY.items()}
+    return [names_by_label[result["specialist"]] for result in state.get("agent_results", [])
+            if result["specialist"] in names_by_label and is_error_response(result["analysis"])]
+
+def consultation_entry(state: Dict[str, Any]) -> str:
+    """
+    Entry point: a state that already has a usable GP assessment starts at the
+    router, which sends it on to the first unvisited specialist.
+    """
+    gp_done = any(result["specialist"] == "General Practitioner" and not is_error_response(result["analysis"])
+                  for result in state.get("agent_results", []))
+    return "router" if gp_done else "gp"
+
+def consultation_config(thread_id: str, script_ctx=None, sink: Optional[OutputSink] = None) -> Dict[str, Any]:
+    return {"configurable": {"thread_id": thread_id, "script_run_ctx": script_ctx, "output_sink": sink}}
+
+def consultation_result(state: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    JSON-ready outcome of a finished consultation.
+    """
+    return {
+        "status": consultation_status(state),
+        "required_specialists": state.get("required_specialists", []),
+        "failed_specialists": failed_specialists(state),
+        "agent_results": [{key: item[key] for key in ("specialist", "analysis", "structured") if key in item}
+                          for item in state.get("agent_results", [])],
+        "final_report": state.get("final_report", ""),
+        "metadata": state.get("metadata", {}),
+    }
+
+def consultation_status(state: Dict[str, Any]) -> str:
+    failed = failed_specialists(state) or is_error_response(state.get("final_report", ""))
+    return "failed" if failed or not state.get("final_report") else "finished"
+
+def run_consultation(workflow, initial_state: Dict[str, Any], thread_id: str, script_ctx=None,
+                     sink: Optional[OutputSink] = None) -> Dict[str, Any]:
+    """
+    Runs a consultation under its checkpoint thread and records its outcome. Output goes
+    to sink, or by default to the page of script_ctx.
+    """
+    log = get_consultation_log()
+    if log is not None:
+        log.record(thread_id, initial_state.get("report", ""), "running", initial_state.get("images"))
+    state = workflow.invoke(initial_state, config=consultation_config(thread_id, script_ctx, sink))
+    if log is not None:
+        log.record(thread_id, state.get("report", ""), consultation_status(state))
+    return state
 
-        # Ensure the generator's result is now fully processed
-        if isinstance(response_generator, dict):
-            state = response_generator  # Assign directly if already a dictionary
+def resume_consultation(workflow, thread_id: str, script_ctx=None):
+    """
+    Continues a checkpointed consultation and returns (state, thread_id). A run that was
+    interrupted picks up at its saved step. A finished run re-runs only the specialists
+    (and summary) whose upstream call failed, as a new thread starting from the router.
+    """
+    config = consultation_config(thread_id, script_ctx)
+    snapshot = workflow.get_state(config)
+    if not snapshot.values:
+        raise KeyError(f"No checkpoint for consultation {thread_id}")
+    log = get_consultation_log()
+
+    if snapshot.next:
+        print(f"Resuming consultation {thread_id} at {snapshot.next}")
+        state = workflow.invoke(None, config=config)
+        if log is not None:
+            log.record(thread_id, state.get("report", ""), consultation_status(state))
+        return state, thread_id
+
+    values = snapshot.values
+    failed = failed_specialists(values)
+    if not failed and consultation_status(values) == "finished":
+        return values, thread_id
+
+    failed_labels = {SPECIALIST_REGISTRY[name]["specialist"] for name in failed}
+    retry_state = {
+        **values,
+        "agent_results": [result for result in values.get("agent_results", [])
+                          if result["specialist"] not in failed_labels],
+        "visited_specialists": set(values.get("visited_specialists", set())) - set(failed),
+        "final_report": "",
+    }
+    # The visited set only ever grows within a thread, so the retry gets a thread of its own
+    retry_thread = f"{thread_id}:retry-{uuid.uuid4().hex[:8]}"
+    print(f"Retrying {failed or 'summary'} of consultation {thread_id} as {retry_thread}")
+    if log is not None:
+        log.record(thread_id, values.get("report", ""), "retried")
+    return run_consultation(workflow, retry_state, retry_thread, script_ctx), retry_thread
+
+# Background consultations: the Analyse button submits a job to a bounded pool and the
+# page polls the job table, so no Streamlit script thread is held for a whole run
+BACKGROUND_CONSULTATIONS = os.environ.get("AGENTDX_BACKGROUND_CONSULTATIONS", "1") == "1"
+CONSULTATION_WORKERS = int(os.environ.get("AGENTDX_CONSULTATION_WORKERS", "4"))
+CONSULTATION_JOBS_KEPT = int(os.environ.get("AGENTDX_CONSULTATION_JOBS_KEPT", "200"))
+JOB_POLL_INTERVAL = float(os.environ.get("AGENTDX_JOB_POLL_INTERVAL", "1.0"))
+# HTTP service: consultations running at once on the server's event loop, and how many
+# more may wait before new ones are turned away with 503
+SERVICE_MAX_ACTIVE = int(os.environ.get("AGENTDX_SERVICE_CONCURRENCY", "16"))
+SERVICE_MAX_QUEUED = int(os.environ.get("AGENTDX_SERVICE_BACKLOG", "64"))
+
+class ConsultationJob(EventSink):
+    """
+    One submitted consultation and the sink of its run: its status, the ordered log of
+    its events, node-level progress, the agent streams currently being written and,
+    once done, the final state. Listeners are called after every new event.
+    """
+    def __init__(self, job_id: str, thread_id: str, report: str):
+        super().__init__()
+        self.id = job_id
+        self.thread_id = thread_id
+        self.report = report
+        self.status = "queued"
+        self.created = time.time()
+        self.started: Optional[float] = None
+        self.finished: Optional[float] = None
+        self.log: List[Dict[str, Any]] = []
+        self.events: List[Dict[str, Any]] = []
+        self.streams: "OrderedDict[int, List[str]]" = OrderedDict()
+        self.state: Optional[Dict[str, Any]] = None
+        self.error: Optional[str] = None
+        self._listeners: List[Any] = []
+        self._lock = threading.Lock()
+
+    def emit(self, event: Dict[str, Any]) -> None:
+        with self._lock:
+            self.log.append(event)
+            kind = event["event"]
+            if kind in ("node_start", "node_end"):
+                self.events.append({"node": event["node"], "event": kind[len("node_"):], "at": event["at"]})
+            elif kind == "stream_start":
+                self.streams[event["stream"]] = [event["heading"]]
+            elif kind == "chunk" and event["stream"] in self.streams:
+                self.streams[event["stream"]].append(event["text"])
+            elif kind == "stream_replace":
+                self.streams[event["stream"]] = [event["text"]]
+            elif kind == "stream_end":
+                # Finished reports are shown from the final state
+                self.streams.pop(event["stream"], None)
+            listeners = list(self._listeners)
+        for listener in listeners:
+            listener()
+
+    def add_listener(self, listener) -> None:
+        with self._lock:
+            self._listeners.append(listener)
+
+    def remove_listener(self, listener) -> None:
+        with self._lock:
+            self._listeners.remove(listener)
+
+    def events_since(self, index: int) -> List[Dict[str, Any]]:
+        with self._lock:
+            return self.log[index:]
+
+    @property
+    def done(self) -> bool:
+        return self.status in ("done", "failed")
+
+    def snapshot(self) -> Dict[str, Any]:
+        """
+        Consistent copy of the job's progress for rendering.
+        """
+        with self._lock:
+            return {"id": self.id, "status": self.status, "created": self.created, "started": self.started,
+                    "finished": self.finished, "events": list(self.events),
+                    "streams": ["".join(parts) for parts in self.streams.values()], "error": self.error}
+
+class ConsultationJobTable:
+    """
+    Submitted consultation jobs keyed by job id, shared by the thread pool and event
+    loop runners. Keeps the jobs_kept most recent finished jobs.
+    """
+    def __init__(self, jobs_kept: int = CONSULTATION_JOBS_KEPT):
+        self._jobs: "OrderedDict[str, ConsultationJob]" = OrderedDict()
+        self._jobs_kept = jobs_kept
+        self._lock = threading.Lock()
+
+    def _add_job(self, initial_state: Dict[str, Any], thread_id: str) -> ConsultationJob:
+        job = ConsultationJob(uuid.uuid4().hex, thread_id, initial_state.get("report", ""))
+        with self._lock:
+            self._jobs[job.id] = job
+            # Forget the oldest finished jobs beyond the retention limit
+            for old_id in [old.id for old in self._jobs.values() if old.finished][:max(0, len(self._jobs) - self._jobs_kept)]:
+                del self._jobs[old_id]
+        return job
+
+    def get(self, job_id: str) -> Optional[ConsultationJob]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def active(self) -> int:
+        with self._lock:
+            return sum(job.status in ("queued", "running") for job in self._jobs.values())
+
+    @staticmethod
+    def _finish(job: ConsultationJob) -> None:
+        if job.error:
+            print(f"Error: Consultation job {job.id} failed. {job.error}")
+            final = {"event": "error", "error": job.error}
         else:
-            state["agent_results"][-1]["analysis"] = full_response  # Store full response
+            final = {"event": "final", **consultation_result(job.state)}
+        # The closing event is logged before the status changes, so a reader that sees
+        # the job done has already been handed every event
+        job.emit({**final, "consultation": job.thread_id, "at": time.time()})
+        job.finished = time.time()
+        job.status = "failed" if job.error else "done"
+
+class ConsultationRunner(ConsultationJobTable):
+    """
+    Bounded thread pool running consultations off the Streamlit script threads.
+    """
+    def __init__(self, max_workers: int = CONSULTATION_WORKERS, jobs_kept: int = CONSULTATION_JOBS_KEPT):
+        super().__init__(jobs_kept)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="consultation")
+
+    def submit(self, workflow, initial_state: Dict[str, Any], thread_id: str) -> str:
+        job = self._add_job(initial_state, thread_id)
+        self._executor.submit(self._run, job, workflow, initial_state)
+        return job.id
+
+    def _run(self, job: ConsultationJob, workflow, initial_state: Dict[str, Any]) -> None:
+        job.status, job.started = "running", time.time()
+        try:
+            job.state = run_consultation(workflow, initial_state, job.thread_id, sink=job)
+        except Exception as e:
+            job.error = str(e)
+        self._finish(job)
+
+@cache_resource
+def get_consultation_runner(max_workers: int = CONSULTATION_WORKERS) -> ConsultationRunner:
+    return ConsultationRunner(max_workers)
+
+class AsyncConsultationRunner(ConsultationJobTable):
+    """
+    Runs consultations as tasks on the running event loop through the async graph,
+    at most max_active at a time. Others wait in a backlog of at most max_queued;
+    check full() before submitting. Used by the HTTP service, so no thread is held
+    per consultation.
+    """
+    def __init__(self, max_active: int = SERVICE_MAX_ACTIVE, max_queued: int = SERVICE_MAX_QUEUED,
+                 jobs_kept: int = CONSULTATION_JOBS_KEPT):
+        super().__init__(jobs_kept)
+        self.max_active = max_active
+        self.max_queued = max_queued
+        self._semaphore: Optional[asyncio.Semaphore] = None  # Created on the loop by the first job
+        # The loop only keeps weak references to tasks
+        self._tasks: Set[asyncio.Task] = set()
+
+    def full(self) -> bool:
+        return self.active() >= self.max_active + self.max_queued
+
+    def submit(self, workflow, initial_state: Dict[str, Any], thread_id: str) -> str:
+        job = self._add_job(initial_state, thread_id)
+        task = asyncio.get_running_loop().create_task(self._arun(job, workflow, initial_state))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return job.id
+
+    async def _arun(self, job: ConsultationJob, workflow, initial_state: Dict[str, Any]) -> None:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_active)
+        async with self._semaphore:
+            job.status, job.started = "running", time.time()
+            try:
+                job.state = await workflow.ainvoke(initial_state, config=consultation_config(job.thread_id, sink=job))
+            except Exception as e:
+                job.error = str(e)
+            self._finish(job)
+
+# One entry per parallel/async combination in use; graphs of an outdated registry are dropped
+@cache_resource(max_entries=4)
+def _compile_medical_workflow(registry_fingerprint: str, parallel: bool, use_async: bool):
+    print(f"Compiling medical workflow (parallel={parallel}, async={use_async})")
+    # The SQLite checkpointer is synchronous; the async graph runs without one
+    checkpointer = None if use_async else get_checkpointer()
+    return create_dynamic_medical_workflow(parallel=parallel, use_async=use_async, checkpointer=checkpointer)
+
+def get_medical_workflow(parallel: bool = PARALLEL_SPECIALISTS, use_async: bool = False):
+    """
+    Returns the compiled workflow, compiled once per process for each registry and configuration.
+    """
+    return _compile_medical_workflow(specialist_registry_fingerprint(), parallel, use_async)
+
+def route_hub(state: Dict[str, Any]) -> Dict[str, Any]:
+    return {}
+
+def with_consultation_context(node_func):
+    """
+    Runs a graph node inside its consultation's context: the Streamlit script context
+    passed in the run config (nodes may run on worker threads) and the upstream
+    conversation id and output sink of the run.
+    """
+    def wrapped(state: Dict[str, Any], config: RunnableConfig) -> Dict[str, Any]:
+        configurable = config.get("configurable") or {}
+        script_ctx = configurable.get("script_run_ctx")
+        if script_ctx is not None:
+            add_script_run_ctx(threading.current_thread(), script_ctx)
+        sink = configurable.get("output_sink")
+        node = (config.get("metadata") or {}).get("langgraph_node", node_func.__name__)
+        token = _conversation_id.set(state.get("conversation_id") or None)
+        sink_token = _output_sink.set(sink)
+        if sink is not None:
+            sink.node_start(node)
+        try:
+            return node_func(state)
+        finally:
+            if sink is not None:
+                sink.node_end(node)
+            _output_sink.reset(sink_token)
+            _conversation_id.reset(token)
+    return wrapped
+
+def with_async_consultation_context(node_func):
+    async def wrapped(state: Dict[str, Any], config: RunnableConfig) -> Dict[str, Any]:
+        sink = (config.get("configurable") or {}).get("output_sink")
+        node = (config.get("metadata") or {}).get("langgraph_node", node_func.__name__)
+        token = _conversation_id.set(state.get("conversation_id") or None)
+        sink_token = _output_sink.set(sink)
+        if sink is not None:
+            sink.node_start(node)
+        try:
+            return await node_func(state)
+        finally:
+            if sink is not None:
+                sink.node_end(node)
+            _output_sink.reset(sink_token)
+            _conversation_id.reset(token)
+    return wrapped
+
+def update_state_after_specialist(specialist_func):
+    def wrapped(state: Dict[str, Any]) -> Dict[str, Any]:
+        specialist_name = specialist_func.__name__.replace("_agent", "")
+        # Own copy of the results list, which parallel specialists would otherwise share
+        state = specialist_func({**state, "agent_results": list(state.get("agent_results", []))})
+
+        print(f"Visited {specialist_name}")
+        # Return only this specialist's contribution; the state reducers merge it,
+        # which lets several specialists complete in the same step
+        return {
+            "agent_results": [state["agent_results"][-1]],
+            "visited_specialists": {specialist_name},
+        }
+    return wrapped
 
+def update_state_after_async_specialist(specialist_func):
+    async def wrapped(state: Dict[str, Any]) -> Dict[str, Any]:
         specialist_name = specialist_func.__name__.replace("_agent", "")
-        state["visited_specialists"] = state.get("visited_specialists", set()) | {specialist_name}
+        state = await specialist_func({**state, "agent_results": list(state.get("agent_results", []))})
+
         print(f"Visited {specialist_name}")
-        return state  # Now a proper dictionary
+        return {
+            "agent_results": [state["agent_results"][-1]],
+            "visited_specialists": {specialist_name},
+        }
     return wrapped
 
 
 
+@cache_resource(max_entries=16)
+def load_uploaded_image(data: bytes):
+    """
+    Opens and preprocesses an uploaded image once per distinct upload.
+    Returns (image, metadata) where metadata records the upload byte savings.
+    """
+    image = preprocess_image(Image.open(io.BytesIO(data)))
+    # Encoding here also warms the payload cache used by the agents
+    _, payload, mime_type = get_image_payload_cache().get(image)
+    metadata = {
+        "original_bytes": len(data),
+        "upload_bytes": len(payload),
+        "saved_bytes": len(data) - len(payload),
+        "upload_format": mime_type,
+        "size": list(image.size),
+        "mode": image.mode,
+    }
+    print("Image preprocessing ", metadata)
+    return image, metadata
+
 def render_sidebar():
 	# Custom CSS to increase sidebar width
     st.markdown(
@@ -1914,7 +3611,8 @@ def render_sidebar():
     return medical_report, uploaded_file, start_consultation
 
 def main():
-    medical_workflow = create_dynamic_medical_workflow()
+    get_http_session()  # Open (and optionally prewarm) the shared upstream pool at app start
+    medical_workflow = get_medical_workflow()
     
     st.title("Multi-Specialist Medical Diagnostic Assistant")
     st.markdown("This system analyzes patient information and provides specialist consultations.")
@@ -1929,12 +3627,24 @@ def main():
 
     # Render sidebar and get inputs
     medical_report, uploaded_file, start_consultation = render_sidebar()
+    resume_thread = render_resume_picker()
+    if resume_thread:
+        try:
+            st.session_state.workflow_state, st.session_state.thread_id = resume_consultation(
+                medical_workflow, resume_thread, get_script_run_ctx())
+        except Exception as e:
+            st.error(f"Could not resume the consultation: {e}")
+            return
+        st.rerun()
     process_images = []
+    image_metadata = None
     if uploaded_file:
 								try:
-												image = Image.open(uploaded_file)
-												process_images.append(image)
+												image, image_metadata = load_uploaded_image(uploaded_file.getvalue())
+												process_images.append(store_uploaded_image(uploaded_file.getvalue()))
 												st.image(image, caption=uploaded_file.name, width=150)
+												st.caption(f"Uploading {image_metadata['upload_bytes'] / 1024:.0f} KB as {image_metadata['upload_format']} "
+												           f"({image_metadata['saved_bytes'] / 1024:.0f} KB saved)")
 								except UnidentifiedImageError:
 												st.error(f"Unsupported image format: {uploaded_file}")
 								except Exception as e:
@@ -1950,23 +3660,96 @@ def main():
 												"agent_results": [],
 												"required_specialists": [],
 												"visited_specialists": set(),
-												"final_report": ""
+												"final_report": "",
+												"metadata": {"image": image_metadata} if image_metadata else {},
+												"conversation_id": str(uuid.uuid4())
         }
 
 								
 								# Run medical workflow
-        st.session_state.workflow_state = medical_workflow.invoke(initial_state)
+        st.session_state.thread_id = initial_state["conversation_id"]
+        if BACKGROUND_CONSULTATIONS:
+            # The pool runs the graph; this script run ends and the progress panel polls the job
+            st.session_state.job_id = get_consultation_runner().submit(
+                medical_workflow, initial_state, st.session_state.thread_id)
+            st.session_state.workflow_state = None
+            st.rerun()
+        try:
+            st.session_state.workflow_state = run_consultation(
+                medical_workflow, initial_state, st.session_state.thread_id, get_script_run_ctx())
+        except Exception as e:
+            st.error(f"The consultation stopped: {e}. Completed steps are saved and can be resumed from the sidebar.")
+            return
 
 								# Clear loader after processing
         #placeholder.empty()
         st.rerun()
 
 
+    if st.session_state.get("job_id"):
+        render_job_progress()
+
     # Display Results AFTER processing is complete
     if st.session_state.workflow_state:
         display_results(st.session_state.workflow_state)
 
 
+@fragment(run_every=JOB_POLL_INTERVAL)
+def render_job_progress():
+    """
+    Shows the running background consultation: finished and running steps, and the
+    agent responses streaming right now. Re-runs on its own until the job ends, then
+    hands the result to the page.
+    """
+    job = get_consultation_runner().get(st.session_state.job_id)
+    if job is None:
+        st.session_state.job_id = None
+        st.warning("The consultation is no longer available. Completed steps can be resumed from the sidebar.")
+        return
+    progress = job.snapshot()
+    if progress["status"] == "done":
+        st.session_state.workflow_state = job.state
+        st.session_state.job_id = None
+        st.rerun()
+    if progress["status"] == "failed":
+        st.session_state.job_id = None
+        st.error(f"The consultation stopped: {progress['error']}. Completed steps are saved and can be resumed from the sidebar.")
+        return
+
+    open_nodes: Dict[str, int] = {}
+    finished = []
+    for event in progress["events"]:
+        if event["node"] in ("router", "__start__"):
+            continue
+        open_nodes[event["node"]] = open_nodes.get(event["node"], 0) + (1 if event["event"] == "start" else -1)
+        if event["event"] == "end":
+            finished.append(event["node"])
+    running = sorted(node for node, count in open_nodes.items() if count > 0)
+    elapsed = time.time() - (progress["started"] or progress["created"])
+    st.info(f"Consultation {progress['status']} ({elapsed:.0f}s)"
+            + (f" · running: {', '.join(running)}" if running else "")
+            + (f" · done: {', '.join(finished)}" if finished else ""))
+    for text in progress["streams"]:
+        st.markdown(text)
+
+def render_resume_picker() -> Optional[str]:
+    """
+    Lists checkpointed consultations that did not finish cleanly in the sidebar.
+    Returns the thread id to resume when the button is pressed.
+    """
+    log = get_consultation_log()
+    unfinished = log.unfinished() if log is not None else []
+    if not unfinished:
+        return None
+    with st.sidebar.expander(f"Unfinished consultations ({len(unfinished)})"):
+        choice = st.selectbox(
+            "Consultation", range(len(unfinished)),
+            format_func=lambda i: f"{time.strftime('%d %b %H:%M', time.localtime(unfinished[i]['updated']))} "
+                                  f"[{unfinished[i]['status']}] {unfinished[i]['report'][:40]}")
+        if st.button("Resume consultation"):
+            return unfinished[choice]["thread_id"]
+    return None
+
 def display_results(workflow_state):
     """Display only final tabbed results after processing."""
     tab_names = ["GP Assessment"] + [
@@ -1996,11 +3779,358 @@ def display_results(workflow_state):
     with tabs[-1]:
         #st.subheader("Consolidated Medical Report")
         summary = workflow_state.get("final_report", "")
-        st.markdown(summary)
+        summary_slot = st.empty()
+        summary_slot.markdown(summary)
         
         if st.button("🔄 Regenerate Summary"):
-            workflow_state = summarize_findings(workflow_state)
-            st.rerun()
+            # Streams into the summary above; the session keeps the new summary and the old ones
+            if regenerate_summary(workflow_state, summary_slot):
+                st.session_state.workflow_state = workflow_state
+            else:
+                summary_slot.markdown(summary)
+
+        versions = workflow_state.get("summary_versions", [])
+        if versions:
+            with st.expander(f"Previous summaries ({len(versions)})"):
+                version = st.selectbox("Compare with", range(len(versions) - 1, -1, -1),
+                                       format_func=lambda i: f"Version {i + 1} (replaced at {versions[i]['replaced_at']})")
+                st.markdown(versions[version]["summary"])
+
+# Headless batch mode: python AgentDx-v1.py batch cases.jsonl results.jsonl [--concurrency N] [--async]
+BATCH_CONCURRENCY = int(os.environ.get("AGENTDX_BATCH_CONCURRENCY", "4"))
+
+def read_batch_cases(path: str) -> List[Dict[str, Any]]:
+    """
+    Reads cases from a JSONL or CSV file. Each case needs a report and may carry an id
+    and image paths (a list in JSONL, ";"-separated in CSV), relative to the case file.
+    """
+    import csv
+    with open(path, newline="", encoding="utf-8") as handle:
+        if path.lower().endswith(".csv"):
+            rows = list(csv.DictReader(handle))
+        else:
+            rows = [json.loads(line) for line in handle if line.strip()]
+    base_dir = os.path.dirname(os.path.abspath(path))
+    cases = []
+    for number, row in enumerate(rows, 1):
+        if not row.get("report"):
+            print(f"Warning: Skipping case {row.get('id') or number}: no report")
+            continue
+        images = row.get("images") or row.get("image") or []
+        if isinstance(images, str):
+            images = [image.strip() for image in images.split(";") if image.strip()]
+        cases.append({"id": str(row.get("id") or number), "report": row["report"],
+                      "images": [os.path.join(base_dir, image) for image in images]})
+    return cases
+
+def consultation_initial_state(report: str, image_data: List[bytes]) -> Dict[str, Any]:
+    """
+    Builds the workflow input for a report, preprocessing its images like an upload.
+    """
+    images, image_metadata = [], None
+    for data in image_data:
+        _, image_metadata = load_uploaded_image(data)
+        images.append(store_uploaded_image(data))
+    return {
+        "report": report,
+        "images": images or None,
+        "agent_results": [],
+        "required_specialists": [],
+        "visited_specialists": set(),
+        "final_report": "",
+        "metadata": {"image": image_metadata} if image_metadata else {},
+        "conversation_id": str(uuid.uuid4()),
+    }
+
+def batch_initial_state(case: Dict[str, Any]) -> Dict[str, Any]:
+    image_data = []
+    for image_path in case["images"]:
+        with open(image_path, "rb") as handle:
+            image_data.append(handle.read())
+    return consultation_initial_state(case["report"], image_data)
+
+def batch_case_result(case: Dict[str, Any], state: Optional[Dict[str, Any]], latency: float,
+                      thread_id: Optional[str] = None, error: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Output record for one case.
+    """
+    if state is None:
+        return {"id": case["id"], "thread_id": thread_id, "status": "error", "latency_s": round(latency, 3),
+                "error": error}
+    return {"id": case["id"], "thread_id": thread_id, "latency_s": round(latency, 3), **consultation_result(state)}
+
+def run_batch_case(workflow, case: Dict[str, Any], sink: OutputSink) -> Dict[str, Any]:
+    started = time.perf_counter()
+    thread_id = None
+    try:
+        initial_state = batch_initial_state(case)
+        thread_id = initial_state["conversation_id"]
+        state = run_consultation(workflow, initial_state, thread_id, sink=sink)
+    except Exception as e:
+        return batch_case_result(case, None, time.perf_counter() - started, thread_id, str(e))
+    return batch_case_result(case, state, time.perf_counter() - started, thread_id)
+
+async def arun_batch_case(workflow, case: Dict[str, Any], semaphore: asyncio.Semaphore,
+                          sink: OutputSink) -> Dict[str, Any]:
+    async with semaphore:
+        started = time.perf_counter()
+        thread_id = None
+        try:
+            initial_state = await asyncio.to_thread(batch_initial_state, case)
+            thread_id = initial_state["conversation_id"]
+            state = await workflow.ainvoke(initial_state, config=consultation_config(thread_id, sink=sink))
+        except Exception as e:
+            return batch_case_result(case, None, time.perf_counter() - started, thread_id, str(e))
+        return batch_case_result(case, state, time.perf_counter() - started, thread_id)
+
+def latency_percentile(latencies: List[float], percent: float) -> float:
+    """
+    Nearest-rank percentile; 0 for no samples.
+    """
+    if not latencies:
+        return 0.0
+    ordered = sorted(latencies)
+    rank = -(-percent * len(ordered) // 100)  # ceil
+    return ordered[max(0, int(rank) - 1)]
+
+def run_batch(cases: List[Dict[str, Any]], output_path: str, concurrency: int = BATCH_CONCURRENCY,
+              use_async: bool = False, sink: Optional[OutputSink] = None) -> Dict[str, Any]:
+    """
+    Runs every case through the compiled workflow, concurrency cases at a time, and
+    appends each result to output_path (JSONL) as soon as its case completes. Agent
+    output goes to sink (nowhere by default). Returns throughput and latency statistics.
+    """
+    sink = sink if sink is not None else OutputSink()
+    get_http_session()
+    workflow = get_medical_workflow(use_async=use_async)
+    latencies: List[float] = []
+    statuses: Dict[str, int] = {}
+    started = time.perf_counter()
+
+    with open(output_path, "a", encoding="utf-8") as output:
+        def write(result: Dict[str, Any]) -> None:
+            output.write(json.dumps(result, default=str) + "\n")
+            output.flush()
+            latencies.append(result["latency_s"])
+            statuses[result["status"]] = statuses.get(result["status"], 0) + 1
+            print(f"Case {result['id']}: {result['status']} in {result['latency_s']:.1f}s "
+                  f"({len(latencies)}/{len(cases)})")
+
+        if use_async:
+            async def run_all():
+                semaphore = asyncio.Semaphore(concurrency)
+                for finished in asyncio.as_completed([arun_batch_case(workflow, case, semaphore, sink) for case in cases]):
+                    write(await finished)
+                await get_async_http_client().aclose()
+            asyncio.run(run_all())
+        else:
+            with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="batch") as executor:
+                futures = [executor.submit(run_batch_case, workflow, case, sink) for case in cases]
+                for finished in concurrent.futures.as_completed(futures):
+                    write(finished.result())
+
+    elapsed = time.perf_counter() - started
+    return {
+        "cases": len(cases),
+        "statuses": statuses,
+        "elapsed_s": round(elapsed, 2),
+        "throughput_per_min": round(len(cases) / elapsed * 60, 2) if elapsed else 0.0,
+        "latency_p50_s": latency_percentile(latencies, 50),
+        "latency_p95_s": latency_percentile(latencies, 95),
+        "upstream": get_upstream_limiter().metrics() if UPSTREAM_LIMITER else None,
+    }
+
+def batch_main(argv: List[str]) -> int:
+    import argparse
+    parser = argparse.ArgumentParser(prog="AgentDx-v1.py batch", description="Run AgentDx over a file of cases without the UI.")
+    parser.add_argument("cases", help="JSONL or CSV file with a report column and optional id and images columns")
+    parser.add_argument("output", help="JSONL file the results are appended to")
+    parser.add_argument("--concurrency", type=int, default=BATCH_CONCURRENCY, help="Cases run at once")
+    parser.add_argument("--async", dest="use_async", action="store_true",
+                        help="Run the cases as coroutines on one event loop instead of worker threads")
+    parser.add_argument("--events", help="Also write every node and stream event to this JSONL file")
+    args = parser.parse_args(argv)
+
+    cases = read_batch_cases(args.cases)
+    print(f"Running {len(cases)} cases with concurrency {args.concurrency} ({'async' if args.use_async else 'threads'})")
+    sink = JsonlSink(args.events) if args.events else None
+    try:
+        stats = run_batch(cases, args.output, args.concurrency, args.use_async, sink)
+    finally:
+        if sink is not None:
+            sink.close()
+    print(f"Done: {stats['cases']} cases in {stats['elapsed_s']}s, {stats['throughput_per_min']} cases/min, "
+          f"p50 {stats['latency_p50_s']}s, p95 {stats['latency_p95_s']}s, {stats['statuses']}")
+    if stats["upstream"]:
+        print(f"Upstream: {stats['upstream']}")
+    return 0 if stats["statuses"].get("finished", 0) == stats["cases"] else 1
+
+# HTTP service: python AgentDx-v1.py serve [--host H] [--port P]
+#   POST /consultations                 report + images (JSON with base64 images, or multipart form)
+#   GET  /consultations/{id}            status, and the result once finished
+#   GET  /consultations/{id}/events     server-sent events: node_start, stream_start, chunk, stream_end, node_end, final
+SERVICE_HOST = os.environ.get("AGENTDX_SERVICE_HOST", "127.0.0.1")
+SERVICE_PORT = int(os.environ.get("AGENTDX_SERVICE_PORT", "8000"))
+SSE_KEEPALIVE_SECONDS = float(os.environ.get("AGENTDX_SSE_KEEPALIVE", "15"))
+SERVICE_RETRY_AFTER_SECONDS = 10  # Suggested to clients turned away with a full backlog
+
+def _import_service():
+    try:
+        import starlette.applications, starlette.responses, starlette.routing
+    except ImportError as e:
+        raise ImportError("The HTTP service requires starlette, uvicorn, python-multipart and httpx: "
+                          "pip install starlette uvicorn python-multipart httpx") from e
+    _import_httpx()
+    return starlette
+
+def format_sse(index: int, event: Dict[str, Any]) -> str:
+    return f"id: {index}\nevent: {event['event']}\ndata: {json.dumps(event, default=str)}\n\n"
+
+def consultation_job_view(job: ConsultationJob) -> Dict[str, Any]:
+    """
+    Polling view of a job: progress while it runs, the result once it is done.
+    """
+    progress = job.snapshot()
+    view = {"id": job.id, "thread_id": job.thread_id, "status": progress["status"], "created": progress["created"],
+            "started": progress["started"], "finished": progress["finished"],
+            "nodes": progress["events"], "events": f"/consultations/{job.id}/events"}
+    if progress["status"] == "done":
+        view["result"] = consultation_result(job.state)
+    elif progress["status"] == "failed":
+        view["error"] = progress["error"]
+    return view
+
+async def _read_consultation_request(request):
+    """
+    Returns (report, image bytes) from a JSON body ({"report", "images": [base64, ...]})
+    or a multipart form (report field, one or more image files).
+    """
+    if request.headers.get("content-type", "").startswith("multipart/form-data"):
+        form = await request.form()
+        uploads = [upload for key in ("image", "images") for upload in form.getlist(key) if hasattr(upload, "read")]
+        return form.get("report"), [await upload.read() for upload in uploads]
+    body = await request.json()
+    if not isinstance(body, dict):
+        raise ValueError("expected a JSON object")
+    images = body.get("images") or ([body["image"]] if body.get("image") else [])
+    return body.get("report"), [base64.b64decode(image) for image in images]
+
+def create_service_app(workflow=None, runner: Optional[AsyncConsultationRunner] = None):
+    """
+    ASGI app running consultations as tasks on the server's event loop through the
+    async graph, with a bounded backlog. workflow must be an async compiled graph.
+    """
+    _import_service()
+    from starlette.applications import Starlette
+    from starlette.responses import Response, StreamingResponse
+    from starlette.routing import Route
+
+    def JSONResponse(content: Dict[str, Any], status_code: int = 200, headers=None) -> Response:
+        # States carry sets and timestamps the stock JSONResponse would reject
+        return Response(json.dumps(content, default=str), status_code, headers, media_type="application/json")
+
+    workflow = workflow if workflow is not None else get_medical_workflow(use_async=True)
+    runner = runner if runner is not None else AsyncConsultationRunner()
+
+    def busy() -> Response:
+        return JSONResponse({"error": "Too many consultations in progress, retry later"}, status_code=503,
+                            headers={"Retry-After": str(SERVICE_RETRY_AFTER_SECONDS)})
+
+    async def submit(request):
+        # Checked before and after reading the upload, which other requests may overtake
+        if runner.full():
+            return busy()
+        try:
+            report, image_data = await _read_consultation_request(request)
+        except ValueError as e:
+            return JSONResponse({"error": f"Malformed request: {e}"}, status_code=400)
+        if not report or not isinstance(report, str):
+            return JSONResponse({"error": "report is required"}, status_code=400)
+        try:
+            initial_state = await asyncio.to_thread(consultation_initial_state, report, image_data)
+        except (UnidentifiedImageError, OSError) as e:
+            return JSONResponse({"error": f"Unsupported image: {e}"}, status_code=400)
+        if runner.full():
+            return busy()
+        job_id = runner.submit(workflow, initial_state, initial_state["conversation_id"])
+        return JSONResponse(consultation_job_view(runner.get(job_id)), status_code=202,
+                            headers={"Location": f"/consultations/{job_id}"})
+
+    def find_job(request) -> Optional[ConsultationJob]:
+        return runner.get(request.path_params["job_id"])
+
+    async def status(request):
+        job = find_job(request)
+        if job is None:
+            return JSONResponse({"error": "Unknown consultation"}, status_code=404)
+        return JSONResponse(consultation_job_view(job))
+
+    async def events(request):
+        job = find_job(request)
+        if job is None:
+            return JSONResponse({"error": "Unknown consultation"}, status_code=404)
+        try:
+            cursor = int(request.headers.get("last-event-id", "-1")) + 1
+        except ValueError:
+            cursor = 0
+
+        async def stream():
+            nonlocal cursor
+            loop = asyncio.get_running_loop()
+            wakeup = asyncio.Event()
+            listener = lambda: loop.call_soon_threadsafe(wakeup.set)
+            job.add_listener(listener)
+            try:
+                while True:
+                    wakeup.clear()
+                    done = job.done
+                    for event in job.events_since(cursor):
+                        yield format_sse(cursor, event)
+                        cursor += 1
+                    if done:
+                        return
+                    try:
+                        await asyncio.wait_for(wakeup.wait(), SSE_KEEPALIVE_SECONDS)
+                    except asyncio.TimeoutError:
+                        yield ": keep-alive\n\n"
+            finally:
+                job.remove_listener(listener)
+
+        return StreamingResponse(stream(), media_type="text/event-stream",
+                                 headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+    async def health(request):
+        return JSONResponse({"status": "ok", "active_consultations": runner.active(),
+                             "capacity": runner.max_active + runner.max_queued,
+                             "upstream": get_upstream_limiter().metrics() if UPSTREAM_LIMITER else None})
+
+    async def metrics(request):
+        return JSONResponse(get_upstream_limiter().metrics() if UPSTREAM_LIMITER else {})
+
+    return Starlette(routes=[
+        Route("/consultations", submit, methods=["POST"]),
+        Route("/consultations/{job_id}", status, methods=["GET"]),
+        Route("/consultations/{job_id}/events", events, methods=["GET"]),
+        Route("/health", health, methods=["GET"]),
+        Route("/metrics", metrics, methods=["GET"]),
+    ])
+
+def serve_main(argv: List[str]) -> int:
+    import argparse
+    parser = argparse.ArgumentParser(prog="AgentDx-v1.py serve", description="Serve AgentDx consultations over HTTP.")
+    parser.add_argument("--host", default=SERVICE_HOST)
+    parser.add_argument("--port", type=int, default=SERVICE_PORT)
+    args = parser.parse_args(argv)
+    _import_service()
+    try:
+        import uvicorn
+    except ImportError as e:
+        raise ImportError("The HTTP service requires uvicorn: pip install uvicorn") from e
+    # One process: the compiled graph, the job table and the upstream client are shared by every request
+    uvicorn.run(create_service_app(), host=args.host, port=args.port)
+    return 0
 
 if __name__ == "__main__":
+    if HEADLESS:
+        sys.exit((batch_main if sys.argv[1] == "batch" else serve_main)(sys.argv[2:]))
     main()
\ No newline at end of file